@@ -39,6 +39,8 @@ setup(
     entry_points = {
         'console_scripts': [
             'unisencoder = unisencoder.decoder:main',
+            'unisencoder-server = unisencoder.webserver:main',
+            'unisencoder-ps = unisencoder.perfsonar:main',
         ]
     },
 )
@@ -0,0 +1,175 @@
+'''
+End-to-end dispatcher benchmark against the in-process fake UNIS.
+
+Generates a synthetic tree of .xnd files, dispatches it and reports
+files/sec, latency percentiles per kind of UNIS operation and the number of
+UNIS requests.
+
+    python -m unisencoder.benchmark --files 1000 --extents 16 --latency 0.005
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import settings
+import dispatcher
+from fakeunis import FakeUNIS
+
+
+XND_TEMPLATE = """<?xml version="1.0"?>
+<exnode xmlns="http://loci.cs.utk.edu/exnode">
+  <metadata name="Version" type="string">3.0</metadata>
+  <metadata name="filename" type="string">%(name)s</metadata>
+  <metadata name="lorsversion" type="string">0.82</metadata>
+%(mappings)s
+</exnode>
+"""
+
+MAPPING_TEMPLATE = """  <mapping>
+    <read>ibp://depot%(depot)d.example.org:6714/0#%(key)s/READ</read>
+    <write>ibp://depot%(depot)d.example.org:6714/0#%(key)s/WRITE</write>
+    <manage>ibp://depot%(depot)d.example.org:6714/0#%(key)s/MANAGE</manage>
+    <metadata name="alloc_length" type="integer">%(size)d</metadata>
+    <metadata name="alloc_offset" type="integer">0</metadata>
+    <metadata name="exnode_offset" type="integer">%(offset)d</metadata>
+    <metadata name="logical_length" type="integer">%(size)d</metadata>
+    <metadata name="e2e_blocksize" type="integer">0</metadata>
+  </mapping>"""
+
+
+def make_xnd_tree(path, files, extents, extent_size=1024 * 1024, per_directory=100):
+    """Writes files synthetic exnodes of extents mappings each under path."""
+    names = []
+    for index in range(files):
+        directory = os.path.join(path, "d%04d" % (index / per_directory))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        name = "file%06d.xnd" % index
+        mappings = []
+        for extent in range(extents):
+            mappings.append(MAPPING_TEMPLATE % {
+                "depot": extent % 4,
+                "key": "%d-%d" % (index, extent),
+                "size": extent_size,
+                "offset": extent * extent_size,
+            })
+        filename = os.path.join(directory, name)
+        with open(filename, 'w') as out_file:
+            out_file.write(XND_TEMPLATE % {"name": name, "mappings": "\n".join(mappings)})
+        names.append(filename)
+    return names
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+# Dispatcher operations timed separately, a batch POST and a modified time
+# update have very different costs and would blur each other's percentiles
+TIMED_OPERATIONS = ["CreateRemoteDirectory", "DispatchBatch", "PostExnode",
+                    "DispatchStream", "UpdateModified"]
+
+
+def timed(func, latencies):
+    """Wraps func to append the duration of every call to latencies."""
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+    return wrapper
+
+
+def run(files, extents, latency=0, error_rate=0.0, batch_size=None, gzip=False):
+    """Runs one dispatch of a synthetic tree and returns the measurements."""
+    workdir = tempfile.mkdtemp(prefix="unisencoder-bench-")
+    unis = FakeUNIS(latency=latency, error_rate=error_rate).start()
+    xnd_path = settings.XND_FILE_PATH
+    log_path = settings.DISPATCH_LOG_PATH
+    batch = settings.EXNODE_BATCH_SIZE
+    try:
+        settings.XND_FILE_PATH = os.path.join(workdir, "xnd")
+        settings.DISPATCH_LOG_PATH = os.path.join(workdir, "dispatched_files.log")
+        if batch_size is not None:
+            settings.EXNODE_BATCH_SIZE = batch_size
+        make_xnd_tree(settings.XND_FILE_PATH, files, extents)
+
+        dispatch = dispatcher.Dispatcher(host=unis.host, port=unis.port, gzip=gzip)
+        latencies = dict((name, []) for name in TIMED_OPERATIONS)
+        for name in TIMED_OPERATIONS:
+            setattr(dispatch, name, timed(getattr(dispatch, name), latencies[name]))
+
+        start = time.time()
+        entries = dispatcher.read_dispatch_log()
+        dispatch_list = dispatcher.build_dispatch_list(dispatcher.create_file_list(), entries)
+        root_id = dispatch.CreateRemoteDirectory(settings.ROOT_NAME, None)
+        dispatcher.dispatch_files(dispatch, dispatch_list, entries, root_id)
+        elapsed = time.time() - start
+        dispatch._client.close()
+        # Only the files journaled with an id were uploaded under their parent
+        uploaded = len([entry for entry in entries.itervalues() if entry["id"]])
+
+        return {
+            "files": len(dispatch_list),
+            "uploaded": uploaded,
+            "failed": len(dispatch_list) - uploaded,
+            "seconds": elapsed,
+            "files_per_sec": len(dispatch_list) / elapsed if elapsed else 0.0,
+            "latencies": dict((name, (len(values), percentile(values, 0.50),
+                                      percentile(values, 0.99)))
+                              for name, values in latencies.iteritems() if values),
+            "requests": unis.request_count,
+            "errors": unis.error_count,
+            "bytes": unis.bytes_received,
+        }
+    finally:
+        settings.XND_FILE_PATH = xnd_path
+        settings.DISPATCH_LOG_PATH = log_path
+        settings.EXNODE_BATCH_SIZE = batch
+        unis.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the exnode dispatcher against a fake UNIS"
+    )
+    parser.add_argument('-n', '--files', type=int, default=1000,
+        help='Number of synthetic .xnd files.')
+    parser.add_argument('-e', '--extents', type=int, default=8,
+        help='Mappings per file.')
+    parser.add_argument('--latency', type=float, default=0,
+        help='Seconds the fake UNIS waits before every answer.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='Fraction of UNIS requests answered with an error.')
+    parser.add_argument('--batch-size', type=int, default=None,
+        help='Exnodes per POST (default settings.EXNODE_BATCH_SIZE).')
+    parser.add_argument('-z', '--gzip', action='store_true',
+        help='Compress upload bodies.')
+    args = parser.parse_args()
+
+    result = run(args.files, args.extents, args.latency, args.error_rate,
+                 args.batch_size, args.gzip)
+    print "files:         %d (%d uploaded, %d failed)" % (result["files"], result["uploaded"],
+                                                    result["failed"])
+    print "elapsed:       %.2f s" % result["seconds"]
+    print "throughput:    %.1f files/s" % result["files_per_sec"]
+    for name in TIMED_OPERATIONS:
+        if name in result["latencies"]:
+            count, p50, p99 = result["latencies"][name]
+            print "%-22s %6d calls, p50 %.2f ms, p99 %.2f ms" % \
+                (name + ":", count, p50 * 1000, p99 * 1000)
+    print "UNIS requests: %d (%d errors)" % (result["requests"], result["errors"])
+    print "bytes sent:    %d" % result["bytes"]
+
+if __name__ == '__main__':
+    main()
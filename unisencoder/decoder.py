@@ -8,10 +8,12 @@ Decodes different topologies to UNIS representation.
 """
 
 import argparse
+import collections
 import json
 import logging
 import calendar
 import datetime
+import multiprocessing
 import os
 import re
 import sys
@@ -20,6 +22,11 @@ import pdb #python debugger use, pdb.set_trace(), to start trace
 import settings
 from lxml import etree
 from netlogger import nllog
+from extents import ExtentIndex, coalesce_extents, make_lifetimes
+import model
+from output import share_definitions, canonicalize, write_index, build_index, \
+    is_mapping, move_pointer, rewrite_pointers
+from registry import URNRegistry
 from urllib import unquote
 from urllib import quote
 import urllib2 
@@ -54,6 +61,67 @@ class UNISDecoder(object, nllog.DoesLogging):
         """Abstract method."""
         raise NotImplementedError
     
+    def reset(self):
+        """Clears the per document state so the decoder can be reused."""
+        pass
+    
+    def _finish(self, sout, **kwargs):
+        """
+        Parses the encoded JSON text, into the slotted classes of
+        model when encode was called with compact=True. The decoders
+        release their dict tree before calling this, so the peak of an
+        encode is the larger of the tree and the output plus the text. With
+        canonical=True the output is put in the canonical form of
+        output.canonicalize. With a registry (registry.URNRegistry) the
+        output is recorded under document, by default its URN, and its
+        references to other documents are resolved.
+        """
+        if kwargs.get("compact", False):
+            out = model.loads(sout)
+        else:
+            out = json.loads(sout)
+        if kwargs.get("canonical", False):
+            canonicalize(out)
+        urn_registry = kwargs.get("registry", None)
+        if urn_registry is not None:
+            document = kwargs.get("document", None) or out.get("urn", None) or \
+                kwargs.get("component_manager_id", None) or kwargs.get("slice_urn", None)
+            if document is None:
+                raise UNISDecoderException("A document name is required to use the URN registry")
+            urn_registry.register(document, out)
+            urn_registry.resolve(out, document)
+        return out
+    
+    def _encode_parallel(self, elements, **kwargs):
+        """
+        Encodes independent subtrees of the document with _encode_subtree
+        in a pool of kwargs["processes"] processes. Only the plain options
+        of kwargs are sent along. Returns the results in the order of
+        elements.
+        """
+        processes = kwargs["processes"]
+        documents = [etree.tostring(element, with_tail=False) for element in elements]
+        options = dict((key, value) for key, value in kwargs.iteritems()
+                       if key != "processes" and
+                       (value is None or isinstance(value, (basestring, bool, int, long, float))))
+        batches = processes * settings.PARALLEL_CHUNKS
+        size = max(1, (len(documents) + batches - 1) / batches)
+        jobs = [(self.__class__, documents[start:start + size], options)
+                for start in range(0, len(documents), size)]
+        self.log.debug("encode_parallel", subtrees=len(documents), jobs=len(jobs),
+            processes=processes, guid=self._guid)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_encode_subtrees, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return collections.deque(result for batch in results for result in batch)
+    
+    def _encode_subtree(self, element, **kwargs):
+        """Abstract method, encodes one subtree for _encode_parallel."""
+        raise NotImplementedError
+    
     def _encode_ignore(self, doc, out, **kwargs):
         """Just log Ignore an element."""
         self.log.info("ignore", tag=doc.tag, guid=self._guid)
@@ -159,6 +227,11 @@ class ExnodeDecoder(UNISDecoder):
         self._names["e2e_blocksize"]  = None
         self._names["exnode_offset"]  = "offset"
         self._names["logical_length"] = "size"
+        self.reset()
+
+    def reset(self):
+        # ExtentIndex of the last encoded exnode, see encode's extent_index
+        self.extent_index = None
 
     def _refactor_default_xmlns(self, tree):
         """
@@ -198,7 +271,13 @@ class ExnodeDecoder(UNISDecoder):
         return tree
     
     def encode(self, tree, **kwargs):
+        """
+        Encodes an exnode. With coalesce=True the extents are written in
+        the compact form of extents.coalesce_extents. With extent_index=True
+        an ExtentIndex of the extents is also left in self.extent_index.
+        """
         self.log.debug("encode.start", guid = self._guid)
+        self.reset()
 
         out = {}
         self._parent_collection = out
@@ -220,9 +299,80 @@ class ExnodeDecoder(UNISDecoder):
             self._duration = settings.DEFAULT_EXNODE_DURATION
         
         out = self.visit(root, None)
+        if kwargs.get("coalesce", False):
+            out["extents"] = coalesce_extents(out["extents"])
+        if kwargs.get("extent_index", False):
+            self.extent_index = ExtentIndex.from_extents(out["extents"])
         self.log.debug("encode.end", guid = self._guid)
         return out
     
+    def iterencode(self, source, **kwargs):
+        """
+        Encodes the exnode read from source (a filename or file object)
+        and yields its JSON text piece by piece. The document is parsed
+        incrementally and every mapping is written and freed as soon as it
+        is read, so memory does not grow with the number of mappings. The
+        root fields, size included, come after the extents. Takes the
+        options of encode, except coalesce and extent_index, and an
+        optional properties dict added to the root.
+        """
+        self.log.debug("iterencode.start", guid = self._guid)
+        self.reset()
+        self._duration = kwargs.get("duration", settings.DEFAULT_EXNODE_DURATION)
+        self._file_size = 0
+        root = {}
+
+        yield '{"extents": ['
+        count = 0
+        for event, element in etree.iterparse(source, events = ("end",)):
+            if not isinstance(element.tag, basestring):
+                continue
+            tag = etree.QName(element).localname
+            parent = element.getparent()
+            if tag == "metadata" and parent is not None and parent.getparent() is None:
+                name = self._names.get(element.get("name"), None)
+                if name is not None:
+                    root[name] = element.text
+            elif tag == "mapping":
+                extent = self._stream_extent(element)
+                yield (", " if count else "") + json.dumps(extent)
+                count += 1
+                # Free the mapping and everything read before it
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+        root["size"] = self._file_size
+        root["parent"] = kwargs.get("parent", None)
+        root["created"] = kwargs["creation_time"]
+        root["mode"] = "file"
+        root["modified"] = kwargs["modified_time"]
+        if kwargs.get("properties", None) is not None:
+            root["properties"] = kwargs["properties"]
+        yield "], " + json.dumps(root)[1:]
+        self.log.debug("iterencode.end", extents = count, guid = self._guid)
+
+    def _stream_extent(self, element):
+        """Builds the extent of a mapping element, as visit would."""
+        extent = {}
+        extent["location"] = "ibp://"
+        extent["$schema"] = "http://unis.incntre.iu.edu/schema/exnode/ext/ibp#"
+        extent["lifetimes"] = make_lifetimes(self._duration)
+        for child in element.iterchildren(tag = etree.Element):
+            tag = etree.QName(child).localname
+            if tag in ("read", "write", "manage"):
+                extent.setdefault("mapping", {})[tag] = child.text
+            elif tag == "metadata":
+                name = self._names.get(child.get("name"), None)
+                if name == "size":
+                    self._file_size += int(child.text)
+                    extent[name] = int(child.text)
+                elif name == "offset":
+                    extent[name] = int(child.text)
+                elif name is not None:
+                    extent[name] = child.text
+        return extent
+
     def visit(self, node, parent):
         out = {}
         if node is None:
@@ -273,13 +423,10 @@ class ExnodeDecoder(UNISDecoder):
             tmpNode["extents"] = []
             out = tmpNode
         elif node.tag == "mapping":
-            tmpStart = datetime.datetime.utcnow()
-            tmpEnd = tmpStart + datetime.timedelta(hours = self._duration)
             tmpNode = {}
             tmpNode["location"] = "ibp://"
             tmpNode["$schema"] = "http://unis.incntre.iu.edu/schema/exnode/ext/ibp#"
-            tmpNode["lifetimes"] = []
-            tmpNode["lifetimes"].append({"start": tmpStart.strftime("%Y-%m-%d %H:%M:%S%z"), "end": tmpEnd.strftime("%Y-%m-%d %H:%M:%S%z")})
+            tmpNode["lifetimes"] = make_lifetimes(self._duration)
             out = tmpNode
         else:
             out = outValue
@@ -317,6 +464,48 @@ class ExnodeDecoder(UNISDecoder):
         self.log.debug("GenerateTag.start", component_id = node.attrib.get("component_id", None), guid = self._guid)
         return out
         
+class ElementFilter(object):
+    """
+    Selects the top level nodes and links of an RSpec that are encoded,
+    the others are skipped before their handlers run. Every condition
+    given must hold:
+    
+    kinds -- element names to keep, "node" and/or "link"
+    urn_prefix -- prefix of the component_id (sliver_id without one)
+    component_manager -- URN of the component manager of the element
+    available -- availability of nodes, <available now="..."/>; links pass
+    """
+    
+    def __init__(self, kinds=None, urn_prefix=None, component_manager=None, available=None):
+        self.kinds = set(kinds) if kinds else None
+        self.urn_prefix = urn_prefix
+        self.component_manager = component_manager
+        self.available = available
+    
+    def matches(self, element):
+        kind = element.tag.rsplit("}", 1)[-1]
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+        if self.urn_prefix is not None:
+            urn = element.get("component_id", None) or element.get("sliver_id", None)
+            if urn is None or not unquote(urn).strip().startswith(self.urn_prefix):
+                return False
+        if self.component_manager is not None:
+            managers = [element.get("component_manager_id", None)]
+            managers += [child.get("name", None) for child in element.iterchildren()
+                         if child.tag.endswith("}component_manager")]
+            if self.component_manager not in [m.strip() for m in managers if m]:
+                return False
+        if self.available is not None and kind == "node":
+            available = False
+            for child in element.iterchildren():
+                if child.tag.endswith("}available"):
+                    available = child.get("now", "").strip().lower() in ("true", "1")
+            if available != self.available:
+                return False
+        return True
+
+
 class RSpec3Decoder(UNISDecoder):
     """Decodes RSpecV3 to UNIS format."""
     
@@ -335,14 +524,7 @@ class RSpec3Decoder(UNISDecoder):
 
     def __init__(self):
         super(RSpec3Decoder, self).__init__()
-        self._parent_collection = {}
-        self._tree = None
-        self._root = None
-        self._jsonpointer_path = "#/"
-        self._jsonpath_cache = {}
-        self._urn_cache = {}
-        self._component_id_cache = {}
-        self._sliver_id_cache = {}
+        self.reset()
         self.geni_ns = "geni"
         self._ignored_namespaces = [
             "http://hpn.east.isi.edu/rspec/ext/stitch/0.1/",
@@ -350,13 +532,12 @@ class RSpec3Decoder(UNISDecoder):
             "http://www.protogeni.net/resources/rspec/ext/flack/1",
             "http://www.protogeni.net/resources/rspec/ext/client/1",
         ]
-        # Resolving jsonpath is expensive operation
-        # This cache keeps track of jsonpath used to replaced in the end
-        # with jsonpointers
-        self._subsitution_cache = {}
 
         self._handlers = {}
+        # Top level elements an ElementFilter applies to
+        self._filtered_tags = set()
         for ns in RSpec3Decoder.rspec3:
+            self._filtered_tags.update(["{%s}node" % ns, "{%s}link" % ns])
             self._handlers.update({
             "{%s}%s" % (ns, "rspec") : self._encode_rspec,
             "{%s}%s" % (ns, "node") : self._encode_rspec_node,
@@ -389,14 +570,37 @@ class RSpec3Decoder(UNISDecoder):
             "{%s}%s" % (ns, "monitor_urn") : self._encode_gemini_monitor_urn,
             })
 
+    def reset(self):
+        self._parent_collection = {}
+        self._tree = None
+        self._root = None
+        self.ns_default = None
+        self._jsonpointer_path = "#/"
+        self._jsonpath_cache = {}
+        self._urn_cache = {}
+        self._component_id_cache = {}
+        self._sliver_id_cache = {}
+        # Nodes encoded by _encode_parallel, in document order
+        self._encoded_subtrees = None
+        self._element_filter = None
+        self._slice_urn = None
+        # Resolving jsonpath is expensive operation
+        # This cache keeps track of jsonpath used to replaced in the end
+        # with jsonpointers
+        self._subsitution_cache = {}
+
     def _encode_children(self, doc, out, **kwargs):
         """Iterates over the all child nodes and process and call the approperiate
         handler for each one."""
+        element_filter = kwargs.get("element_filter", None)
         for child in doc.iterchildren():
             if child.tag is etree.Comment:
                 continue
             if child.nsmap.get(child.prefix, None) in self._ignored_namespaces:
                 continue
+            if element_filter is not None and child.tag in self._filtered_tags and \
+                    not element_filter.matches(child):
+                continue
             self.log.debug("_encode_children.start", child=child.tag, guid=self._guid)
             if child.tag in self._handlers:
                 self._handlers[child.tag](child, out, **kwargs)
@@ -462,7 +666,7 @@ class RSpec3Decoder(UNISDecoder):
               </xsl:attribute>
            </xsl:template>
         </xsl:stylesheet>
-        """ % (exclude_ns, exclude_prefixes, RSpec3Decoder.ns_default)
+        """ % (exclude_ns, exclude_prefixes, self.ns_default)
         
         xslt_root = etree.XML(XSLT)
         transform = etree.XSLT(xslt_root)
@@ -472,11 +676,14 @@ class RSpec3Decoder(UNISDecoder):
 
     def encode(self, tree, slice_urn=None, **kwargs):
         self.log.debug("encode.start", guid=self._guid)
+        self.reset()
+        self._element_filter = kwargs.get("element_filter", None)
+        self._slice_urn = slice_urn
         out = {}
         
         # set the default document namespace
         root = tree.getroot()
-        RSpec3Decoder.ns_default = root.nsmap[None]
+        self.ns_default = root.nsmap[None]
 
         tree = self._refactor_default_xmlns(tree)
         root = tree.getroot()
@@ -491,12 +698,18 @@ class RSpec3Decoder(UNISDecoder):
             #pdb.set_trace()
             sys.stderr.write("No handler for: %s\n" % root.tag)
         
+        if kwargs.get("shared_definitions", False):
+            share_definitions(out, self.geni_ns)
         sout = json.dumps(out)
         # This is an optimization hack to make every jsonpath a jsonpointer
         for urn, jpath in self._subsitution_cache.iteritems():
             if urn in self._jsonpath_cache:
                 sout = sout.replace(jpath, self._jsonpath_cache[urn])
-        out = json.loads(sout)
+        # Only the text is needed from here on, let the dict tree and the
+        # caches pointing into it go before _finish builds the output
+        out = None
+        self.reset()
+        out = self._finish(sout, slice_urn=slice_urn, **kwargs)
         
         self.log.debug("encode.end", guid=self._guid)
         return out
@@ -576,6 +789,16 @@ class RSpec3Decoder(UNISDecoder):
             out["id"] = self.geni_urn_to_id(component_manager_id)
             out["urn"] = component_manager_id
         
+        # The nodes are independent until links refer to their interfaces
+        processes = kwargs.get("processes", None)
+        if processes is not None and processes > 1 and out is self._parent_collection:
+            nodes = list(doc.iterchildren("{%s}node" % self.ns_default))
+            if self._element_filter is not None:
+                nodes = [node for node in nodes if self._element_filter.matches(node)]
+            if len(nodes) > 1:
+                self._encoded_subtrees = self._encode_parallel(nodes,
+                    rspec_type=rspec_type, **kwargs)
+        
         # Iterate children
         self._encode_children(doc, out, rspec_type=rspec_type,
             collection=collection, parent=out, **kwargs)
@@ -593,6 +816,8 @@ class RSpec3Decoder(UNISDecoder):
     def _encode_rspec_node(self, doc, out, collection, **kwargs):
         self.log.debug("_encode_rspec_node.start",
             component_id=doc.attrib.get("component_id", None), guid=self._guid)
+        if self._encoded_subtrees is not None and collection is self._parent_collection:
+            return self._add_encoded_node(doc, collection)
         assert isinstance(out, dict)
         assert doc.nsmap['rspec'] in RSpec3Decoder.rspec3, \
             "Not valid element '%s'" % doc.tag
@@ -678,6 +903,60 @@ class RSpec3Decoder(UNISDecoder):
             component_id=doc.attrib.get("component_id", None), guid=self._guid)
         return node
         
+    def _encode_subtree(self, element, **kwargs):
+        """
+        Encodes one top level node alone, as the first node of an empty
+        RSpec. Returns the node, its ports and their URN pointers.
+        """
+        self.reset()
+        self.ns_default = element.nsmap.get("rspec", None)
+        self._tree = element.getroottree()
+        self._root = element
+        collection = {}
+        self._parent_collection = collection
+        self._jsonpointer_path = "#"
+        self._encode_rspec_node(element, collection, collection=collection,
+            parent=collection, **kwargs)
+        return {
+            "node": collection["nodes"][0],
+            "ports": collection.get("ports", []),
+            "urns": self._urn_cache,
+            "substitutions": self._subsitution_cache,
+        }
+    
+    def _add_encoded_node(self, doc, collection):
+        """Adds the next node of _encode_parallel, moving its pointers to their place."""
+        encoded = self._encoded_subtrees.popleft()
+        node = encoded["node"]
+        ports = encoded["ports"]
+        if "nodes" not in collection:
+            collection["nodes"] = []
+        moves = {"#/nodes/0": "#/nodes/%d" % len(collection["nodes"])}
+        if ports:
+            if "ports" not in collection:
+                collection["ports"] = []
+            offset = len(collection["ports"])
+            for index in range(len(ports)):
+                moves["#/ports/%d" % index] = "#/ports/%d" % (offset + index)
+            rewrite_pointers(ports, moves)
+            collection["ports"].extend(ports)
+        rewrite_pointers(node, moves)
+        collection["nodes"].append(node)
+        
+        for urn, pointer in encoded["urns"].iteritems():
+            if pointer.startswith("#"):
+                pointer = move_pointer(pointer, moves)
+            self._urn_cache[urn] = pointer
+        self._subsitution_cache.update(encoded["substitutions"])
+        # Links find their interfaces by component_id
+        for element in [doc] + list(doc.iterchildren("{%s}interface" % self.ns_default)):
+            component_id = element.attrib.get("component_id", None)
+            if component_id is not None:
+                self._component_id_cache[component_id.strip()] = element
+        self.log.debug("_encode_rspec_node.end",
+            component_id=doc.attrib.get("component_id", None), guid=self._guid)
+        return node
+        
     def _encode_rspec_interface(self, doc, out, collection, **kwargs):
         self.log.debug("_encode_rspec_interface.start",
             component_id=doc.attrib.get("component_id", None),
@@ -1161,6 +1440,8 @@ class RSpec3Decoder(UNISDecoder):
         urn = unquote(urn.strip())
         if urn in self._urn_cache:
             return self._urn_cache[urn]
+        if self._element_filter is not None and self._is_filtered_out(element):
+            return self._filtered_urn(element, rspec_type, urn)
        
         # TODO (AH) : Improve generating json paths
         #if rspec_type == RSpec3Decoder.RSpecManifest:
@@ -1226,6 +1507,24 @@ class RSpec3Decoder(UNISDecoder):
         self._subsitution_cache[urn] = jpath
         return jpath
     
+    def _is_filtered_out(self, element):
+        """True if element is in a top level element the filter skipped."""
+        while element is not None and element.tag not in self._filtered_tags:
+            element = element.getparent()
+        return element is not None and not self._element_filter.matches(element)
+    
+    def _filtered_urn(self, element, rspec_type, urn):
+        """
+        The URN a skipped element would have been encoded with, the
+        reference to it is left to the registry or the reader.
+        """
+        client_id = element.get("client_id", None)
+        if rspec_type == RSpec3Decoder.RSpecManifest and client_id and self._slice_urn:
+            kind = element.tag.rsplit("}", 1)[-1]
+            return RSpec3Decoder.rspec_create_urn(
+                self._slice_urn + "+" + kind + "+" + client_id.strip())
+        return urn
+    
     def _find_sliver_id(self, urn, component_type, try_hard=False):
         """
         Looks for the any element with sliver_id == urn and of type
@@ -1248,7 +1547,7 @@ class RSpec3Decoder(UNISDecoder):
             escaped_urn = escape_urn(urn)
             xpath = ".//rspec:%s[@sliver_id='%s' or @sliver_id='%s']" \
                 % (component_type, urn, escaped_urn)
-        result = self._root.xpath(xpath, namespaces={"rspec": RSpec3Decoder.ns_default})
+        result = self._root.xpath(xpath, namespaces={"rspec": self.ns_default})
         
         if len(result) > 1:
             self.log.debug("_find_sliver_id.end", guid=self._guid, urn=urn)
@@ -1280,7 +1579,7 @@ class RSpec3Decoder(UNISDecoder):
             escaped_urn = escape_urn(urn)
             xpath = ".//rspec:%s[@client_id='%s' or @client_id='%s']" \
                 % (component_type, urn, escaped_urn)
-        result = self._root.xpath(xpath, namespaces={"rspec": RSpec3Decoder.ns_default})
+        result = self._root.xpath(xpath, namespaces={"rspec": self.ns_default})
         if len(result) > 1:
             self.log.debug("_find_client_id.end", guid=self._guid, urn=urn)
             raise UNISDecoderException("Found more than one node with the URN '%s'" % urn)
@@ -1314,7 +1613,7 @@ class RSpec3Decoder(UNISDecoder):
             escaped_urn = escape_urn(urn)
             xpath = ".//rspec:%s[@component_id='%s' or @component_id='%s']" \
                 % (component_type, urn, escaped_urn)
-        result = self._root.xpath(xpath, namespaces={"rspec": RSpec3Decoder.ns_default})
+        result = self._root.xpath(xpath, namespaces={"rspec": self.ns_default})
         
         if len(result) > 1:
             self.log.debug("_find_component_id.end", guid=self._guid, urn=urn)
@@ -1937,20 +2236,12 @@ class PSDecoder(UNISDecoder):
     nmtl3 = "http://ogf.org/schema/network/topology/l3/20070828/"
     nmtl4 = "http://ogf.org/schema/network/topology/l4/20070828/"
     nml = "http://schemas.ogf.org/nml/base/201103"
+    DOMAIN_TAGS = ["{%s}domain" % nmtb, "{%s}domain" % ctrl]
     
     def __init__(self):
         super(PSDecoder, self).__init__()
-        self._parent_collection = {}
-        self._tree = None
-        self._root = None
-        self._jsonpointer_path = "#/"
-        self._jsonpath_cache = {}
-        self._urn_cache = {}
+        self.reset()
         self._ignored_namespaces = [PSDecoder.nml]
-        # Resolving jsonpath is expensive operation
-        # This cache keeps track of jsonpath used to replaced in the end
-        # with jsonpointers
-        self._subsitution_cache = {}
         
         self._handlers = {
             "{%s}%s" % (PSDecoder.nmtb, "topology") : self._encode_topology,
@@ -2006,6 +2297,20 @@ class PSDecoder(UNISDecoder):
             "{%s}%s" % (PSDecoder.ctrl, "vlanTranslation") : self._encode_vlanTranslation,
         }
     
+    def reset(self):
+        self._parent_collection = {}
+        self._tree = None
+        self._root = None
+        self._jsonpointer_path = "#/"
+        self._jsonpath_cache = {}
+        self._urn_cache = {}
+        # Resolving jsonpath is expensive operation
+        # This cache keeps track of jsonpath used to replaced in the end
+        # with jsonpointers
+        self._subsitution_cache = {}
+        # Domains encoded by _encode_parallel, in document order
+        self._encoded_subtrees = None
+    
     @staticmethod
     def create_id(urn):
         new_id = urn.replace("urn:ogf:network:", "").replace(":", "_").replace("=", "_")
@@ -2014,6 +2319,7 @@ class PSDecoder(UNISDecoder):
  
     def encode(self, tree, **kwargs):
         self.log.debug("encode.start", guid=self._guid)
+        self.reset()
         out = {}
         self._parent_collection = out
         root = tree.getroot()
@@ -2024,6 +2330,9 @@ class PSDecoder(UNISDecoder):
         else:
             #pdb.set_trace()
             sys.stderr.write("No handler for: %s\n" % root.tag)
+        if self._encoded_subtrees is not None:
+            # References between domains encoded apart are still URNs
+            _resolve_urn_hrefs(out, build_index(out)["urns"])
         self.log.debug("encode.end", guid=self._guid)
         sout = json.dumps(out)
         
@@ -2031,7 +2340,10 @@ class PSDecoder(UNISDecoder):
         for urn, jpath in self._subsitution_cache.iteritems():
             if urn in self._jsonpath_cache:
                 sout = sout.replace(jpath, self._jsonpath_cache[urn])
-        out = json.loads(sout)
+        # Only the text is needed from here on, see RSpec3Decoder.encode
+        out = None
+        self.reset()
+        out = self._finish(sout, **kwargs)
         return out
     
     def _parse_xml_bool(self, xml_bool):
@@ -2051,6 +2363,11 @@ class PSDecoder(UNISDecoder):
             out["urn"] = self._parse_urn(urn)
             out["id"] = PSDecoder.create_id(out["urn"])
         out["$schema"] = UNISDecoder.SCHEMAS["topology"]
+        processes = kwargs.get("processes", None)
+        if processes is not None and processes > 1 and out is self._parent_collection:
+            domains = [child for child in doc.iterchildren() if child.tag in PSDecoder.DOMAIN_TAGS]
+            if len(domains) > 1:
+                self._encoded_subtrees = self._encode_parallel(domains, **kwargs)
         self._encode_children(doc, out, **kwargs)
         self.log.debug("_encode_topology.end", guid=self._guid)
         return out
@@ -2058,10 +2375,9 @@ class PSDecoder(UNISDecoder):
     def _encode_domain(self, doc, out, **kwargs):
         self.log.debug("_encode_domain.start", urn=doc.attrib.get('id', None), guid=self._guid)
         assert isinstance(out, dict)
-        assert doc.tag in [
-            "{%s}domain" % PSDecoder.nmtb,
-            "{%s}domain" % PSDecoder.ctrl,
-        ], "Not valid element '%s'" % doc.tag
+        assert doc.tag in PSDecoder.DOMAIN_TAGS, "Not valid element '%s'" % doc.tag
+        if self._encoded_subtrees is not None and out is self._parent_collection:
+            return self._add_encoded_domain(doc, out)
         domain = {}
         domain["$schema"] = UNISDecoder.SCHEMAS["domain"]
         urn = doc.attrib.get('id', None)
@@ -2085,6 +2401,45 @@ class PSDecoder(UNISDecoder):
         self.log.debug("_encode_domain.end", urn=doc.attrib.get('id', None), guid=self._guid)
         return domain
 
+    def _encode_subtree(self, element, **kwargs):
+        """
+        Encodes one domain alone, as the first domain of a topology.
+        Returns the domain as JSON text.
+        """
+        self.reset()
+        # Under a topology root the JSON paths of the domain are the ones
+        # of the whole document
+        root = etree.Element("{%s}topology" % PSDecoder.nmtb)
+        root.append(element)
+        self._tree = root.getroottree()
+        self._root = root
+        out = {}
+        self._parent_collection = out
+        self._encode_domain(element, out, **kwargs)
+        sout = json.dumps(out["domains"][0])
+        for urn, jpath in self._subsitution_cache.iteritems():
+            if urn in self._jsonpath_cache:
+                sout = sout.replace(jpath, self._jsonpath_cache[urn])
+        return sout
+    
+    def _add_encoded_domain(self, doc, out):
+        """Adds the next domain of _encode_parallel, moving its pointers to their place."""
+        sout = self._encoded_subtrees.popleft()
+        if "domains" not in out:
+            out["domains"] = []
+        index = len(out["domains"])
+        if index:
+            sout = sout.replace('"#/domains/0/', '"#/domains/%d/' % index)
+            sout = sout.replace('"$.domains[0]', '"$.domains[%d]' % index)
+            sout = sout.replace('"domains/0"', '"domains/%d"' % index)
+        domain = json.loads(sout)
+        out["domains"].append(domain)
+        if domain.get("urn", None):
+            self._urn_cache[domain["urn"]] = doc
+            self._jsonpath_cache[domain["urn"]] = "domains/%d" % index
+        self.log.debug("_encode_domain.end", urn=doc.attrib.get('id', None), guid=self._guid)
+        return domain
+
     def _encode_node(self, doc, out, collection=None, parent=None, **kwargs):
         self.log.debug("_encode_node.start",
             urn=doc.attrib.get('id', None), guid=self._guid)
@@ -2730,6 +3085,107 @@ class PSDecoder(UNISDecoder):
             self.log.debug("_encode_children.end", child=child.tag, guid=self._guid)
 
 
+# Input types accepted by the command line and the web service
+DECODERS = {
+    "rspec3": RSpec3Decoder,
+    "ps": PSDecoder,
+    "exnode": ExnodeDecoder,
+}
+
+
+def _encode_subtrees(job):
+    """Pool worker of UNISDecoder._encode_parallel."""
+    cls, documents, kwargs = job
+    decoder = cls()
+    return [decoder._encode_subtree(etree.fromstring(document), **kwargs)
+            for document in documents]
+
+
+def _resolve_urn_hrefs(obj, urns):
+    """Rewrites the hrefs of obj that are URNs found in urns to their pointers."""
+    if isinstance(obj, list):
+        for value in obj:
+            _resolve_urn_hrefs(value, urns)
+        return
+    if not is_mapping(obj):
+        return
+    href = obj.get("href", None)
+    if isinstance(href, basestring) and href in urns:
+        obj["href"] = urns[href]
+    for value in obj.itervalues():
+        if isinstance(value, list) or is_mapping(value):
+            _resolve_urn_hrefs(value, urns)
+
+
+# Options of encode_options turned into an ElementFilter
+FILTER_OPTIONS = ("kinds", "urn_prefix", "component_manager", "available")
+
+
+def encode_options(input_type, options):
+    """
+    Converts decoder options received as text (web service, stdio mode)
+    to the keyword arguments of the decoder's encode.
+    """
+    kwargs = dict((str(name), value) for name, value in options.iteritems())
+    if isinstance(kwargs.get("compact", None), basestring):
+        kwargs["compact"] = kwargs["compact"].strip().lower() in ("true", "1")
+    if input_type == "rspec3" and any(name in kwargs for name in FILTER_OPTIONS):
+        filters = dict((name, kwargs.pop(name)) for name in FILTER_OPTIONS if name in kwargs)
+        if isinstance(filters.get("kinds", None), basestring):
+            filters["kinds"] = filters["kinds"].split(",")
+        if isinstance(filters.get("available", None), basestring):
+            filters["available"] = filters["available"].strip().lower() in ("true", "1")
+        kwargs["element_filter"] = ElementFilter(**filters)
+    if input_type == "exnode":
+        now = calendar.timegm(datetime.datetime.utcnow().timetuple())
+        kwargs["creation_time"] = int(kwargs.get("creation_time", now))
+        kwargs["modified_time"] = int(kwargs.get("modified_time", now))
+        if "duration" in kwargs:
+            kwargs["duration"] = float(kwargs["duration"])
+    return kwargs
+
+
+def serve_stdio(in_file, out_file):
+    """
+    Encodes documents read from in_file as JSON lines until EOF, keeping
+    one warm decoder per input type. Each request is an object with "type",
+    "options" and the XML document in "payload", and an optional "id" that
+    is echoed back. Each response is written as one line holding either
+    "result" or "error".
+    """
+    decoders = {}
+    # readline instead of iterating the file: iteration reads ahead and
+    # would block waiting for requests the caller has not sent yet
+    for line in iter(in_file.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        response = {}
+        try:
+            request = json.loads(line)
+            response["id"] = request.get("id", None)
+            input_type = request.get("type", None)
+            if input_type not in DECODERS:
+                raise UNISDecoderException("Unknown input type '%s'" % input_type)
+            kwargs = encode_options(input_type, request.get("options", {}))
+            payload = request["payload"]
+            if isinstance(payload, unicode):
+                payload = payload.encode("utf-8")
+            tree = etree.fromstring(payload).getroottree()
+            if input_type not in decoders:
+                decoders[input_type] = DECODERS[input_type]()
+            decoder = decoders[input_type]
+            try:
+                response["result"] = decoder.encode(tree, **kwargs)
+            finally:
+                decoder.reset()
+        except Exception, e:
+            response["error"] = str(e)
+        out_file.write(json.dumps(response, cls=model.ModelEncoder))
+        out_file.write("\n")
+        out_file.flush()
+
+
 def setup_logger(filename="unisencoder.log"):
     logging.setLoggerClass(nllog.BPLogger)
     log = logging.getLogger(nllog.PROJECT_NAMESPACE)
@@ -2752,19 +3208,20 @@ def make_envelope(content):
     """ % content
     return envelope
 
-def send_receive(url, envelope):
+def send_receive(url, envelope, timeout=None):
     req = urllib2.Request(url=url, data=envelope,
         headers={
             'Content-type': 'text/xml; charset="UTF-8"',
             'SOAPAction': 'http://ggf.org/ns/nmwg/base/2.0/message/'
         }
     )
-    f = urllib2.urlopen(req)
+    if timeout is None:
+        f = urllib2.urlopen(req)
+    else:
+        f = urllib2.urlopen(req, timeout=timeout)
     return f.read()
     
-    
-def pull_topology(url):
-    query = """
+TS_QUERY = """
     <nmwg:message type="TSQueryRequest" id="msg1" xmlns:nmwg="http://ggf.org/ns/nmwg/base/2.0/" xmlns:xquery="http://ggf.org/ns/nmwg/tools/org/perfsonar/service/lookup/xquery/1.0/">
         <nmwg:metadata id="meta1">
         <nmwg:eventType>http://ggf.org/ns/nmwg/topology/20070809</nmwg:eventType>
@@ -2772,8 +3229,10 @@ def pull_topology(url):
     <nmwg:data metadataIdRef="meta1" id="d1" />
     </nmwg:message>
     """
-    envelope = make_envelope(query)
-    return send_receive(url, envelope)
+    
+def pull_topology(url, timeout=None):
+    envelope = make_envelope(TS_QUERY)
+    return send_receive(url, envelope, timeout)
 
 class Usage(Exception):
     def __init__(self, msg):
@@ -2785,8 +3244,8 @@ def main():
     parser = argparse.ArgumentParser(
         description="Encodes RSpec V3 and the different perfSONAR's topologies to UNIS"
     )
-    parser.add_argument('-t', '--type', required=True, type=str,
-        choices=["rspec3", "ps", "exnode"], help='Input type (rspec3, ps or exnode)')
+    parser.add_argument('-t', '--type', type=str, default=None,
+        choices=sorted(DECODERS.keys()), help='Input type (rspec3, ps or exnode)')
     parser.add_argument('-o', '--output', type=str, default=None,
         help='Output file')
     parser.add_argument('-l', '--log', type=str, default="unisencoder.log",
@@ -2799,11 +3258,48 @@ def main():
         help='The URN of the component manager of the advertisment RSpec.')
     parser.add_argument('--indent', type=int, default=2,
         help='JSON output indent.')
-    parser.add_argument('filename', type=str, help='Input file.')    
+    parser.add_argument('--shared-definitions', action='store_true',
+        help='Write repeated GENI blocks of an RSpec once, under "definitions".')
+    parser.add_argument('--canonical', action='store_true',
+        help='Sort resources by URN, add fingerprints and sort keys, for byte stable output.')
+    parser.add_argument('--compact', action='store_true',
+        help='Hold the output in the compact model of unisencoder.model (rspec3, ps).')
+    parser.add_argument('--index', type=str, default=None,
+        help='Also write a URN/id to JSON pointer index of the output to this file.')
+    parser.add_argument('--registry', type=str, default=None,
+        help='URN registry (SQLite file) to record the output in and resolve references from.')
+    parser.add_argument('--document', type=str, default=None,
+        help='Name the output is recorded under in the registry (default its URN).')
+    parser.add_argument('--stream', action='store_true',
+        help='Encode an exnode incrementally, without building it in memory (no indent).')
+    parser.add_argument('--coalesce', action='store_true',
+        help='Group replicas and merge contiguous extents of an exnode.')
+    parser.add_argument('--extent-index', type=str, default=None,
+        help='Also write the extent index of an exnode to this file.')
+    parser.add_argument('--select-kind', type=str, action='append', default=None,
+        choices=["node", "link"], help='Only encode the top level elements of this kind (rspec3).')
+    parser.add_argument('--select-urn-prefix', type=str, default=None,
+        help='Only encode the nodes and links whose component_id starts with this (rspec3).')
+    parser.add_argument('--select-component-manager', type=str, default=None,
+        help='Only encode the nodes and links of this component manager (rspec3).')
+    parser.add_argument('--select-available', action='store_true',
+        help='Only encode the nodes available now (rspec3).')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+        help='Encode the nodes (rspec3) or domains (ps) of one document with this many processes.')
+    parser.add_argument('--serve-stdio', action='store_true',
+        help='Keep running and encode JSON-lines requests read from stdin.')
+    parser.add_argument('filename', type=str, nargs='?', default=None,
+        help='Input file (default stdin).')
     args = parser.parse_args()
     
     setup_logger(args.log)
     
+    if args.serve_stdio:
+        serve_stdio(sys.stdin, sys.stdout)
+        return
+    if args.type is None:
+        parser.error("argument -t/--type is required")
+    
     if args.filename is None:
         in_file = sys.stdin
         creation_time = calendar.timegm(datetime.datetime.utcnow().timetuple())
@@ -2838,30 +3334,59 @@ def main():
         print >>sys.stderr, err.msg
         return
 
+    encoder = DECODERS[args.type]()
+    if args.stream and args.type == "exnode":
+        out_file = sys.stdout if args.output is None else open(args.output, 'w')
+        for chunk in encoder.iterencode(in_file, creation_time = creation_time,
+                                        modified_time = modified_time):
+            out_file.write(chunk)
+        in_file.close()
+        out_file.close()
+        return
+    
     topology = etree.parse(in_file)
     in_file.close()
     
     if args.type == "rspec3":
-        encoder = RSpec3Decoder()
         kwargs = dict(slice_urn=slice_urn,
                       slice_uuid=slice_uuid,
-                      component_manager_id=args.component_manager_id)
+                      component_manager_id=args.component_manager_id,
+                      shared_definitions=args.shared_definitions,
+                      canonical=args.canonical,
+                      compact=args.compact,
+                      processes=args.processes)
+        if args.select_kind or args.select_urn_prefix or \
+                args.select_component_manager or args.select_available:
+            kwargs["element_filter"] = ElementFilter(kinds=args.select_kind,
+                urn_prefix=args.select_urn_prefix,
+                component_manager=args.select_component_manager,
+                available=True if args.select_available else None)
     elif args.type == "ps":
-        encoder = PSDecoder()
-        kwargs = dict()
+        kwargs = dict(canonical=args.canonical,
+                      compact=args.compact,
+                      processes=args.processes)
     elif args.type == "exnode":
-        encoder = ExnodeDecoder()
         kwargs = dict(creation_time = creation_time,
-                      modified_time = modified_time)
+                      modified_time = modified_time,
+                      coalesce = args.coalesce,
+                      extent_index = args.extent_index is not None)
     
+    if args.registry and args.type != "exnode":
+        kwargs["registry"] = URNRegistry(args.registry)
+        kwargs["document"] = args.document
     topology_out = encoder.encode(topology, **kwargs)
+    if args.index and args.type != "exnode":
+        write_index(topology_out, args.index)
+    if args.type == "exnode" and args.extent_index:
+        encoder.extent_index.save(args.extent_index)
 
     if args.output is None:
         out_file = sys.stdout
     else:
         out_file = open(args.output, 'w')
     
-    json.dump(topology_out, fp=out_file, indent=args.indent)
+    json.dump(topology_out, fp=out_file, indent=args.indent, sort_keys=args.canonical,
+              cls=model.ModelEncoder)
     out_file.close()
     
 if __name__ == '__main__':
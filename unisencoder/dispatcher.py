@@ -4,21 +4,34 @@ import urllib
 import os, sys, getopt
 import settings
 import logging
+import hashlib
 import uuid
 import time
 from lxml import etree
+from netlogger import nllog
 from subprocess import call
 
 
 from decoder import ExnodeDecoder
+from extents import without_lifetimes, renew_lifetimes
+from unisclient import UNISClient, UNISClientException, json_chunks
+from metrics import Metrics
 
-class Dispatcher(object):
+# Fields of an encoded exnode that change without the file content changing
+VOLATILE_EXNODE_FIELDS = ["lifetimes", "created", "modified", "parent", "properties"]
+
+class Dispatcher(object, nllog.DoesLogging):
     def __init__(self, **kwargs):
+        nllog.DoesLogging.__init__(self)
+        self._guid = uuid.uuid1()
+
         if "duration" in kwargs:
             self._duration = kwargs["duration"]
         else:
             self._duration = settings.DEFAULT_EXNODE_DURATION
 
+        self._coalesce = kwargs.get("coalesce", settings.EXNODE_COALESCE)
+
         if "host" in kwargs:
             self._host = kwargs["host"]
         else:
@@ -29,6 +42,12 @@ class Dispatcher(object):
         else:
             self._port = settings.UNIS_PORT
 
+        self.metrics = kwargs.get("metrics", None) or Metrics()
+        self._client = UNISClient(self._host, self._port,
+                                  gzip = kwargs.get("gzip", settings.UNIS_GZIP),
+                                  timeout = kwargs.get("timeout", settings.UNIS_TIMEOUT),
+                                  metrics = self.metrics)
+
     def _parseFile(self):
         in_file = open(self._path, 'r')
         info = os.stat(self._path)
@@ -38,29 +57,149 @@ class Dispatcher(object):
         topology = etree.parse(in_file)
         in_file.close()
         encoder = ExnodeDecoder()
-        kwargs = dict(creation_time = creation_time, modified_time = modified_time, duration = self._duration)
+        kwargs = dict(creation_time = creation_time, modified_time = modified_time,
+                      duration = self._duration, coalesce = self._coalesce)
         
         return encoder.encode(topology, **kwargs)
     
-    def SetDuration(duration):
+    def SetDuration(self, duration):
         self._duration = duration
 
-    def DispatchFile(self, filename, parent, metadata = None):
+    def EncodeFile(self, filename):
         self._path = filename
-        topology_out = self._parseFile()
-        topology_out["parent"] = parent
-        topology_out["properties"] = {}
-        topology_out["properties"]["metadata"] = metadata
-        
-        data = json.dumps(topology_out)
-        request = urllib2.Request("{host}:{port}/exnodes".format(host = self._host, port = self._port), data = data, headers = {'Content-Type': 'application/perfsonar+json'})
+        with self.metrics.timer("encode_seconds"):
+            exnode = self._parseFile()
+        self.metrics.inc("files_encoded")
+        return exnode
+
+    def PrepareExnode(self, filename, parent, metadata = None, exnode = None):
+        """
+        Returns the exnode document for filename ready to be posted.
+        An already encoded exnode can be passed to avoid encoding twice.
+        """
+        if exnode is None:
+            exnode = self.EncodeFile(filename)
+        exnode["parent"] = parent
+        exnode["properties"] = {}
+        exnode["properties"]["metadata"] = metadata
+        return exnode
+
+    def DispatchFile(self, filename, parent, metadata = None, exnode = None):
+        """Uploads filename to UNIS and returns the id UNIS assigned to it."""
+        topology_out = self.PrepareExnode(filename, parent, metadata, exnode)
+        response = self._post("exnodes", lambda: json_chunks(topology_out))
+        if response is None:
+            return None
+        return response.get("id", None)
+
+    def DispatchStream(self, filename, parent, metadata = None):
+        """
+        Encodes filename while uploading it, one mapping at a time, for
+        exnodes too large to build in memory. Returns the UNIS id.
+        """
+        info = os.stat(filename)
+        encoder = ExnodeDecoder()
+        def chunks():
+            with open(filename, 'rb') as in_file:
+                for chunk in encoder.iterencode(in_file,
+                                                creation_time = int(info.st_ctime),
+                                                modified_time = int(info.st_mtime),
+                                                duration = self._duration,
+                                                parent = parent,
+                                                properties = {"metadata": metadata}):
+                    yield chunk
+        with self.metrics.timer("encode_seconds", mode = "stream"):
+            response = self._post("exnodes", chunks)
+        self.metrics.inc("files_encoded")
+        if response is None:
+            return None
+        return response.get("id", None)
+
+    def PostExnode(self, data):
+        """Posts one JSON encoded exnode and returns its UNIS id."""
+        response = self._post("exnodes", lambda: [data])
+        if response is None:
+            return None
+        return response.get("id", None)
+
+    def DispatchBatch(self, documents):
+        """
+        Uploads a list of JSON encoded exnodes with a single POST. Returns
+        the list of ids in the same order, None for the exnodes UNIS did not
+        create, or None if the whole batch was rejected.
+        """
+        response = self._post("exnodes", lambda: self._join_documents(documents))
+        if response is None:
+            return None
+        if not isinstance(response, list):
+            response = [response]
         
+        ids = []
+        for index in range(len(documents)):
+            if index < len(response) and isinstance(response[index], dict):
+                ids.append(response[index].get("id", None))
+            else:
+                ids.append(None)
+        return ids
+
+    def _join_documents(self, documents):
+        yield "["
+        for index, data in enumerate(documents):
+            if index > 0:
+                yield ","
+            yield data
+        yield "]"
+
+    def _post(self, path, chunks):
+        """Streams chunks to UNIS, returns the decoded response or None."""
+        try:
+            return self._client.send("POST", path, chunks)
+        except UNISClientException as e:
+            self.log.error("Failed to connect to UNIS", value = e.status or e.args, guid = self._guid)
+            return None
+
+    def _update_exnode(self, exnode_id, update):
+        """
+        Reads an exnode back from UNIS, calls update on it and PUTs it
+        whole: UNIS replaces a resource on PUT, it does not merge a partial
+        document into it. Returns False if UNIS has no such exnode.
+        """
+        path = "exnodes/{id}".format(id = exnode_id)
+        exnode = self._client.get(path)
+        if not exnode:
+            return False
+        update(exnode)
+        self._client.put(path, exnode)
+        return True
+
+    def UpdateModified(self, exnode_id, modified_time):
+        """
+        Updates the modified time of an exnode already in UNIS.
+        Used when a file was touched but its content did not change.
+        """
+        def touch(exnode):
+            exnode["modified"] = modified_time
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError, e:
-            self.log.error("Failed to connect to UNIS", value = e.code, guid = self._guid)
-        except urllib2.URLError as e:
-            self.log.error("Failed to connect to UNIS", value = e.args, guid = self._guid)
+            return self._update_exnode(exnode_id, touch)
+        except UNISClientException as e:
+            self.log.error("Failed to update UNIS", value = e.status or e.args, guid = self._guid)
+            return False
+
+    def RenewLifetimes(self, exnode_id, duration = None):
+        """
+        Renews the extent lifetimes of an exnode already in UNIS, reading
+        it back and PUTting it with new lifetimes. Returns True on success.
+        """
+        if duration is None:
+            duration = self._duration
+        try:
+            if not self._update_exnode(exnode_id, lambda exnode: renew_lifetimes(exnode, duration)):
+                return False
+        except UNISClientException as e:
+            self.log.error("Failed to renew lifetimes", id = exnode_id, value = e.status or e.args, guid = self._guid)
+            return False
+        self.metrics.inc("exnodes_renewed")
+        return True
 
     def CreateRemoteDirectory(self, name, parent):
         data = {}
@@ -70,26 +209,71 @@ class Dispatcher(object):
         data["size"]     = 0
         data["parent"]   = parent
         data["mode"]     = "directory"
-        data = json.dumps(data)
-        print "Sending: {0}".format(data)
-        request = urllib2.Request("{host}:{port}/exnodes".format(host = self._host, port = self._port), data = data, headers = {'Content-Type': 'application/perfsonar+json'})
-        response = ""
+        self.log.debug("CreateRemoteDirectory", name = name, parent = parent, guid = self._guid)
         
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError, e:
-            print "Failed to contact UNIS - {err}".format(err = e)
-        except urllib2.URLError as e:
-            print "Error in URL - {err}".format(err = e)
-            
-        response =  response.read()
-        print response
-        response = json.loads(response)
+        response = self._post("exnodes", lambda: json_chunks(data))
+        if response is None:
+            return None
         return response["id"]
         
 
 
 
+class ExnodeBatcher(object):
+    """
+    Groups exnodes into array POSTs to UNIS. A batch is sent once it holds
+    settings.EXNODE_BATCH_SIZE exnodes, settings.EXNODE_BATCH_BYTES encoded
+    bytes, or its oldest exnode has waited settings.EXNODE_BATCH_LATENCY
+    seconds. callback(key, exnode_id) is called for every exnode UNIS
+    created, exnodes a batch rejects are retried with single posts.
+    """
+    def __init__(self, dispatch, callback, **kwargs):
+        self._dispatch = dispatch
+        self._callback = callback
+        self._metrics = dispatch.metrics
+        self._max_size = kwargs.get("max_size", settings.EXNODE_BATCH_SIZE)
+        self._max_bytes = kwargs.get("max_bytes", settings.EXNODE_BATCH_BYTES)
+        self._max_latency = kwargs.get("max_latency", settings.EXNODE_BATCH_LATENCY)
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, exnode):
+        if not self._pending:
+            self._oldest = time.time()
+        data = json.dumps(exnode)
+        self._pending.append((key, data))
+        self._pending_bytes += len(data)
+        self._metrics.set("queue_depth", len(self._pending), stage = "upload")
+        
+        if len(self._pending) >= self._max_size or \
+           self._pending_bytes >= self._max_bytes or \
+           time.time() - self._oldest >= self._max_latency:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None
+        self._metrics.set("queue_depth", 0, stage = "upload")
+        
+        ids = self._dispatch.DispatchBatch([data for key, data in batch])
+        if ids is None:
+            ids = [None] * len(batch)
+        
+        for (key, data), exnode_id in zip(batch, ids):
+            if exnode_id is None:
+                exnode_id = self._dispatch.PostExnode(data)
+            if exnode_id is not None:
+                self._callback(key, exnode_id)
+
+
 #  Temporary function that creates a list of upload candidates
 def create_file_list():
     tmpResult = []
@@ -106,48 +290,165 @@ def create_file_list():
 
 
 def create_directories(dispatch, filename, root):
+    """
+    Creates the directories of filename under root in UNIS and returns the
+    id of the innermost one. Returns None if root or any directory could
+    not be created: the file has no parent to be uploaded under.
+    """
     directories = filename.split("/")
     ids = []
     ids.append(root)
     
     for index in range(0, len(directories) - 1):
+        if ids[index] is None:
+            return None
         ids.append(dispatch.CreateRemoteDirectory(directories[index], ids[index]))
 
     return ids[len(ids) - 1]
 
-def build_dispatch_list(file_list):
-    entries = []
-    tmpResult = []
-    
+def hash_file(filename, block_size = 65536):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as in_file:
+        block = in_file.read(block_size)
+        while block:
+            digest.update(block)
+            block = in_file.read(block_size)
+    return digest.hexdigest()
+
+def hash_exnode(exnode):
+    """Hashes an encoded exnode ignoring the fields that change on every encode."""
+    stable = dict((key, value) for key, value in exnode.iteritems() if key not in VOLATILE_EXNODE_FIELDS)
+    stable["extents"] = [without_lifetimes(extent) for extent in exnode.get("extents", [])]
+    return hashlib.sha1(json.dumps(stable, sort_keys = True)).hexdigest()
+
+def read_dispatch_log():
+    """
+    Reads the dispatch log into a dict keyed by filename. Each line is
+    filename, modified time, content hash, encoded hash and UNIS id separated
+    by tabs; old logs only have the first two columns.
+    """
+    entries = {}
     if not os.path.exists(settings.DISPATCH_LOG_PATH):
-        with open(settings.DISPATCH_LOG_PATH, 'w') as dispatch_log:
-            pass
+        return entries
 
-    with open(settings.DISPATCH_LOG_PATH, 'r+') as dispatch_log:
+    with open(settings.DISPATCH_LOG_PATH, 'r') as dispatch_log:
         for line in dispatch_log:
-            entries.append(line.split('\t'))
-    
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                continue
+            fields += [""] * (5 - len(fields))
+            entries[fields[0]] = {
+                "modified": int(fields[1]),
+                "content_hash": fields[2],
+                "encoded_hash": fields[3],
+                "id": fields[4],
+            }
+    return entries
+
+def write_dispatch_log(entries):
     with open(settings.DISPATCH_LOG_PATH, 'w') as dispatch_log:
-        for filename in file_list:
-            info = os.stat(filename)
-            modified_time = int(info.st_mtime)
-            tmpDoUpload = True
-            
-            for entry in entries:
-                if filename == entry[0]:
-                    if int(modified_time) > int(entry[1]):
-                        tmpDoUpload = True
-                    else:
-                        tmpDoUpload = False
-                    break
-                
-            if tmpDoUpload:
-                tmpResult.append(filename)
-            else:
-                dispatch_log.write("%s\t%s\n" % (filename, modified_time))
+        for filename in sorted(entries.keys()):
+            entry = entries[filename]
+            dispatch_log.write("%s\t%s\t%s\t%s\t%s\n" % (filename, entry["modified"], entry["content_hash"], entry["encoded_hash"], entry["id"] or ""))
+
+def build_dispatch_list(file_list, entries, metrics = None):
+    """Returns the files modified since they were last dispatched."""
+    tmpResult = []
+    if metrics is None:
+        metrics = Metrics()
+    
+    for filename in file_list:
+        info = os.stat(filename)
+        modified_time = int(info.st_mtime)
+        entry = entries.get(filename, None)
+        metrics.inc("files_scanned")
+        
+        if entry is None or modified_time > entry["modified"]:
+            tmpResult.append(filename)
+        else:
+            metrics.inc("files_skipped", reason = "mtime")
             
     return tmpResult
 
+def dispatch_files(dispatch, dispatch_list, entries, root_id, do_expand = False):
+    """
+    Uploads every file in dispatch_list and records it in entries. Files
+    whose content, or whose encoded exnode, did not change since the last
+    upload only get their modified time updated in UNIS. Files of at least
+    settings.EXNODE_STREAM_THRESHOLD bytes are encoded while they upload.
+    Files whose directories could not be created are left out of entries
+    so the next run retries them.
+    """
+    metrics = dispatch.metrics
+    pending = {}
+    def uploaded(filename, exnode_id):
+        entry = pending.pop(filename)
+        entry["id"] = exnode_id
+        entries[filename] = entry
+        metrics.inc("files_uploaded")
+    batcher = ExnodeBatcher(dispatch, uploaded)
+    
+    for index, filename in enumerate(dispatch_list):
+        metrics.set("queue_depth", len(dispatch_list) - index, stage = "encode")
+        modified_time = int(os.stat(filename).st_mtime)
+        content_hash = hash_file(filename)
+        entry = entries.get(filename, None)
+        
+        if entry and entry["id"] and entry["content_hash"] == content_hash:
+            metrics.inc("files_skipped", reason = "content")
+            if dispatch.UpdateModified(entry["id"], modified_time):
+                entry["modified"] = modified_time
+            continue
+        
+        metadata = {}
+        expanded_dir = os.path.relpath(filename, settings.XND_FILE_PATH)
+        if do_expand:
+            dispatch.log.debug("expand_filename", filename = filename, guid = dispatch._guid)
+            expanded_dir = parse_filename(expanded_dir)
+            metadata = build_metadata(expanded_dir)
+
+        if not dispatch._coalesce and os.path.getsize(filename) >= settings.EXNODE_STREAM_THRESHOLD:
+            # Never built in memory, so there is no encoded hash to compare
+            parent = create_directories(dispatch, expanded_dir, root_id)
+            if parent is None:
+                metrics.inc("files_failed", reason = "directory")
+                continue
+            exnode_id = dispatch.DispatchStream(filename, parent, metadata)
+            if exnode_id is not None:
+                entries[filename] = {
+                    "modified": modified_time,
+                    "content_hash": content_hash,
+                    "encoded_hash": "",
+                    "id": exnode_id,
+                }
+                metrics.inc("files_uploaded")
+            continue
+
+        exnode = dispatch.EncodeFile(filename)
+        encoded_hash = hash_exnode(exnode)
+        if entry and entry["id"] and entry["encoded_hash"] == encoded_hash:
+            metrics.inc("files_skipped", reason = "encoded")
+            if dispatch.UpdateModified(entry["id"], modified_time):
+                entry["modified"] = modified_time
+                entry["content_hash"] = content_hash
+            continue
+        
+        parent = create_directories(dispatch, expanded_dir, root_id)
+        if parent is None:
+            # Not journaled, so the next sweep retries it
+            metrics.inc("files_failed", reason = "directory")
+            continue
+        pending[filename] = {
+            "modified": modified_time,
+            "content_hash": content_hash,
+            "encoded_hash": encoded_hash,
+            "id": None,
+        }
+        batcher.add(filename, dispatch.PrepareExnode(filename, parent, metadata, exnode = exnode))
+    
+    metrics.set("queue_depth", 0, stage = "encode")
+    batcher.flush()
+
 def parse_filename(filename):
     sensor = filename[:3]
     path   = filename[3:6]
@@ -166,31 +467,71 @@ def build_metadata(filepath):
     
     return metadata
 
+def renew_dispatched(dispatch, entries, duration = None):
+    """
+    Renews the lifetimes of every exnode the dispatch log has a UNIS id
+    for. No file is read or encoded. Returns the filenames that failed.
+    """
+    failed = []
+    for filename, entry in sorted(entries.iteritems()):
+        if not entry.get("id", None):
+            continue
+        if not dispatch.RenewLifetimes(entry["id"], duration):
+            failed.append(filename)
+    return failed
+
 def main(argv):
     do_expand = False
+    do_gzip = settings.UNIS_GZIP
+    metrics_port = settings.METRICS_PORT
+    metrics_file = settings.METRICS_SNAPSHOT_PATH
+    do_renew = False
+    duration = settings.DEFAULT_EXNODE_DURATION
 
     try:
-        opts, args = getopt.getopt(argv, "x", ["--expand-folders"])
+        opts, args = getopt.getopt(argv, "xz", ["expand-folders", "gzip", "metrics-port=", "metrics-file=",
+                                                "renew", "duration="])
         for opt, arg in opts:
             if opt in ('-x', "--expand-folders"):
                 do_expand = True
+            elif opt in ('-z', "--gzip"):
+                do_gzip = True
+            elif opt == "--metrics-port":
+                metrics_port = int(arg)
+            elif opt == "--metrics-file":
+                metrics_file = arg
+            elif opt == "--renew":
+                do_renew = True
+            elif opt == "--duration":
+                duration = float(arg)
     except:
         pass
     
-    dispatch_list = build_dispatch_list(create_file_list())
-    dispatch = Dispatcher()
+    metrics = Metrics()
+    if metrics_port:
+        metrics.serve(metrics_port)
+    if metrics_file:
+        metrics.start_snapshots(metrics_file, settings.METRICS_SNAPSHOT_INTERVAL)
+    
+    entries = read_dispatch_log()
+    dispatch = Dispatcher(gzip = do_gzip, metrics = metrics, duration = duration)
+    
+    if do_renew:
+        failed = renew_dispatched(dispatch, entries, duration)
+        if failed:
+            dispatch.log.error("renew.failed", count = len(failed), guid = dispatch._guid)
+        if metrics_file:
+            metrics.write_snapshot(metrics_file)
+        return
     
+    dispatch_list = build_dispatch_list(create_file_list(), entries, metrics)
     root_id = dispatch.CreateRemoteDirectory(settings.ROOT_NAME, None)
-    for filename in dispatch_list:
-        metadata = {}
-        expanded_dir = os.path.relpath(filename, settings.XND_FILE_PATH)
-        if do_expand:
-            print "Expanding filename"
-            expanded_dir = parse_filename(expanded_dir)
-            metadata = build_metadata(expanded_dir)
-
-        parent = create_directories(dispatch, expanded_dir, root_id)
-        dispatch.DispatchFile(filename, parent, metadata)
+    try:
+        dispatch_files(dispatch, dispatch_list, entries, root_id, do_expand)
+    finally:
+        write_dispatch_log(entries)
+        if metrics_file:
+            metrics.write_snapshot(metrics_file)
         
 if __name__ == "__main__":
     main(sys.argv[1:])
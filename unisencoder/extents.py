@@ -0,0 +1,313 @@
+'''
+Compact index of the extents of an encoded exnode.
+
+The extents are grouped by their (offset, size) range, every group
+holding the positions in exnode["extents"] of its replicas. Ranges are
+kept in sorted arrays together with the running maximum of their ends,
+so the groups covering a byte range are found with two binary searches
+instead of a scan of the extents.
+
+    index = ExtentIndex.from_extents(exnode["extents"])
+    for offset, size, positions in index.covering(0, 1024 * 1024):
+        replicas = [exnode["extents"][i] for i in positions]
+
+An index can be saved next to the exnode as a sidecar file and loaded
+without decoding the exnode again.
+
+coalesce_extents rewrites the extents of an exnode in a compact form: the
+contiguous mappings a depot holds are merged into one replica and the
+replicas of the same byte range are grouped in one descriptor, which
+carries the $schema, location and lifetimes its mappings share:
+
+    {"offset": 0, "size": 4194304, "$schema": ..., "location": "ibp://",
+     "lifetimes": [...],
+     "replicas": [{"depot": "depot0.example.org:6714",
+                   "mappings": [{"size": 1048576, "read": ..., "write": ...,
+                                 "manage": ...}, ...]}]}
+
+The mappings of a replica follow each other from the descriptor offset.
+expand_extents turns the compact form back into one extent per mapping.
+
+renew_lifetimes and renew_files restamp the lifetimes of exnodes that are
+already encoded, in either form, without going back to the XML.
+'''
+
+import array
+import bisect
+import datetime
+import json
+import os
+import sys
+import urlparse
+import settings
+
+
+SIDECAR_VERSION = 1
+# Extent fields moved to the descriptor when every mapping has the same value
+SHARED_EXTENT_FIELDS = ["$schema", "location", "lifetimes"]
+LIFETIME_FORMAT = "%Y-%m-%d %H:%M:%S%z"
+
+
+class ExtentIndex(object):
+    """Sorted offset/length arrays of an exnode's extents, replicas grouped."""
+
+    def __init__(self, offsets=None, lengths=None, starts=None, positions=None):
+        self.offsets = offsets if offsets is not None else array.array('l')
+        self.lengths = lengths if lengths is not None else array.array('l')
+        # Group i owns positions[starts[i]:starts[i + 1]]
+        self.starts = starts if starts is not None else array.array('l', [0])
+        self.positions = positions if positions is not None else array.array('l')
+        self._build_ends()
+
+    @classmethod
+    def from_extents(cls, extents):
+        """Builds the index of a list of extents with offset and size."""
+        groups = {}
+        for position, extent in enumerate(extents):
+            key = (int(extent["offset"]), int(extent["size"]))
+            groups.setdefault(key, []).append(position)
+
+        offsets = array.array('l')
+        lengths = array.array('l')
+        starts = array.array('l', [0])
+        positions = array.array('l')
+        for (offset, size) in sorted(groups.keys()):
+            offsets.append(offset)
+            lengths.append(size)
+            positions.extend(groups[(offset, size)])
+            starts.append(len(positions))
+        return cls(offsets, lengths, starts, positions)
+
+    def _build_ends(self):
+        self._max_ends = array.array('l')
+        running = 0
+        for offset, size in zip(self.offsets, self.lengths):
+            running = max(running, offset + size)
+            self._max_ends.append(running)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def size(self):
+        """Bytes up to the end of the last extent."""
+        if not self._max_ends:
+            return 0
+        return self._max_ends[-1]
+
+    def replicas(self, group):
+        return list(self.positions[self.starts[group]:self.starts[group + 1]])
+
+    def covering(self, start, end):
+        """
+        Returns (offset, size, positions) for every range overlapping the
+        bytes [start, end), ordered by offset.
+        """
+        if end <= start:
+            return []
+        # Ranges starting before end, then the first whose end (or that of
+        # a range before it) reaches past start
+        high = bisect.bisect_left(self.offsets, end)
+        low = bisect.bisect_right(self._max_ends, start, 0, high)
+        out = []
+        for group in xrange(low, high):
+            offset = self.offsets[group]
+            size = self.lengths[group]
+            if offset + size > start:
+                out.append((offset, size, self.replicas(group)))
+        return out
+
+    def gaps(self):
+        """Returns the (start, end) byte ranges not covered by any extent."""
+        out = []
+        position = 0
+        for offset, size in zip(self.offsets, self.lengths):
+            if offset > position:
+                out.append((position, offset))
+            position = max(position, offset + size)
+        return out
+
+    def save(self, filename):
+        """Writes the index as a sidecar: a JSON header line and the arrays."""
+        header = {
+            "version": SIDECAR_VERSION,
+            "groups": len(self.offsets),
+            "extents": len(self.positions),
+            "itemsize": self.offsets.itemsize,
+            "byteorder": sys.byteorder,
+        }
+        with open(filename, 'wb') as out_file:
+            out_file.write(json.dumps(header) + "\n")
+            for values in (self.offsets, self.lengths, self.starts, self.positions):
+                values.tofile(out_file)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as in_file:
+            header = json.loads(in_file.readline())
+            if header.get("version", None) != SIDECAR_VERSION:
+                raise ValueError("Unsupported extent index version in '%s'" % filename)
+            if header["itemsize"] != array.array('l').itemsize:
+                raise ValueError("Extent index '%s' was written with %d byte integers" % \
+                    (filename, header["itemsize"]))
+            counts = [header["groups"], header["groups"], header["groups"] + 1, header["extents"]]
+            arrays = []
+            for count in counts:
+                values = array.array('l')
+                values.fromfile(in_file, count)
+                if header["byteorder"] != sys.byteorder:
+                    values.byteswap()
+                arrays.append(values)
+        return cls(*arrays)
+
+
+def depot(extent):
+    """Returns the host:port of the depot holding an extent."""
+    caps = extent.get("mapping", {})
+    for cap in ("read", "write", "manage"):
+        if caps.get(cap, None):
+            return urlparse.urlsplit(caps[cap]).netloc
+    return None
+
+
+def is_coalesced(extent):
+    return "replicas" in extent
+
+
+def coalesce_extents(extents):
+    """
+    Returns the compact form of a list of encoded extents. An extent that
+    no other extent continues or replicates is left plain, it is shorter
+    than its replicas descriptor.
+    """
+    plain = dict(((extent["offset"], extent["size"]), extent) for extent in extents)
+    by_depot = {}
+    for extent in extents:
+        by_depot.setdefault(depot(extent), []).append(extent)
+
+    # Runs of contiguous extents on one depot become one replica
+    ranges = {}
+    for name, members in sorted(by_depot.items()):
+        members.sort(key=lambda extent: extent["offset"])
+        run = []
+        for extent in members:
+            if run and extent["offset"] != run[-1]["offset"] + run[-1]["size"]:
+                _add_replica(ranges, name, run)
+                run = []
+            run.append(extent)
+        if run:
+            _add_replica(ranges, name, run)
+
+    out = []
+    for (offset, size) in sorted(ranges.keys()):
+        replicas = ranges[(offset, size)]
+        if len(replicas) == 1 and len(replicas[0]["mappings"]) == 1:
+            out.append(plain[(offset, size)])
+            continue
+        descriptor = {"offset": offset, "size": size}
+        mappings = [mapping for replica in replicas for mapping in replica["mappings"]]
+        for field in SHARED_EXTENT_FIELDS:
+            values = [mapping.get(field, None) for mapping in mappings]
+            if values[0] is not None and all(value == values[0] for value in values):
+                descriptor[field] = values[0]
+                for mapping in mappings:
+                    del mapping[field]
+        descriptor["replicas"] = replicas
+        out.append(descriptor)
+    return out
+
+
+def _add_replica(ranges, name, run):
+    offset = run[0]["offset"]
+    size = run[-1]["offset"] + run[-1]["size"] - offset
+    mappings = []
+    for extent in run:
+        mapping = dict((key, value) for key, value in extent.iteritems()
+                       if key not in ("offset", "mapping"))
+        mapping.update(extent.get("mapping", {}))
+        mappings.append(mapping)
+    ranges.setdefault((offset, size), []).append({"depot": name, "mappings": mappings})
+
+
+def expand_extents(extents):
+    """Returns one extent per mapping, the inverse of coalesce_extents."""
+    out = []
+    for descriptor in extents:
+        if not is_coalesced(descriptor):
+            out.append(descriptor)
+            continue
+        for replica in descriptor["replicas"]:
+            offset = descriptor["offset"]
+            for mapping in replica["mappings"]:
+                extent = {}
+                for field in SHARED_EXTENT_FIELDS:
+                    if field in descriptor:
+                        extent[field] = descriptor[field]
+                caps = {}
+                for key, value in mapping.iteritems():
+                    if key in ("read", "write", "manage"):
+                        caps[key] = value
+                    else:
+                        extent[key] = value
+                extent["mapping"] = caps
+                extent["offset"] = offset
+                offset += mapping["size"]
+                out.append(extent)
+    out.sort(key=lambda extent: extent["offset"])
+    return out
+
+
+def without_lifetimes(extent):
+    """Returns a copy of an extent, plain or coalesced, without lifetimes."""
+    out = dict((key, value) for key, value in extent.iteritems() if key != "lifetimes")
+    if is_coalesced(extent):
+        out["replicas"] = [dict(replica, mappings=[without_lifetimes(mapping) for mapping in replica["mappings"]])
+                           for replica in extent["replicas"]]
+    return out
+
+
+def make_lifetimes(duration=None, start=None):
+    """Returns the lifetimes of an extent valid for duration hours from start."""
+    if duration is None:
+        duration = settings.DEFAULT_EXNODE_DURATION
+    if start is None:
+        start = datetime.datetime.utcnow()
+    end = start + datetime.timedelta(hours = duration)
+    return [{"start": start.strftime(LIFETIME_FORMAT), "end": end.strftime(LIFETIME_FORMAT)}]
+
+
+def renew_lifetimes(exnode, duration=None, start=None):
+    """
+    Replaces the lifetimes of every extent of an encoded exnode, plain or
+    coalesced, and returns the exnode.
+    """
+    lifetimes = make_lifetimes(duration, start)
+    for extent in exnode.get("extents", []):
+        if is_coalesced(extent):
+            for replica in extent["replicas"]:
+                for mapping in replica["mappings"]:
+                    mapping.pop("lifetimes", None)
+        extent["lifetimes"] = [dict(lifetime) for lifetime in lifetimes]
+    return exnode
+
+
+def renew_files(filenames, duration=None, start=None):
+    """
+    Renews the lifetimes of exnodes saved as JSON files, rewriting each
+    file in place. Returns the list of files that could not be renewed.
+    """
+    if start is None:
+        start = datetime.datetime.utcnow()
+    failed = []
+    for filename in filenames:
+        try:
+            with open(filename, 'r') as in_file:
+                exnode = json.load(in_file)
+            renew_lifetimes(exnode, duration, start)
+            tmp_filename = filename + ".tmp"
+            with open(tmp_filename, 'w') as out_file:
+                json.dump(exnode, out_file)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError, ValueError):
+            failed.append(filename)
+    return failed
@@ -0,0 +1,261 @@
+'''
+In-process stand-in for a UNIS instance.
+
+Implements enough of the /exnodes collection for the dispatcher: creating
+files and directories (single documents or arrays), reading them back and
+replacing them with PUT. Latency, errors and dropped connections can be
+injected to exercise the dispatcher without a live UNIS.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+
+class FakeUNISServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Connections cut by stop() are expected to fail mid request
+        if not self.unis.stopping:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeUNISHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer each reply so its status line, headers and body leave in one
+    # write instead of waiting out the client's delayed ACK
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Large replies are flushed in several writes, the last of which
+        # Nagle would hold back until the client ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.unis.opened(self.connection)
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.server.unis.closed(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        unis = self.server.unis
+        if not unis.begin_request(self):
+            return
+        collection, resource_id = self._split_path()
+        if collection != "exnodes":
+            return self._reply(404, {"error": "unknown collection"})
+        if resource_id is None:
+            return self._reply(200, unis.list_exnodes())
+        exnode = unis.get_exnode(resource_id)
+        if exnode is None:
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, exnode)
+
+    def do_POST(self):
+        unis = self.server.unis
+        body = self._read_body()
+        if not unis.begin_request(self):
+            return
+        collection, resource_id = self._split_path()
+        if collection != "exnodes" or resource_id is not None:
+            return self._reply(404, {"error": "unknown collection"})
+        try:
+            doc = json.loads(body)
+        except ValueError:
+            return self._reply(400, {"error": "not valid json"})
+        if isinstance(doc, list):
+            self._reply(201, [unis.create_exnode(item) for item in doc])
+        else:
+            self._reply(201, unis.create_exnode(doc))
+
+    def do_PUT(self):
+        unis = self.server.unis
+        body = self._read_body()
+        if not unis.begin_request(self):
+            return
+        collection, resource_id = self._split_path()
+        if collection != "exnodes" or resource_id is None:
+            return self._reply(404, {"error": "unknown collection"})
+        try:
+            doc = json.loads(body)
+        except ValueError:
+            return self._reply(400, {"error": "not valid json"})
+        exnode = unis.update_exnode(resource_id, doc)
+        if exnode is None:
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, exnode)
+
+    def _split_path(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if not parts:
+            return None, None
+        if len(parts) == 1:
+            return parts[0], None
+        return parts[0], parts[1]
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = "".join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.unis.received(len(body))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _reply(self, status, doc):
+        body = json.dumps(doc)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/perfsonar+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeUNIS(object):
+    """
+    A UNIS stand-in served from a background thread.
+
+    latency is the number of seconds every request is delayed, error_rate
+    the probability a request is answered with a 500 instead. Setting drop
+    to n closes the connection of the next n requests without an answer,
+    after reading them.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.request_count = 0
+        self.error_count = 0
+        self.bytes_received = 0
+        self.drop = 0
+        self._exnodes = {}
+        self.stopping = False
+        self._lock = threading.Lock()
+        # Open client connections, stop() closes them so no handler thread
+        # is left blocked on a kept alive connection
+        self._connections = set()
+        self._closed = threading.Condition(self._lock)
+        self._server = FakeUNISServer((host, port), FakeUNISHandler)
+        self._server.unis = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return "http://%s" % self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self.stopping = True
+        self._server.shutdown()
+        deadline = time.time() + timeout
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            while self._connections and time.time() < deadline:
+                self._closed.wait(deadline - time.time())
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def opened(self, conn):
+        with self._lock:
+            self._connections.add(conn)
+
+    def closed(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+            self._closed.notify_all()
+
+    def received(self, size):
+        with self._lock:
+            self.bytes_received += size
+
+    def begin_request(self, handler):
+        """Counts the request and applies the injected latency, errors and
+        drops. Returns False if the request was answered with an error or
+        is dropped."""
+        with self._lock:
+            self.request_count += 1
+            drop = self.drop > 0
+            if drop:
+                self.drop -= 1
+        if drop:
+            handler.close_connection = 1
+            return False
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.error_count += 1
+            handler._reply(500, {"error": "injected error"})
+            return False
+        return True
+
+    def create_exnode(self, doc):
+        doc = dict(doc)
+        doc["id"] = str(uuid.uuid4())
+        doc["selfRef"] = "%s:%s/exnodes/%s" % (self.host, self.port, doc["id"])
+        with self._lock:
+            self._exnodes[doc["id"]] = doc
+        return doc
+
+    def update_exnode(self, exnode_id, doc):
+        with self._lock:
+            exnode = self._exnodes.get(exnode_id, None)
+            if exnode is None:
+                return None
+            # Like UNIS, a PUT replaces the whole resource
+            doc = dict(doc)
+            doc["id"] = exnode_id
+            doc["selfRef"] = exnode["selfRef"]
+            self._exnodes[exnode_id] = doc
+            return doc
+
+    def get_exnode(self, exnode_id):
+        with self._lock:
+            return self._exnodes.get(exnode_id, None)
+
+    def list_exnodes(self):
+        with self._lock:
+            return self._exnodes.values()
+
+    def files(self):
+        return [exnode for exnode in self.list_exnodes() if exnode.get("mode") == "file"]
+
+    def directories(self):
+        return [exnode for exnode in self.list_exnodes() if exnode.get("mode") == "directory"]
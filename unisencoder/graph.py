@@ -0,0 +1,239 @@
+'''
+Graph view of an encoded topology for path computation.
+
+TopologyGraph indexes the output of RSpec3Decoder or PSDecoder once:
+nodes, their ports and the links between them, with link capacities and
+the trafficEngineeringMetric of the perfSONAR control plane. Nodes, ports
+and links are named by their JSON pointer in the output; queries also
+accept URNs.
+
+    graph = TopologyGraph(PSDecoder().encode(tree))
+    graph.neighbors("urn:ogf:network:domain=example.net:node=rtr1")
+    cost, nodes, links = graph.shortest_path(source, destination, min_capacity=10 ** 9)
+'''
+
+import collections
+import heapq
+
+import model
+from output import hrefs, is_mapping, is_resource, escape_pointer
+
+
+# Link cost when no trafficEngineeringMetric was given
+DEFAULT_METRIC = 1
+
+
+class TopologyGraph(object):
+    """Node, port and link adjacency of an encoded topology."""
+
+    def __init__(self, out):
+        self.out = out
+        self.nodes = {}
+        self.ports = {}
+        self.links = {}
+        self.urns = {}
+        self.port_node = {}
+        # Links inside a port (perfSONAR) start at that port
+        self._link_port = {}
+        self.node_ports = collections.defaultdict(list)
+        self.port_links = collections.defaultdict(list)
+        # node -> list of (neighbor, link, capacity, metric)
+        self.adjacency = collections.defaultdict(list)
+        self._walk(out, "#", None, None)
+        for port, node in self.port_node.iteritems():
+            self.node_ports[node].append(port)
+        for link in sorted(self.links):
+            self._add_link(link)
+
+    def _walk(self, obj, pointer, node, port):
+        if isinstance(obj, list):
+            for position, value in enumerate(obj):
+                if isinstance(value, list) or is_mapping(value):
+                    self._walk(value, "%s/%d" % (pointer, position), node, port)
+            return
+
+        if is_resource(obj):
+            cls = model.resource_class(obj["$schema"])
+            if obj.get("urn", None):
+                self.urns[obj["urn"]] = pointer
+            if cls is model.Node:
+                self.nodes[pointer] = obj
+                node, port = pointer, None
+                for href in hrefs(obj.get("ports", None)):
+                    self.port_node[href] = pointer
+            elif cls is model.Port:
+                self.ports[pointer] = obj
+                if node is not None:
+                    self.port_node[pointer] = node
+                port = pointer
+            elif cls is model.Link:
+                self.links[pointer] = obj
+                if port is not None:
+                    self._link_port[pointer] = port
+            elif cls is model.Domain:
+                node, port = None, None
+
+        for key, value in obj.iteritems():
+            if isinstance(value, list) or is_mapping(value):
+                self._walk(value, pointer + "/" + escape_pointer(key), node, port)
+
+    def _end_port(self, href):
+        """An endpoint is a port, or a remote link standing for its port."""
+        if href in self.links:
+            return self._link_port.get(href, None)
+        return href
+
+    def _add_link(self, link):
+        resource = self.links[link]
+        endpoints = resource.get("endpoints", None)
+        ends = list(hrefs(endpoints))
+        if link in self._link_port and self._link_port[link] not in ends:
+            ends.insert(0, self._link_port[link])
+        ends = [self._end_port(href) for href in ends]
+        ends = [port for port in ends if port is not None]
+        for port in ends:
+            if link not in self.port_links[port]:
+                self.port_links[port].append(link)
+        if len(ends) < 2:
+            return
+
+        source, sink = ends[0], ends[1]
+        directed = resource.get("directed", False) or \
+            (is_mapping(endpoints) and "source" in endpoints)
+        capacity = self.capacity(link)
+        metric = self.metric(link)
+        source_node = self.port_node.get(source, None)
+        sink_node = self.port_node.get(sink, None)
+        if source_node is None or sink_node is None or source_node == sink_node:
+            return
+        self.adjacency[source_node].append((sink_node, link, capacity, metric))
+        if not directed:
+            self.adjacency[sink_node].append((source_node, link, capacity, metric))
+
+    def resolve(self, name):
+        """Returns the pointer of a pointer or URN."""
+        if name.startswith("#"):
+            return name
+        if name not in self.urns:
+            raise KeyError(name)
+        return self.urns[name]
+
+    def capacity(self, name):
+        """
+        Capacity of a link or port. A link without its own capacity gets
+        the smallest capacity of its ports. None if unknown.
+        """
+        pointer = self.resolve(name)
+        resource = self.links.get(pointer, None) or self.ports.get(pointer, None)
+        if resource is None:
+            raise KeyError(name)
+        if resource.get("capacity", None) is not None:
+            return resource["capacity"]
+        if pointer in self.links:
+            capacities = [self.ports[port].get("capacity", None)
+                          for port in self._link_ports(pointer) if port in self.ports]
+            capacities = [capacity for capacity in capacities if capacity is not None]
+            if capacities:
+                return min(capacities)
+        return None
+
+    def metric(self, name):
+        """trafficEngineeringMetric of a link, DEFAULT_METRIC if it has none."""
+        resource = self.links[self.resolve(name)]
+        properties = resource.get("properties", None) or {}
+        ctrl = properties.get("ctrlPlane", None) or {}
+        metric = ctrl.get("trafficEngineeringMetric", None)
+        if metric is None:
+            return DEFAULT_METRIC
+        return metric
+
+    def _link_ports(self, link):
+        ports = [self._end_port(href) for href in hrefs(self.links[link].get("endpoints", None))]
+        if link in self._link_port:
+            ports.append(self._link_port[link])
+        return [port for port in ports if port is not None]
+
+    def neighbors(self, node):
+        """Returns the nodes one link away from node."""
+        seen = []
+        for neighbor, link, capacity, metric in self.adjacency.get(self.resolve(node), []):
+            if neighbor not in seen:
+                seen.append(neighbor)
+        return seen
+
+    def node_of(self, port):
+        return self.port_node.get(self.resolve(port), None)
+
+    def reachable(self, source, min_capacity=None):
+        """Returns the set of nodes reachable from source."""
+        source = self.resolve(source)
+        seen = set([source])
+        queue = collections.deque([source])
+        while queue:
+            node = queue.popleft()
+            for neighbor, link, capacity, metric in self.adjacency.get(node, []):
+                if neighbor in seen or not _fits(capacity, min_capacity):
+                    continue
+                seen.add(neighbor)
+                queue.append(neighbor)
+        return seen
+
+    def is_reachable(self, source, destination, min_capacity=None):
+        return self.resolve(destination) in self.reachable(source, min_capacity)
+
+    def shortest_path(self, source, destination, weight="metric", min_capacity=None):
+        """
+        Dijkstra from source to destination. weight is "metric" (the
+        trafficEngineeringMetric), "hops", or "capacity" (cost 1/capacity,
+        preferring the widest links). Links with less than min_capacity
+        are skipped. Returns (cost, nodes, links) or None.
+        """
+        source = self.resolve(source)
+        destination = self.resolve(destination)
+        costs = {source: 0}
+        previous = {}
+        queue = [(0, source)]
+        done = set()
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if node in done:
+                continue
+            done.add(node)
+            if node == destination:
+                break
+            for neighbor, link, capacity, metric in self.adjacency.get(node, []):
+                if neighbor in done or not _fits(capacity, min_capacity):
+                    continue
+                new_cost = cost + _weight(weight, capacity, metric)
+                if new_cost < costs.get(neighbor, float("inf")):
+                    costs[neighbor] = new_cost
+                    previous[neighbor] = (node, link)
+                    heapq.heappush(queue, (new_cost, neighbor))
+
+        if destination not in done:
+            return None
+        nodes = [destination]
+        links = []
+        while nodes[-1] != source:
+            node, link = previous[nodes[-1]]
+            nodes.append(node)
+            links.append(link)
+        nodes.reverse()
+        links.reverse()
+        return costs[destination], nodes, links
+
+
+def _fits(capacity, min_capacity):
+    if min_capacity is None:
+        return True
+    return capacity is not None and capacity >= min_capacity
+
+
+def _weight(weight, capacity, metric):
+    if weight == "hops":
+        return 1
+    if weight == "capacity":
+        if not capacity:
+            return float("inf")
+        return 1.0 / capacity
+    return metric
@@ -0,0 +1,360 @@
+'''
+Merges encoded domains into one federated topology.
+
+    topology = merge_domains([ad1, ad2, ad3], urn="urn:publicid:IDN+federation")
+
+Every input domain (or every domain of an input topology) becomes one of
+topology["domains"]. Resources are deduplicated by URN through a hash
+index, the first copy wins, and every JSON pointer is rewritten to the
+merged positions in one pass per input. A domain seen again is merged
+into its first copy: its other lists are appended, its mappings merged
+and values that differ are reported in conflicts, keeping the first.
+References between the inputs, bare URNs or the "<document><pointer>"
+references of the URN registry, become pointers into the merged
+topology.
+
+encode_many encodes many documents in parallel and merges them:
+
+    python -m unisencoder.merge -t rspec3 -o federation.json \\
+        utah.xml=urn:publicid:IDN+emulab.net+authority+cm \\
+        gpo.xml=urn:publicid:IDN+instageni.gpolab.bbn.com+authority+cm
+
+encode_manifests encodes the manifests of many slices against the same
+advertisements. The advertisements are encoded and indexed once, URN to
+"<document><pointer>" as in the URN registry, and the relations.over
+component references of every manifest are resolved from that index:
+
+    outputs = encode_manifests(
+        [("utah.xml", "urn:publicid:IDN+emulab.net+authority+cm")],
+        [("slice1.xml", slice1_urn), ("slice2.xml", slice2_urn, slice2_uuid)])
+'''
+
+import argparse
+import json
+import multiprocessing
+import sys
+
+from lxml import etree
+
+from decoder import DECODERS, RSpec3Decoder, UNISDecoder, setup_logger
+from output import build_index, is_mapping, move_pointer, rewrite_pointers, escape_pointer
+
+
+# Top level lists of a domain whose resources are deduplicated by URN
+MERGED_COLLECTIONS = ["nodes", "ports", "links"]
+
+
+def _input_domains(out):
+    """Returns (domain, pointer) for the domains of one encoded input."""
+    if out.get("$schema", None) == UNISDecoder.SCHEMAS["topology"] and "domains" in out:
+        return [(domain, "#/domains/%d" % index) for index, domain in enumerate(out["domains"])]
+    return [(out, "#")]
+
+
+def _merge_into(target, source, old, new, moves, added, pending, conflicts):
+    """
+    Merges the keys of source, a copy of target found at old, into target
+    at new. Keys target lacks are added, lists appended and mappings
+    merged; other values that differ are appended to conflicts as
+    (pointer, kept, dropped).
+    """
+    for key, value in source.iteritems():
+        old_key = old + "/" + escape_pointer(key)
+        new_key = new + "/" + escape_pointer(key)
+        kept = target.get(key, None)
+        if key not in target:
+            target[key] = value
+            if isinstance(value, basestring):
+                pending.append((target, key))
+            else:
+                added.append(value)
+        elif isinstance(value, list) and isinstance(kept, list):
+            for index, item in enumerate(value):
+                moves["%s/%d" % (old_key, index)] = "%s/%d" % (new_key, len(kept))
+                kept.append(item)
+                added.append(item)
+        elif is_mapping(value) and is_mapping(kept):
+            _merge_into(kept, value, old_key, new_key, moves, added, pending, conflicts)
+        elif value != kept and conflicts is not None:
+            conflicts.append((new_key, kept, value))
+
+
+def merge_domains(outputs, urn=None, documents=None, conflicts=None):
+    """
+    Merges encoded outputs into one topology. documents optionally names
+    each output as the URN registry did (by default its URN) so registry
+    references between them can be resolved. When a list is given as
+    conflicts, the values of a repeated domain that differ from its first
+    copy are appended to it as (merged pointer, kept, dropped).
+    """
+    merged = {"$schema": UNISDecoder.SCHEMAS["topology"], "domains": []}
+    if urn is not None:
+        merged["urn"] = urn
+    # URN -> pointer in the merged topology, the hash index used for dedupe
+    seen = {}
+    # document -> pointer moves of that input
+    moved = {}
+    # pointer -> merged domain
+    targets = {}
+
+    for position, out in enumerate(outputs):
+        moves = {}
+        # What this input added, the only part its pointers are valid in
+        added = []
+        # (mapping, key) of the pointer strings added to a merged domain
+        pending = []
+        for domain, old_prefix in _input_domains(out):
+            domain_urn = domain.get("urn", None)
+            if domain_urn is not None and domain_urn in seen:
+                # Same domain from another input, its new resources join it
+                prefix = seen[domain_urn]
+                target = targets[prefix]
+                collections = dict((name, domain.get(name, [])) for name in MERGED_COLLECTIONS)
+                others = dict((key, value) for key, value in domain.iteritems()
+                              if key not in MERGED_COLLECTIONS)
+                _merge_into(target, others, old_prefix, prefix, moves, added, pending, conflicts)
+            else:
+                prefix = "#/domains/%d" % len(merged["domains"])
+                target = domain
+                merged["domains"].append(domain)
+                targets[prefix] = domain
+                added.append(domain)
+                if domain_urn is not None:
+                    seen[domain_urn] = prefix
+                collections = {}
+                for name in MERGED_COLLECTIONS:
+                    if name in domain:
+                        collections[name] = domain[name]
+                        domain[name] = []
+            moves[old_prefix] = prefix
+
+            for name, resources in collections.iteritems():
+                for index, resource in enumerate(resources):
+                    old = "%s/%s/%d" % (old_prefix, name, index)
+                    resource_urn = resource.get("urn", None) if is_mapping(resource) else None
+                    if resource_urn is not None and resource_urn in seen:
+                        moves[old] = seen[resource_urn]
+                        continue
+                    kept = target.setdefault(name, [])
+                    new = "%s/%s/%d" % (prefix, name, len(kept))
+                    moves[old] = new
+                    if resource_urn is not None:
+                        seen[resource_urn] = new
+                    kept.append(resource)
+                    if target is not domain:
+                        added.append(resource)
+
+        rewrite_pointers(added, moves)
+        for mapping, key in pending:
+            if mapping[key].startswith("#/"):
+                mapping[key] = move_pointer(mapping[key], moves)
+        name = documents[position] if documents else out.get("urn", None)
+        if name:
+            moved.setdefault(name, moves)
+
+    _resolve_references(merged["domains"], seen, moved)
+    return merged
+
+
+def _resolve_references(obj, seen, moved):
+    """Turns bare URN and "<document>#/..." hrefs into merged pointers."""
+    if isinstance(obj, list):
+        for value in obj:
+            _resolve_references(value, seen, moved)
+        return
+    if not is_mapping(obj):
+        return
+    href = obj.get("href", None)
+    if isinstance(href, basestring) and not href.startswith("#"):
+        if href in seen:
+            obj["href"] = seen[href]
+        elif "#/" in href:
+            document, pointer = href.split("#", 1)
+            if document in moved:
+                obj["href"] = move_pointer("#" + pointer, moved[document])
+    for value in obj.itervalues():
+        if isinstance(value, list) or is_mapping(value):
+            _resolve_references(value, seen, moved)
+
+
+def _encode_file(job):
+    """Pool worker: encodes one file, returns the output."""
+    input_type, filename, kwargs = job
+    tree = etree.parse(filename)
+    return DECODERS[input_type]().encode(tree, **kwargs)
+
+
+def _encode_jobs(jobs, processes, worker=_encode_file, initializer=None, initargs=()):
+    """Runs worker over jobs, in a pool unless there is only one job."""
+    if processes == 1 or len(jobs) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [worker(job) for job in jobs]
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        return pool.map(worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def encode_many(inputs, input_type="rspec3", processes=None, urn=None, conflicts=None):
+    """
+    Encodes inputs, a list of filenames or (filename, encode options)
+    pairs, with a pool of processes and merges them with merge_domains.
+    """
+    jobs = []
+    for item in inputs:
+        if isinstance(item, basestring):
+            item = (item, {})
+        jobs.append((input_type, item[0], dict(item[1])))
+    return merge_domains(_encode_jobs(jobs, processes), urn=urn, conflicts=conflicts)
+
+
+def component_index(outputs, documents=None):
+    """
+    Returns the URN -> "<document><pointer>" index of encoded
+    advertisements. documents names each output, by default its URN.
+    """
+    index = {}
+    for position, out in enumerate(outputs):
+        document = documents[position] if documents else out.get("urn", None)
+        if not document:
+            raise ValueError("Advertisement %d has no URN, a document name is required" % position)
+        for resource_urn, pointer in build_index(out)["urns"].iteritems():
+            index.setdefault(resource_urn, document + pointer)
+    return index
+
+
+def resolve_components(out, index):
+    """
+    Rewrites the relations.over component ids of an encoded manifest to
+    their references in index. Returns how many were resolved.
+    """
+    resolved = 0
+    if isinstance(out, list):
+        for value in out:
+            resolved += resolve_components(value, index)
+        return resolved
+    if not is_mapping(out):
+        return resolved
+    relations = out.get("relations", None)
+    if is_mapping(relations) and isinstance(relations.get("over", None), list):
+        for ref in relations["over"]:
+            href = ref.get("href", None) if is_mapping(ref) else None
+            if isinstance(href, basestring) and not href.startswith("#"):
+                # Component ids are URNs as the advertisement encoded them
+                href = index.get(href, None) or index.get(RSpec3Decoder.rspec_create_urn(href), None)
+                if href is not None:
+                    ref["href"] = href
+                    resolved += 1
+    for value in out.itervalues():
+        if isinstance(value, list) or is_mapping(value):
+            resolved += resolve_components(value, index)
+    return resolved
+
+
+# The advertisement index of the manifest workers, set once per process
+_components = {}
+
+
+def _set_components(index):
+    global _components
+    _components = index
+
+
+def _encode_manifest(job):
+    """Pool worker: encodes one manifest and resolves it with _components."""
+    out = _encode_file(job)
+    resolve_components(out, _components)
+    return out
+
+
+def encode_manifests(advertisements, manifests, processes=None, index=None):
+    """
+    Encodes manifests, (filename, slice_urn) or (filename, slice_urn,
+    slice_uuid) tuples, with a pool of processes. advertisements,
+    (filename, component_manager_id) pairs, are encoded and indexed once
+    beforehand, unless their component_index is given as index. Returns
+    the outputs in the order of manifests.
+    """
+    if index is None:
+        jobs = [("rspec3", filename, {"component_manager_id": component_manager_id})
+                for filename, component_manager_id in advertisements]
+        outputs = _encode_jobs(jobs, processes)
+        index = component_index(outputs, [out.get("urn", None) or job[2]["component_manager_id"]
+                                          for out, job in zip(outputs, jobs)])
+        del outputs
+
+    jobs = []
+    for item in manifests:
+        options = {"slice_urn": item[1]}
+        if len(item) > 2 and item[2] is not None:
+            options["slice_uuid"] = item[2]
+        jobs.append(("rspec3", item[0], options))
+    return _encode_jobs(jobs, processes, _encode_manifest, _set_components, (index,))
+
+
+def split_input(item):
+    """
+    Splits a FILE=URN argument into (FILE, URN), URN None without one.
+    Filenames may contain "=", the URN starts at the last "=urn:".
+    """
+    filename, sep, urn = item.rpartition("=urn:")
+    if not sep:
+        return item, None
+    return filename, "urn:" + urn
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Encodes many RSpec V3 or perfSONAR documents into one UNIS topology"
+    )
+    parser.add_argument('-t', '--type', type=str, default="rspec3",
+        choices=["rspec3", "ps"], help='Input type.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+        help='Output file')
+    parser.add_argument('-l', '--log', type=str, default="unisencoder.log",
+        help='Log file.')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+        help='Encoding processes (default one per CPU).')
+    parser.add_argument('--urn', type=str, default=None,
+        help='URN of the merged topology.')
+    parser.add_argument('--indent', type=int, default=2,
+        help='JSON output indent.')
+    parser.add_argument('-a', '--advertisement', type=str, action='append', default=[],
+        help='FILE=COMPONENT_MANAGER_URN of an advertisement the inputs are manifests of. '
+             'The inputs are then FILE=SLICE_URN and the output a list of their topologies.')
+    parser.add_argument('inputs', type=str, nargs='+',
+        help='Input files, FILE=COMPONENT_MANAGER_URN for advertisements.')
+    args = parser.parse_args()
+
+    setup_logger(args.log)
+    if args.advertisement:
+        advertisements = [split_input(item) for item in args.advertisement]
+        manifests = [split_input(item) for item in args.inputs]
+        outputs = encode_manifests(advertisements, manifests, args.processes)
+        out_file = sys.stdout if args.output is None else open(args.output, 'w')
+        json.dump(outputs, fp=out_file, indent=args.indent)
+        out_file.close()
+        return
+
+    inputs = []
+    for item in args.inputs:
+        filename, component_manager_id = split_input(item)
+        options = {}
+        if component_manager_id:
+            options["component_manager_id"] = component_manager_id
+        inputs.append((filename, options))
+
+    conflicts = []
+    topology = encode_many(inputs, args.type, args.processes, args.urn, conflicts)
+    for pointer, kept, dropped in conflicts:
+        print >>sys.stderr, "%s differs between inputs, keeping %s over %s" % (
+            pointer, json.dumps(kept), json.dumps(dropped))
+    out_file = sys.stdout if args.output is None else open(args.output, 'w')
+    json.dump(topology, fp=out_file, indent=args.indent)
+    out_file.close()
+
+if __name__ == '__main__':
+    main()
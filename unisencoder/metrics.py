@@ -0,0 +1,184 @@
+'''
+Counters, gauges and latency histograms for the dispatcher.
+
+Metrics can be scraped in the Prometheus text format from a small HTTP
+endpoint, or written periodically as a JSON snapshot file.
+'''
+
+import BaseHTTPServer
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(name, labels):
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for name, value in labels)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(("%g" % bound, count) for bound, count in zip(self.buckets, self.counts)),
+        }
+
+
+class Metrics(object):
+    """Thread safe registry of counters, gauges and histograms."""
+
+    def __init__(self, prefix="unisencoder"):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self, name, labels)
+
+    def get(self, name, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            return self._gauges.get(key, None)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                full = "%s_%s_total" % (self._prefix, name)
+                if full not in typed:
+                    lines.append("# TYPE %s counter" % full)
+                    typed.add(full)
+                lines.append("%s%s %s" % (full, _format_labels(labels), value))
+            for (name, labels), value in sorted(self._gauges.items()):
+                full = "%s_%s" % (self._prefix, name)
+                if full not in typed:
+                    lines.append("# TYPE %s gauge" % full)
+                    typed.add(full)
+                lines.append("%s%s %s" % (full, _format_labels(labels), value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                full = "%s_%s" % (self._prefix, name)
+                if full not in typed:
+                    lines.append("# TYPE %s histogram" % full)
+                    typed.add(full)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append("%s_bucket%s %d" % (full, _format_labels(labels, ("le", "%g" % bound)), count))
+                lines.append("%s_bucket%s %d" % (full, _format_labels(labels, ("le", "+Inf")), histogram.count))
+                lines.append("%s_sum%s %s" % (full, _format_labels(labels), histogram.sum))
+                lines.append("%s_count%s %d" % (full, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns every metric as a JSON serializable dict."""
+        def name(key):
+            return key[0] + _format_labels(key[1])
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "uptime": time.time() - self._started,
+                "counters": dict((name(key), value) for key, value in self._counters.items()),
+                "gauges": dict((name(key), value) for key, value in self._gauges.items()),
+                "histograms": dict((name(key), histogram.snapshot()) for key, histogram in self._histograms.items()),
+            }
+
+    def write_snapshot(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as out_file:
+            json.dump(self.snapshot(), out_file, indent=2)
+        os.rename(tmp_path, path)
+
+    def start_snapshots(self, path, interval):
+        """Writes a snapshot to path every interval seconds from a daemon thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot(path)
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve(self, port, host=""):
+        """Serves render() on http://host:port/metrics from a daemon thread."""
+        metrics = self
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class _Timer(object):
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._name, time.time() - self._start, **self._labels)
+        return False
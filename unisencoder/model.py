@@ -0,0 +1,238 @@
+'''
+Compact in-memory model of encoded topologies.
+
+Decoders called with compact=True return their output built from the
+classes below instead of dicts: the common fields of domains, nodes, ports
+and links live in __slots__, and keys and $schema URLs are interned, so
+a large advertisement kept in memory takes a fraction of the space. The
+decoders still build the usual dicts and the JSON text first and only
+parse the text into this model at the end; the saving is in the output
+that is held on to, not in the peak of the encode. Resources still answer
+the usual dict lookups (resource["ports"], get, in, iteritems, itervalues) and are
+turned into JSON lazily:
+
+    json.dump(out, out_file, cls=ModelEncoder)
+
+to_dict converts a compact output back to plain dicts and lists.
+'''
+
+import json
+
+
+_MISSING = object()
+_strings = {}
+
+
+def intern_string(value):
+    """Returns the one shared copy of a str or unicode value."""
+    return _strings.setdefault(value, value)
+
+
+class Resource(object):
+    """A UNIS resource with its common fields in slots, the rest in _extra."""
+
+    __slots__ = ("schema", "id", "urn", "name", "description", "properties", "_extra")
+    FIELDS = (
+        ("$schema", "schema"),
+        ("id", "id"),
+        ("urn", "urn"),
+        ("name", "name"),
+        ("description", "description"),
+        ("properties", "properties"),
+    )
+
+    def __init__(self, pairs=()):
+        self._extra = None
+        for key, value in pairs:
+            self[key] = value
+
+    def __getitem__(self, key):
+        attr = self._ATTRS.get(key, None)
+        if attr is not None:
+            value = getattr(self, attr, _MISSING)
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        attr = self._ATTRS.get(key, None)
+        if attr is not None:
+            setattr(self, attr, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[intern_string(key)] = value
+
+    def __delitem__(self, key):
+        attr = self._ATTRS.get(key, None)
+        try:
+            if attr is not None:
+                delattr(self, attr)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for key, attr in self.FIELDS:
+            value = getattr(self, attr, _MISSING)
+            if value is not _MISSING:
+                yield key, value
+        if self._extra is not None:
+            for item in self._extra.iteritems():
+                yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Resource, dict)):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.iteritems()))
+
+    def to_dict(self):
+        """Returns the resource, and everything in it, as plain dicts."""
+        return dict((key, to_dict(value)) for key, value in self.iteritems())
+
+
+class Domain(Resource):
+    __slots__ = ("nodes", "ports", "links", "domains")
+    FIELDS = Resource.FIELDS + (
+        ("nodes", "nodes"),
+        ("ports", "ports"),
+        ("links", "links"),
+        ("domains", "domains"),
+    )
+
+
+class Node(Resource):
+    __slots__ = ("ports", "location", "relations")
+    FIELDS = Resource.FIELDS + (
+        ("ports", "ports"),
+        ("location", "location"),
+        ("relations", "relations"),
+    )
+
+
+class Port(Resource):
+    __slots__ = ("address", "capacity", "relations")
+    FIELDS = Resource.FIELDS + (
+        ("address", "address"),
+        ("capacity", "capacity"),
+        ("relations", "relations"),
+    )
+
+
+class Link(Resource):
+    __slots__ = ("directed", "endpoints", "capacity")
+    FIELDS = Resource.FIELDS + (
+        ("directed", "directed"),
+        ("endpoints", "endpoints"),
+        ("capacity", "capacity"),
+    )
+
+
+for _cls in (Resource, Domain, Node, Port, Link):
+    _cls._ATTRS = dict(_cls.FIELDS)
+
+# Resources are recognized by the last part of their $schema,
+# e.g. http://unis.incntre.iu.edu/schema/20140214/node#
+KINDS = {
+    "domain": Domain,
+    "topology": Domain,
+    "node": Node,
+    "port": Port,
+    "link": Link,
+}
+_classes = {}
+
+
+def resource_class(schema):
+    """Returns the model class of a $schema URL, None for other schemas."""
+    if schema not in _classes:
+        kind = schema.rstrip("#").rsplit("/", 1)[-1] if isinstance(schema, basestring) else None
+        _classes[schema] = KINDS.get(kind, None)
+    return _classes[schema]
+
+
+def from_pairs(pairs):
+    """
+    json.loads object_pairs_hook building the compact model: objects with
+    a known $schema become resources, the others dicts with interned keys.
+    """
+    schema = None
+    for key, value in pairs:
+        if key == "$schema":
+            schema = value
+            break
+    cls = resource_class(schema) if schema is not None else None
+    if cls is None:
+        return dict((intern_string(key), intern_string(value) if key == "$schema" else value)
+                    for key, value in pairs)
+    resource = cls()
+    for key, value in pairs:
+        if key == "$schema":
+            value = intern_string(value)
+        resource[key] = value
+    return resource
+
+
+def loads(text):
+    """Parses JSON text into the compact model."""
+    return json.loads(text, object_pairs_hook=from_pairs)
+
+
+def to_dict(obj):
+    """Converts a compact output, or any part of it, to dicts and lists."""
+    if isinstance(obj, Resource):
+        return obj.to_dict()
+    if isinstance(obj, dict):
+        return dict((key, to_dict(value)) for key, value in obj.iteritems())
+    if isinstance(obj, list):
+        return [to_dict(value) for value in obj]
+    return obj
+
+
+class ModelEncoder(json.JSONEncoder):
+    """JSONEncoder writing resources without converting them first."""
+
+    def default(self, obj):
+        if isinstance(obj, Resource):
+            return dict(obj.iteritems())
+        return json.JSONEncoder.default(self, obj)
@@ -0,0 +1,320 @@
+'''
+Post-processing of encoded topologies.
+
+share_definitions moves the GENI blocks that repeat across nodes and
+links of an advertisement (hardware types, sliver types, disk images,
+component managers) to one shared "definitions" section. Every distinct
+block used more than once, and longer than a reference to it, is written
+once and referenced where it was used:
+
+    "hardware_types": [{"href": "#/definitions/hardware_types/0", "rel": "full"}]
+
+It runs on the finished dict, so it only makes the serialized output
+smaller; the decoders still build every copy while encoding.
+
+canonicalize makes the output independent of the order of the input
+document: resources are sorted by URN and shared definitions by content,
+the JSON pointers between them are rewritten to the new positions and
+every node, port and link gets a
+content fingerprint in properties.fingerprint. Serialized with
+dumps_canonical the same topology always gives the same bytes.
+
+build_index returns the lookups consumers otherwise get by walking the
+whole topology, meant to be saved as a sidecar file next to the output:
+URN and id to JSON pointer, port to the node owning it and port to the
+links ending at it.
+'''
+
+import hashlib
+import json
+import model
+
+
+# Shared GENI properties, innermost first so sliver types are compared
+# after their disk images became references
+SHARED_KINDS = ["disk_images", "hardware_types", "component_managers", "sliver_type"]
+# Resources given a properties.fingerprint by canonicalize
+FINGERPRINTED = (model.Node, model.Port, model.Link)
+
+
+def _property_blocks(obj, namespace):
+    """Yields every properties[namespace] dict in obj."""
+    if isinstance(obj, dict):
+        properties = obj.get("properties", None)
+        if isinstance(properties, dict) and isinstance(properties.get(namespace, None), dict):
+            yield properties[namespace]
+        for value in obj.itervalues():
+            if isinstance(value, (dict, list)):
+                for block in _property_blocks(value, namespace):
+                    yield block
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                for block in _property_blocks(value, namespace):
+                    yield block
+
+
+def share_definitions(out, namespace="geni", kinds=SHARED_KINDS):
+    """
+    Replaces the repeated GENI blocks of out by references to
+    out["definitions"][kind][n]. Returns out. Only blocks used more than
+    once and longer than their reference are moved. This shrinks the
+    output, not the memory or time of the encode that built out.
+    """
+    definitions = {}
+    # (kind, digest) -> pointer, or None for the blocks left in place
+    pointers = {}
+
+    def share(kind, value, digest):
+        key = (kind, digest)
+        if key not in pointers:
+            shared = definitions.get(kind, [])
+            pointer = "#/definitions/%s/%d" % (kind, len(shared))
+            if len(json.dumps(value)) > len(json.dumps({"href": pointer, "rel": "full"})):
+                definitions.setdefault(kind, []).append(value)
+            else:
+                pointer = None
+            pointers[key] = pointer
+        if pointers[key] is None:
+            return value
+        return {"href": pointers[key], "rel": "full"}
+
+    blocks = list(_property_blocks(out, namespace))
+    for kind in kinds:
+        # (container, key) of every block of this kind
+        found = []
+        for block in blocks:
+            for container in [block] + [value for value in block.values() if isinstance(value, dict)]:
+                value = container.get(kind, None)
+                if isinstance(value, list):
+                    found.extend((value, index) for index, item in enumerate(value)
+                                 if isinstance(item, dict) and "href" not in item)
+                elif isinstance(value, dict) and "href" not in value:
+                    found.append((container, kind))
+        digests = [hashlib.sha1(json.dumps(container[key], sort_keys=True)).digest()
+                   for container, key in found]
+        counts = {}
+        for digest in digests:
+            counts[digest] = counts.get(digest, 0) + 1
+        for (container, key), digest in zip(found, digests):
+            if counts[digest] > 1:
+                container[key] = share(kind, container[key], digest)
+
+    if definitions:
+        out["definitions"] = definitions
+    return out
+
+
+def is_mapping(obj):
+    return isinstance(obj, (dict, model.Resource))
+
+
+def is_resource(obj):
+    return is_mapping(obj) and "$schema" in obj
+
+
+def _resource_key(resource):
+    return (resource.get("urn", None) or "", resource.get("id", None) or "",
+            resource.get("name", None) or "")
+
+
+def escape_pointer(key):
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def _reorder(obj, old, new, moves):
+    """Sorts every list of resources in obj, recording pointer moves."""
+    if is_mapping(obj):
+        for key, value in obj.iteritems():
+            if isinstance(value, list) or is_mapping(value):
+                _reorder(value, old + "/" + escape_pointer(key), new + "/" + escape_pointer(key), moves)
+    elif isinstance(obj, list):
+        order = range(len(obj))
+        if obj and all(is_resource(value) for value in obj):
+            order.sort(key=lambda index: _resource_key(obj[index]))
+            obj[:] = [obj[index] for index in order]
+        for new_index, old_index in enumerate(order):
+            old_pointer = "%s/%d" % (old, old_index)
+            new_pointer = "%s/%d" % (new, new_index)
+            if old_pointer != new_pointer:
+                moves[old_pointer] = new_pointer
+            value = obj[new_index]
+            if isinstance(value, list) or is_mapping(value):
+                _reorder(value, old_pointer, new_pointer, moves)
+
+
+def move_pointer(pointer, moves):
+    parts = pointer.split("/")
+    for end in range(len(parts), 0, -1):
+        prefix = "/".join(parts[:end])
+        if prefix in moves:
+            return "/".join([moves[prefix]] + parts[end:])
+    return pointer
+
+
+def rewrite_pointers(obj, moves):
+    if is_mapping(obj):
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return
+    for key, value in items:
+        if isinstance(value, basestring):
+            if value.startswith("#/"):
+                obj[key] = move_pointer(value, moves)
+        else:
+            rewrite_pointers(value, moves)
+
+
+def fingerprint(resource):
+    """Returns the sha1 of a resource's canonical JSON, without its fingerprint."""
+    copy = dict((key, value) for key, value in resource.iteritems() if key != "selfRef")
+    properties = copy.get("properties", None)
+    if is_mapping(properties) and "fingerprint" in properties:
+        copy["properties"] = dict((key, value) for key, value in properties.iteritems()
+                                  if key != "fingerprint")
+    return hashlib.sha1(dumps_canonical(copy)).hexdigest()
+
+
+def _add_fingerprints(obj):
+    if isinstance(obj, list):
+        for value in obj:
+            _add_fingerprints(value)
+        return
+    if not is_mapping(obj):
+        return
+    for value in obj.itervalues():
+        if isinstance(value, list) or is_mapping(value):
+            _add_fingerprints(value)
+    if is_resource(obj) and model.resource_class(obj["$schema"]) in FINGERPRINTED:
+        if not is_mapping(obj.get("properties", None)):
+            obj["properties"] = {}
+        obj["properties"]["fingerprint"] = fingerprint(obj)
+
+
+def _sort_definitions(out):
+    """
+    Sorts every out["definitions"] list by the canonical JSON of its
+    blocks and rewrites the pointers to them. Kinds are sorted innermost
+    first, so blocks referencing other definitions compare on their
+    final references.
+    """
+    definitions = out.get("definitions", None)
+    if not is_mapping(definitions):
+        return
+    kinds = [kind for kind in SHARED_KINDS if kind in definitions]
+    kinds += sorted(kind for kind in definitions.keys() if kind not in SHARED_KINDS)
+    for kind in kinds:
+        shared = definitions[kind]
+        if not isinstance(shared, list):
+            continue
+        keys = [dumps_canonical(block) for block in shared]
+        order = sorted(range(len(shared)), key=lambda index: keys[index])
+        shared[:] = [shared[index] for index in order]
+        moves = {}
+        prefix = "#/definitions/" + escape_pointer(kind)
+        for new_index, old_index in enumerate(order):
+            if new_index != old_index:
+                moves["%s/%d" % (prefix, old_index)] = "%s/%d" % (prefix, new_index)
+        if moves:
+            rewrite_pointers(out, moves)
+
+
+def canonicalize(out):
+    """
+    Sorts the resources of out by URN, and the shared definitions by
+    content, rewrites the pointers to them and adds fingerprints.
+    Returns out.
+    """
+    _sort_definitions(out)
+    moves = {}
+    _reorder(out, "#", "#", moves)
+    if moves:
+        rewrite_pointers(out, moves)
+    _add_fingerprints(out)
+    return out
+
+
+def dumps_canonical(out, **kwargs):
+    """Serializes out with sorted keys and no optional whitespace."""
+    return json.dumps(out, sort_keys=True, separators=(",", ":"), cls=model.ModelEncoder, **kwargs)
+
+
+def resolve(out, pointer):
+    """Returns what a "#/..." JSON pointer of out points to."""
+    obj = out
+    for part in pointer.lstrip("#").strip("/").split("/"):
+        if not part:
+            continue
+        part = part.replace("~1", "/").replace("~0", "~")
+        obj = obj[int(part)] if isinstance(obj, list) else obj[part]
+    return obj
+
+
+def hrefs(value):
+    """Yields the JSON pointers referenced by a list or dict of hrefs."""
+    if is_mapping(value):
+        if "href" in value:
+            value = [value]
+        else:
+            value = value.values()
+    if not isinstance(value, list):
+        return
+    for item in value:
+        if is_mapping(item):
+            href = item.get("href", None)
+            if isinstance(href, basestring) and href.startswith("#/"):
+                yield href
+
+
+def _index(obj, pointer, node, port, index):
+    if isinstance(obj, list):
+        for position, value in enumerate(obj):
+            if isinstance(value, list) or is_mapping(value):
+                _index(value, "%s/%d" % (pointer, position), node, port, index)
+        return
+
+    if is_resource(obj):
+        cls = model.resource_class(obj["$schema"])
+        if obj.get("urn", None):
+            index["urns"][obj["urn"]] = pointer
+        if obj.get("id", None):
+            index["ids"][obj["id"]] = pointer
+        if cls is model.Node:
+            node, port = pointer, None
+            for href in hrefs(obj.get("ports", None)):
+                index["port_node"][href] = pointer
+        elif cls is model.Port:
+            if node is not None:
+                index["port_node"][pointer] = node
+            port = pointer
+        elif cls is model.Link:
+            ends = set(hrefs(obj.get("endpoints", None)))
+            if port is not None:
+                ends.add(port)
+            for href in sorted(ends):
+                index["port_links"].setdefault(href, []).append(pointer)
+        elif cls is model.Domain:
+            node, port = None, None
+
+    for key, value in obj.iteritems():
+        if isinstance(value, list) or is_mapping(value):
+            _index(value, pointer + "/" + escape_pointer(key), node, port, index)
+
+
+def build_index(out):
+    """
+    Returns {"urns": {urn: pointer}, "ids": {id: pointer},
+    "port_node": {port pointer: node pointer},
+    "port_links": {port pointer: [link pointers]}} for an encoded topology.
+    """
+    index = {"urns": {}, "ids": {}, "port_node": {}, "port_links": {}}
+    _index(out, "#", None, None, index)
+    return index
+
+
+def write_index(out, filename):
+    """Saves the build_index of out as a JSON sidecar file."""
+    with open(filename, 'w') as out_file:
+        json.dump(build_index(out), out_file, sort_keys=True)
@@ -0,0 +1,660 @@
+'''
+Fetches topologies from perfSONAR topology services (TS).
+
+Many services are queried concurrently, each with its own timeout. SOAP
+responses are parsed incrementally as they arrive (gzip encoded responses
+are decompressed on the fly) and the topology element is handed to
+PSDecoder directly, without buffering the body or parsing it twice.
+
+Responses can be kept in an on-disk TopologyCache, so unchanged
+topologies skip the transfer (conditional requests) and the encoding.
+
+The topology services themselves can be discovered by crawling perfSONAR
+lookup services with LookupCrawler.
+
+TopologyDaemon keeps UNIS current: it polls every service on its own
+jittered schedule and pushes a topology only when its hash changed.
+
+    unisencoder-ps --discover --interval 600
+'''
+
+import Queue
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import urllib2
+import uuid
+import zlib
+import settings
+from lxml import etree
+from netlogger import nllog
+from decoder import PSDecoder, TS_QUERY, make_envelope, setup_logger
+from unisclient import UNISClient, UNISClientException
+
+
+TOPOLOGY_TAG = "{%s}topology" % PSDecoder.nmtb
+PSSERVICE_NS = "http://ggf.org/ns/nmwg/tools/org/perfsonar/service/1.0/"
+ACCESS_POINT_TAG = "{%s}accessPoint" % PSSERVICE_NS
+TOPOLOGY_EVENT_TYPE = "http://ggf.org/ns/nmwg/topology/20070809"
+
+LS_QUERY = """
+    <nmwg:message type="LSQueryRequest" id="msg1" xmlns:nmwg="http://ggf.org/ns/nmwg/base/2.0/" xmlns:xquery="http://ggf.org/ns/nmwg/tools/org/perfsonar/service/lookup/xquery/1.0/">
+        <nmwg:metadata id="meta1">
+            <xquery:subject id="sub1">
+                declare namespace nmwg="http://ggf.org/ns/nmwg/base/2.0/";
+                declare namespace perfsonar="http://ggf.org/ns/nmwg/tools/org/perfsonar/1.0/";
+                declare namespace psservice="http://ggf.org/ns/nmwg/tools/org/perfsonar/service/1.0/";
+                for $metadata in /nmwg:store[@type="LSStore"]/nmwg:metadata
+                    let $metadata_id := $metadata/@id
+                    let $data := /nmwg:store[@type="LSStore"]/nmwg:data[@metadataIdRef=$metadata_id]
+                    where %s
+                    return $metadata/perfsonar:subject/psservice:service/psservice:accessPoint
+            </xquery:subject>
+            <nmwg:eventType>http://ggf.org/ns/nmwg/tools/org/perfsonar/service/lookup/xquery/1.0</nmwg:eventType>
+        </nmwg:metadata>
+        <nmwg:data metadataIdRef="meta1" id="d1" />
+    </nmwg:message>
+    """
+# Services registering topology data, and lookup services to crawl next
+LS_TOPOLOGY_CONDITION = '$data/nmwg:metadata/nmwg:eventType[text()="%s"]' % TOPOLOGY_EVENT_TYPE
+LS_LOOKUP_CONDITION = '$metadata/perfsonar:subject/psservice:service/psservice:serviceType[text()="LS" or text()="hLS"]'
+
+
+class PerfSONARException(Exception):
+    """Raised when a perfSONAR service answers with something unusable."""
+    pass
+
+
+class GzipStream(object):
+    """File-like object decompressing a gzip encoded stream as it is read."""
+
+    def __init__(self, fileobj, block_size=64 * 1024):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ""
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            block = self._fileobj.read(self._block_size)
+            if not block:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+            else:
+                self._buffer += self._decompressor.decompress(block)
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+# Encode options that do not change the encoded topology
+UNKEYED_OPTIONS = ["processes"]
+
+
+def cache_options(kwargs):
+    """
+    Returns the encode options of kwargs that are part of a TopologyCache
+    key, or None when the result can't be cached: a URN registry has to
+    see every encode, and compact outputs are not plain JSON.
+    """
+    options = {}
+    for name, value in kwargs.iteritems():
+        if name in UNKEYED_OPTIONS:
+            continue
+        if name == "compact" and value:
+            return None
+        if value is not None and not isinstance(value, (basestring, bool, int, long, float)):
+            return None
+        options[name] = value
+    return options
+
+
+class TopologyCache(object):
+    """
+    On-disk cache of encoded topologies keyed by endpoint, query and the
+    encode options (see cache_options).
+
+    Entries younger than ttl seconds are used without contacting the
+    service. Older entries still provide the validators for conditional
+    requests and the topology hash that lets an unchanged topology skip
+    the encoding. The least recently used entries are evicted once the
+    cache grows over max_bytes.
+    """
+
+    def __init__(self, path=None, ttl=None, max_bytes=None):
+        if path is None:
+            path = settings.PS_CACHE_DIR
+        if ttl is None:
+            ttl = settings.PS_CACHE_TTL
+        if max_bytes is None:
+            max_bytes = settings.PS_CACHE_MAX_BYTES
+        self._path = path
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, url, query=TS_QUERY, options=None):
+        options = json.dumps(options or {}, sort_keys=True)
+        return hashlib.sha1(url + "\0" + query + "\0" + options).hexdigest()
+
+    def _filename(self, url, options):
+        return os.path.join(self._path, self.key(url, options=options) + ".json")
+
+    def get(self, url, options=None):
+        filename = self._filename(url, options)
+        try:
+            with open(filename, 'r') as in_file:
+                entry = json.load(in_file)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.get("fetched", 0) < self._ttl
+
+    def put(self, url, entry, options=None):
+        filename = self._filename(url, options)
+        tmp_filename = "%s.%s.tmp" % (filename, threading.current_thread().ident)
+        with open(tmp_filename, 'w') as out_file:
+            json.dump(entry, out_file)
+        os.rename(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            files = []
+            total = 0
+            for name in os.listdir(self._path):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    info = os.stat(os.path.join(self._path, name))
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, name))
+                total += info.st_size
+            files.sort()
+            while files and total > self._max_bytes:
+                mtime, size, name = files.pop(0)
+                try:
+                    os.remove(os.path.join(self._path, name))
+                except OSError:
+                    pass
+                total -= size
+
+
+class TopologyFetcher(object, nllog.DoesLogging):
+    """Queries perfSONAR topology services and encodes their topologies."""
+
+    def __init__(self, **kwargs):
+        nllog.DoesLogging.__init__(self)
+        self._guid = uuid.uuid1()
+        self._timeout = kwargs.get("timeout", settings.PS_FETCH_TIMEOUT)
+        self._workers = kwargs.get("workers", settings.PS_FETCH_WORKERS)
+        self._cache = kwargs.get("cache", None)
+
+    def open(self, url, timeout=None, entry=None):
+        """
+        Sends the TSQueryRequest and returns the response as a stream and
+        its validators. When the cache entry's validators show the topology
+        did not change the stream is None.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        headers = {
+            'Content-type': 'text/xml; charset="UTF-8"',
+            'SOAPAction': 'http://ggf.org/ns/nmwg/base/2.0/message/',
+            'Accept-Encoding': 'gzip',
+        }
+        if entry is not None:
+            if entry.get("etag", None):
+                headers['If-None-Match'] = entry["etag"]
+            if entry.get("last_modified", None):
+                headers['If-Modified-Since'] = entry["last_modified"]
+        request = urllib2.Request(url=url, data=make_envelope(TS_QUERY), headers=headers)
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry is not None:
+                return None, {"etag": entry.get("etag", None), "last_modified": entry.get("last_modified", None)}
+            raise
+        validators = {
+            "etag": response.info().get("ETag", None),
+            "last_modified": response.info().get("Last-Modified", None),
+        }
+        if response.info().get("Content-Encoding", "").lower() == "gzip":
+            return GzipStream(response), validators
+        return response, validators
+
+    def parse(self, stream):
+        """
+        Parses a TS response incrementally and returns the topology element
+        as its own ElementTree, or None if the response has no topology.
+        """
+        for event, element in etree.iterparse(stream, events=("end",), tag=TOPOLOGY_TAG):
+            # Detaching the element makes it the root of its tree, which is
+            # what PSDecoder expects when it builds paths to elements
+            parent = element.getparent()
+            if parent is not None:
+                parent.remove(element)
+            return etree.ElementTree(element)
+        return None
+
+    def fetch(self, url, timeout=None, **kwargs):
+        """Returns the UNIS encoding of the topology served at url."""
+        return self.fetch_entry(url, timeout, **kwargs)["out"]
+
+    def fetch_entry(self, url, timeout=None, **kwargs):
+        """
+        Returns a dict with the encoded topology ("out"), the hash of the
+        topology element ("topology_hash") and whether it changed since the
+        cached copy ("changed").
+        """
+        self.log.debug("fetch.start", url=url, guid=self._guid)
+        entry = None
+        options = cache_options(kwargs)
+        cache = self._cache if options is not None else None
+        if cache is not None:
+            entry = cache.get(url, options)
+            if entry is not None and cache.is_fresh(entry):
+                self.log.debug("fetch.end", url=url, cache="fresh", guid=self._guid)
+                entry["changed"] = False
+                return entry
+
+        stream, validators = self.open(url, timeout, entry)
+        if stream is None:
+            entry.update(validators)
+            return self._store(cache, url, options, entry, False, "not_modified")
+        try:
+            tree = self.parse(stream)
+        finally:
+            stream.close()
+        if tree is None:
+            self.log.error("no_topology", url=url, guid=self._guid)
+            raise PerfSONARException("No topology in the response of '%s'" % url)
+
+        topology_hash = hashlib.sha1(etree.tostring(tree.getroot(), method="c14n")).hexdigest()
+        if entry is not None and entry.get("topology_hash", None) == topology_hash:
+            entry.update(validators)
+            return self._store(cache, url, options, entry, False, "unchanged")
+
+        entry = {
+            "url": url,
+            "topology_hash": topology_hash,
+            "out": PSDecoder().encode(tree, **kwargs),
+        }
+        entry.update(validators)
+        return self._store(cache, url, options, entry, True, "encoded")
+
+    def _store(self, cache, url, options, entry, changed, how):
+        entry["fetched"] = time.time()
+        entry.pop("changed", None)
+        if cache is not None:
+            cache.put(url, entry, options)
+        entry["changed"] = changed
+        self.log.debug("fetch.end", url=url, cache=how, guid=self._guid)
+        return entry
+
+    def fetch_all(self, urls, timeouts=None, **kwargs):
+        """
+        Fetches every url concurrently with at most workers requests in
+        flight. timeouts optionally maps urls to their own timeout.
+        Returns two dicts, url to encoded topology and url to exception.
+        """
+        if timeouts is None:
+            timeouts = {}
+        return run_concurrently(
+            lambda url: self.fetch(url, timeouts.get(url, None), **kwargs),
+            urls, self._workers, self.log, self._guid)
+
+
+class LookupCrawler(object, nllog.DoesLogging):
+    """
+    Discovers topology services by crawling perfSONAR lookup services.
+
+    Starting from the bootstrap lookup services, every lookup service is
+    asked for the topology services and the other lookup services it
+    knows, at most workers at a time and up to depth levels away. The
+    discovered endpoints are cached in a JSON file for ttl seconds, for
+    the same bootstrap lookup services and depth only. A crawl that found
+    nothing or where a lookup service failed is not cached.
+    """
+
+    def __init__(self, lookup_services=None, **kwargs):
+        nllog.DoesLogging.__init__(self)
+        self._guid = uuid.uuid1()
+        if lookup_services is None:
+            lookup_services = settings.PS_LOOKUP_SERVICES
+        self._lookup_services = list(lookup_services)
+        self._timeout = kwargs.get("timeout", settings.PS_FETCH_TIMEOUT)
+        self._workers = kwargs.get("workers", settings.PS_FETCH_WORKERS)
+        self._depth = kwargs.get("depth", settings.PS_DISCOVERY_DEPTH)
+        self._cache_path = kwargs.get("cache_path", settings.PS_DISCOVERY_CACHE)
+        self._ttl = kwargs.get("ttl", settings.PS_DISCOVERY_TTL)
+
+    def query(self, url, condition):
+        """Returns the access points a lookup service lists for condition."""
+        request = urllib2.Request(url=url, data=make_envelope(LS_QUERY % condition),
+            headers={
+                'Content-type': 'text/xml; charset="UTF-8"',
+                'SOAPAction': 'http://ggf.org/ns/nmwg/base/2.0/message/',
+                'Accept-Encoding': 'gzip',
+            }
+        )
+        response = urllib2.urlopen(request, timeout=self._timeout)
+        stream = response
+        if response.info().get("Content-Encoding", "").lower() == "gzip":
+            stream = GzipStream(response)
+        access_points = []
+        try:
+            for event, element in etree.iterparse(stream, events=("end",), tag=ACCESS_POINT_TAG):
+                if element.text and element.text.strip():
+                    access_points.append(element.text.strip())
+                element.clear()
+        finally:
+            stream.close()
+        return access_points
+
+    def crawl(self, url):
+        return (self.query(url, LS_TOPOLOGY_CONDITION),
+                self.query(url, LS_LOOKUP_CONDITION))
+
+    def discover(self, refresh=False):
+        """Returns the sorted list of topology service access points."""
+        if not refresh:
+            cached = self._load()
+            if cached is not None:
+                return cached["topology_services"]
+
+        visited = set()
+        failed = set()
+        topology_services = set()
+        frontier = set(self._lookup_services)
+        for level in range(self._depth):
+            frontier -= visited
+            if not frontier:
+                break
+            visited |= frontier
+            results, errors = run_concurrently(self.crawl, sorted(frontier), self._workers)
+            for url, e in errors.iteritems():
+                self.log.error("lookup_failed", url=url, value=str(e), guid=self._guid)
+            failed.update(errors)
+            frontier = set()
+            for services, lookup_services in results.itervalues():
+                topology_services.update(services)
+                frontier.update(lookup_services)
+
+        discovered = {
+            "discovered": time.time(),
+            "bootstrap": self._bootstrap(),
+            "lookup_services": sorted(visited),
+            "failed": sorted(failed),
+            "topology_services": sorted(topology_services),
+        }
+        if topology_services and not failed:
+            self._save(discovered)
+        self.log.info("discover", lookup_services=len(visited), failed=len(failed),
+            topology_services=len(topology_services), guid=self._guid)
+        return discovered["topology_services"]
+
+    def _bootstrap(self):
+        return {"lookup_services": sorted(self._lookup_services), "depth": self._depth}
+
+    def _load(self):
+        if not self._cache_path:
+            return None
+        try:
+            with open(self._cache_path, 'r') as in_file:
+                cached = json.load(in_file)
+        except (IOError, ValueError):
+            return None
+        if time.time() - cached.get("discovered", 0) >= self._ttl:
+            return None
+        if cached.get("bootstrap", None) != self._bootstrap():
+            return None
+        return cached
+
+    def _save(self, discovered):
+        if not self._cache_path:
+            return
+        tmp_path = self._cache_path + ".tmp"
+        with open(tmp_path, 'w') as out_file:
+            json.dump(discovered, out_file, indent=2)
+        os.rename(tmp_path, self._cache_path)
+
+
+class TopologyDaemon(object, nllog.DoesLogging):
+    """
+    Polls topology services and pushes their topologies to UNIS.
+
+    endpoints is a list of urls, or a dict of url to its poll interval.
+    Every endpoint gets its own schedule, starting at a random offset in
+    its interval and moved by up to jitter times the interval on every
+    poll, so the services and UNIS see a flat load. A topology is encoded
+    only when its hash changed (see TopologyFetcher) and pushed only when
+    it differs from the last one pushed for that endpoint.
+    """
+
+    def __init__(self, endpoints, **kwargs):
+        nllog.DoesLogging.__init__(self)
+        self._guid = uuid.uuid1()
+        self._interval = kwargs.get("interval", settings.PS_POLL_INTERVAL)
+        self._jitter = kwargs.get("jitter", settings.PS_POLL_JITTER)
+        self._workers = kwargs.get("workers", settings.PS_POLL_WORKERS)
+        self._collection = kwargs.get("collection", "topologies")
+        self._fetcher = kwargs.get("fetcher", None)
+        if self._fetcher is None:
+            self._fetcher = TopologyFetcher(cache=TopologyCache())
+        self._client = kwargs.get("client", None)
+        if self._client is None:
+            self._client = UNISClient()
+        if not isinstance(endpoints, dict):
+            endpoints = dict((url, None) for url in endpoints)
+        self._intervals = {}
+        self._schedule = []
+        self._pushed = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        for url, interval in endpoints.iteritems():
+            self.add(url, interval)
+
+    def add(self, url, interval=None):
+        """Starts polling url, within one interval from now."""
+        if interval is None:
+            interval = self._interval
+        with self._condition:
+            if url in self._intervals:
+                return
+            self._intervals[url] = interval
+            heapq.heappush(self._schedule, (time.time() + random.uniform(0, interval), url))
+            self._condition.notify()
+
+    def poll(self, url):
+        """Fetches the topology of url and pushes it if it changed.
+        Returns True if it was pushed."""
+        try:
+            entry = self._fetcher.fetch_entry(url)
+        except Exception, e:
+            self.log.error("poll_failed", url=url, value=str(e), guid=self._guid)
+            return False
+        if self._pushed.get(url, None) == entry["topology_hash"]:
+            self.log.debug("poll.unchanged", url=url, guid=self._guid)
+            return False
+        try:
+            self._client.post(self._collection, entry["out"])
+        except UNISClientException, e:
+            self.log.error("push_failed", url=url, value=str(e), guid=self._guid)
+            return False
+        self._pushed[url] = entry["topology_hash"]
+        self.log.info("poll.pushed", url=url, topology_hash=entry["topology_hash"], guid=self._guid)
+        return True
+
+    def start(self):
+        for i in range(max(1, self._workers)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run_forever(self):
+        self.start()
+        try:
+            while self._threads:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _next_poll(self, url):
+        interval = self._intervals[url]
+        return time.time() + interval * (1 + random.uniform(-self._jitter, self._jitter))
+
+    def _work(self):
+        while True:
+            with self._condition:
+                url = None
+                while not self._stopped:
+                    if not self._schedule:
+                        self._condition.wait()
+                        continue
+                    due, url = self._schedule[0]
+                    delay = due - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._schedule)
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+            self.poll(url)
+            with self._condition:
+                heapq.heappush(self._schedule, (self._next_poll(url), url))
+                self._condition.notify()
+
+
+def run_concurrently(func, items, workers, log=None, guid=None):
+    """
+    Calls func on every item from at most workers threads. Returns two
+    dicts, item to result and item to the exception func raised.
+    """
+    results = {}
+    errors = {}
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = func(item)
+                with lock:
+                    results[item] = result
+            except Exception, e:
+                if log is not None:
+                    log.error("fetch_failed", item=item, value=str(e), guid=guid)
+                with lock:
+                    errors[item] = e
+
+    threads = [threading.Thread(target=work) for i in range(max(1, min(workers, pending.qsize())))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def fetch_topologies(urls, **kwargs):
+    """
+    Fetches and encodes the topologies of many TS services concurrently.
+    Accepts the TopologyFetcher options and a timeouts dict.
+    """
+    timeouts = kwargs.pop("timeouts", None)
+    return TopologyFetcher(**kwargs).fetch_all(urls, timeouts)
+
+
+def fetch_discovered_topologies(lookup_services=None, **kwargs):
+    """
+    Discovers the topology services known to the lookup services and
+    fetches their topologies. Accepts the fetch_topologies options and
+    a crawler dict of LookupCrawler options.
+    """
+    crawler = LookupCrawler(lookup_services, **kwargs.pop("crawler", {}))
+    return fetch_topologies(crawler.discover(), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Polls perfSONAR topology services and pushes changed topologies to UNIS"
+    )
+    parser.add_argument('urls', type=str, nargs='*',
+        help='Topology service access points.')
+    parser.add_argument('-d', '--discover', action='store_true',
+        help='Also poll the topology services known to the lookup services.')
+    parser.add_argument('-L', '--lookup-service', type=str, action='append', default=None,
+        help='Bootstrap lookup service (default settings.PS_LOOKUP_SERVICES).')
+    parser.add_argument('-i', '--interval', type=float, default=settings.PS_POLL_INTERVAL,
+        help='Seconds between polls of a service.')
+    parser.add_argument('-j', '--jitter', type=float, default=settings.PS_POLL_JITTER,
+        help='Fraction of the interval polls are moved at random.')
+    parser.add_argument('-w', '--workers', type=int, default=settings.PS_POLL_WORKERS,
+        help='Services polled at the same time.')
+    parser.add_argument('--unis-host', type=str, default=settings.UNIS_HOST,
+        help='UNIS URL.')
+    parser.add_argument('--unis-port', type=int, default=settings.UNIS_PORT,
+        help='UNIS port.')
+    parser.add_argument('--cache-dir', type=str, default=settings.PS_CACHE_DIR,
+        help='Directory of the topology cache.')
+    parser.add_argument('-l', '--log', type=str, default="unisencoder.log",
+        help='Log file.')
+    args = parser.parse_args()
+
+    setup_logger(args.log)
+    urls = list(args.urls)
+    if args.discover:
+        urls += LookupCrawler(args.lookup_service).discover()
+    if not urls:
+        parser.error("no topology services given or discovered")
+
+    # Polled topologies are never fresher than the poll interval, so
+    # the cache only provides validators and hashes
+    fetcher = TopologyFetcher(cache=TopologyCache(args.cache_dir, ttl=0))
+    daemon = TopologyDaemon(urls,
+        interval=args.interval,
+        jitter=args.jitter,
+        workers=args.workers,
+        fetcher=fetcher,
+        client=UNISClient(args.unis_host, args.unis_port),
+    )
+    daemon.run_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+'''
+Persistent registry of the URNs of encoded documents.
+
+Every document encoded with a registry records where each of its
+resources ended up: the document it belongs to, its JSON pointer and its
+id. References the decoders could not resolve inside one document, the
+relations.over of manifests (component ids of the advertisement) and the
+remoteLinkId of inter-domain links, are then resolved from the registry
+instead of re-encoding the related documents:
+
+    registry = URNRegistry("urns.db")
+    RSpec3Decoder().encode(ad, component_manager_id=cm, registry=registry)
+    RSpec3Decoder().encode(manifest, slice_urn=slice_urn, registry=registry)
+
+A reference into another document becomes "<document><pointer>", a
+reference into the same document a plain pointer.
+'''
+
+import sqlite3
+import threading
+import time
+from urllib import unquote
+
+import settings
+import model
+from output import is_mapping, is_resource, escape_pointer
+
+
+class URNRegistry(object):
+    """URN to (document, pointer, id) map kept in a SQLite file."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = settings.URN_REGISTRY_PATH
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS urns (
+                urn TEXT PRIMARY KEY,
+                document TEXT NOT NULL,
+                pointer TEXT NOT NULL,
+                id TEXT,
+                kind TEXT,
+                updated REAL)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS urns_document ON urns (document)")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def register(self, document, out):
+        """Records every resource of out as part of document."""
+        now = time.time()
+        rows = [(urn, document, pointer, resource_id, kind, now)
+                for urn, pointer, resource_id, kind in _resources(out, "#")]
+        with self._lock:
+            self._db.execute("DELETE FROM urns WHERE document = ?", (document,))
+            self._db.executemany("INSERT OR REPLACE INTO urns VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        return len(rows)
+
+    def lookup(self, urn):
+        """Returns {"document", "pointer", "id", "kind"} for urn, or None."""
+        with self._lock:
+            for candidate in _candidates(urn):
+                row = self._db.execute(
+                    "SELECT document, pointer, id, kind FROM urns WHERE urn = ?",
+                    (candidate,)).fetchone()
+                if row is not None:
+                    return dict(zip(("document", "pointer", "id", "kind"), row))
+        return None
+
+    def reference(self, urn, document=None):
+        """Returns the href of urn as seen from document, or None."""
+        entry = self.lookup(urn)
+        if entry is None:
+            return None
+        if entry["document"] == document:
+            return entry["pointer"]
+        return entry["document"] + entry["pointer"]
+
+    def resolve(self, out, document=None):
+        """
+        Rewrites the hrefs of out that are still bare URNs, in relations
+        and link endpoints, to references. Returns how many were resolved.
+        """
+        resolved = 0
+        for ref in _unresolved(out):
+            href = self.reference(ref["href"], document)
+            if href is not None:
+                ref["href"] = href
+                resolved += 1
+        return resolved
+
+
+def _candidates(urn):
+    candidates = [urn]
+    clean = unquote(urn).strip()
+    if clean != urn:
+        candidates.append(clean)
+    return candidates
+
+
+def _resources(obj, pointer):
+    """Yields (urn, pointer, id, kind) for the resources in obj."""
+    if isinstance(obj, list):
+        for position, value in enumerate(obj):
+            if isinstance(value, list) or is_mapping(value):
+                for row in _resources(value, "%s/%d" % (pointer, position)):
+                    yield row
+        return
+    if is_resource(obj) and obj.get("urn", None):
+        cls = model.resource_class(obj["$schema"])
+        kind = cls.__name__.lower() if cls is not None else None
+        yield obj["urn"], pointer, obj.get("id", None), kind
+    for key, value in obj.iteritems():
+        if isinstance(value, list) or is_mapping(value):
+            for row in _resources(value, pointer + "/" + escape_pointer(key)):
+                yield row
+
+
+def _unresolved(obj):
+    """Yields the {"href": ...} dicts of obj whose href is not a pointer."""
+    if isinstance(obj, list):
+        for value in obj:
+            for ref in _unresolved(value):
+                yield ref
+        return
+    if not is_mapping(obj):
+        return
+    href = obj.get("href", None)
+    if isinstance(href, basestring) and href.startswith("urn:"):
+        yield obj
+    for value in obj.itervalues():
+        if isinstance(value, list) or is_mapping(value):
+            for ref in _unresolved(value):
+                yield ref
@@ -13,6 +13,8 @@ SCHEMA_DIR = UNISENCODER_ROOT + 'schema' + os.sep
 RSPEC3_SCHEMA_DIR = SCHEMA_DIR + 'rspec' + os.sep + '3' + os.sep
 
 DEFAULT_EXNODE_DURATION = 3 # extent lifetime in HOURS
+EXNODE_COALESCE = False # upload extents in the compact form of extents.coalesce_extents
+EXNODE_STREAM_THRESHOLD = 16 * 1024 * 1024 # .xnd files of this many bytes are encoded while uploading
 ROOT_NAME = "Landsat"
 
 #XND_FILE_PATH = "/home/jemusser/exnodes" 
@@ -21,3 +23,51 @@ DISPATCH_LOG_PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'dispa
 UNIS_HOST = "http://dev.incntre.iu.edu"
 #UNIS_HOST = "http://localhost"
 UNIS_PORT = "8888"
+
+# Batched exnode uploads, a batch is posted when any limit is reached
+EXNODE_BATCH_SIZE = 100 # exnodes per POST
+EXNODE_BATCH_BYTES = 1024 * 1024 # encoded bytes per POST
+EXNODE_BATCH_LATENCY = 5 # max seconds an exnode waits in a batch
+
+# Uploads to UNIS are streamed with chunked transfer encoding
+UNIS_CHUNK_SIZE = 64 * 1024 # bytes per HTTP chunk
+UNIS_GZIP = False # gzip request bodies (Content-Encoding: gzip)
+UNIS_TIMEOUT = 30 # seconds to wait on a UNIS connection
+UNIS_KEEPALIVE = True # reuse one connection per thread across requests
+
+# Dispatcher metrics, None disables the endpoint / snapshot file
+METRICS_PORT = None # serve Prometheus text on http://0.0.0.0:PORT/metrics
+METRICS_SNAPSHOT_PATH = None # write JSON snapshots to this file
+METRICS_SNAPSHOT_INTERVAL = 10 # seconds between JSON snapshots
+
+# Encoding web service (unisencoder-server)
+WEBSERVER_PORT = 8080
+WEBSERVER_WORKERS = 4 # warm decoders kept per input type
+WEBSERVER_MAX_BODY = 64 * 1024 * 1024 # largest accepted XML document in bytes
+WEBSERVER_CACHE_SIZE = 128 # encoded responses kept in memory
+
+# perfSONAR topology service queries
+PS_FETCH_TIMEOUT = 60 # seconds per topology service
+PS_FETCH_WORKERS = 8 # services queried at the same time
+
+# On-disk cache of perfSONAR topology service responses
+PS_CACHE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'ps_cache'
+PS_CACHE_TTL = 300 # seconds a cached topology is used without asking the service
+PS_CACHE_MAX_BYTES = 256 * 1024 * 1024 # cache size before the oldest entries are evicted
+
+# perfSONAR lookup services crawled to discover topology services
+PS_LOOKUP_SERVICES = [] # bootstrap gLS/hLS access points
+PS_DISCOVERY_CACHE = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'ps_discovery.json'
+PS_DISCOVERY_TTL = 3600 # seconds the discovered endpoints are reused
+PS_DISCOVERY_DEPTH = 3 # levels of lookup services followed from the bootstrap list
+
+# Parallel encoding of one large document, encode(tree, processes=N)
+PARALLEL_CHUNKS = 4 # batches of nodes or domains handed to each process
+
+# Registry of the URNs of encoded documents (registry.URNRegistry)
+URN_REGISTRY_PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep + 'urns.db'
+
+# Topology daemon (unisencoder-ps), pushes changed topologies to UNIS
+PS_POLL_INTERVAL = 600 # seconds between polls of a topology service
+PS_POLL_JITTER = 0.1 # fraction of the interval each poll is moved at random
+PS_POLL_WORKERS = 4 # topology services polled at the same time
@@ -0,0 +1,125 @@
+'''
+Small documents shared by the encoder tests.
+'''
+
+from lxml import etree
+
+
+CM_URN = "urn:publicid:IDN+example.net+authority+cm"
+
+# Three nodes, two of them joined by a link
+ADVERTISEMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<rspec xmlns="http://www.geni.net/resources/rspec/3" type="advertisement"
+       generated="2012-03-26T10:00:00Z" expires="2012-03-26T11:00:00Z">
+  <node component_id="urn:publicid:IDN+example.net+node+pc1"
+        component_manager_id="urn:publicid:IDN+example.net+authority+cm"
+        component_name="pc1" exclusive="true">
+    <hardware_type name="pc"/>
+    <available now="true"/>
+    <interface component_id="urn:publicid:IDN+example.net+interface+pc1:eth0"/>
+  </node>
+  <node component_id="urn:publicid:IDN+example.net+node+pc2"
+        component_manager_id="urn:publicid:IDN+example.net+authority+cm"
+        component_name="pc2" exclusive="true">
+    <hardware_type name="pc"/>
+    <available now="false"/>
+    <interface component_id="urn:publicid:IDN+example.net+interface+pc2:eth0"/>
+  </node>
+  <node component_id="urn:publicid:IDN+example.net+node+vm1"
+        component_manager_id="urn:publicid:IDN+example.net+authority+cm"
+        component_name="vm1" exclusive="false">
+    <hardware_type name="pcvm"/>
+    <available now="true"/>
+    <interface component_id="urn:publicid:IDN+example.net+interface+vm1:eth0"/>
+  </node>
+  <link component_id="urn:publicid:IDN+example.net+link+pc1-pc2">
+    <component_manager name="urn:publicid:IDN+example.net+authority+cm"/>
+    <interface_ref component_id="urn:publicid:IDN+example.net+interface+pc1:eth0"/>
+    <interface_ref component_id="urn:publicid:IDN+example.net+interface+pc2:eth0"/>
+    <link_type name="lan"/>
+  </link>
+</rspec>
+"""
+
+SLICE_URN = "urn:publicid:IDN+example.net+slice+test"
+
+# A slice on pc1 and vm1 of ADVERTISEMENT
+MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<rspec xmlns="http://www.geni.net/resources/rspec/3" type="manifest"
+       generated="2012-03-26T10:05:00Z" expires="2012-03-27T10:05:00Z">
+  <node client_id="a" exclusive="true"
+        component_id="urn:publicid:IDN+example.net+node+pc1"
+        component_manager_id="urn:publicid:IDN+example.net+authority+cm"
+        sliver_id="urn:publicid:IDN+example.net+sliver+1">
+    <sliver_type name="raw-pc"/>
+    <interface client_id="a:if0" component_id="urn:publicid:IDN+example.net+interface+pc1:eth0"
+               sliver_id="urn:publicid:IDN+example.net+sliver+2"/>
+  </node>
+  <node client_id="b" exclusive="false"
+        component_id="urn:publicid:IDN+example.net+node+vm1"
+        component_manager_id="urn:publicid:IDN+example.net+authority+cm"
+        sliver_id="urn:publicid:IDN+example.net+sliver+3">
+    <sliver_type name="emulab-openvz"/>
+  </node>
+</rspec>
+"""
+
+# Two domains whose links point at each other
+PS_TOPOLOGY = """<?xml version="1.0" encoding="UTF-8"?>
+<nmtb:topology xmlns:nmtb="http://ogf.org/schema/network/topology/base/20070828/"
+    xmlns:ctrl="http://ogf.org/schema/network/topology/ctrlPlane/20080828/"
+    id="urn:ogf:network:topology">
+  <ctrl:domain id="urn:ogf:network:domain=a.example.net">
+    <ctrl:node id="urn:ogf:network:domain=a.example.net:node=r1">
+      <ctrl:address>10.0.0.1</ctrl:address>
+      <ctrl:port id="urn:ogf:network:domain=a.example.net:node=r1:port=xe-0">
+        <ctrl:capacity>10000000000</ctrl:capacity>
+        <ctrl:link id="urn:ogf:network:domain=a.example.net:node=r1:port=xe-0:link=1">
+          <ctrl:remoteLinkId>urn:ogf:network:domain=b.example.net:node=r2:port=xe-1:link=1</ctrl:remoteLinkId>
+          <ctrl:trafficEngineeringMetric>10</ctrl:trafficEngineeringMetric>
+        </ctrl:link>
+      </ctrl:port>
+    </ctrl:node>
+  </ctrl:domain>
+  <ctrl:domain id="urn:ogf:network:domain=b.example.net">
+    <ctrl:node id="urn:ogf:network:domain=b.example.net:node=r2">
+      <ctrl:address>10.0.1.1</ctrl:address>
+      <ctrl:port id="urn:ogf:network:domain=b.example.net:node=r2:port=xe-1">
+        <ctrl:capacity>10000000000</ctrl:capacity>
+        <ctrl:link id="urn:ogf:network:domain=b.example.net:node=r2:port=xe-1:link=1">
+          <ctrl:remoteLinkId>urn:ogf:network:domain=a.example.net:node=r1:port=xe-0:link=1</ctrl:remoteLinkId>
+          <ctrl:trafficEngineeringMetric>10</ctrl:trafficEngineeringMetric>
+        </ctrl:link>
+      </ctrl:port>
+    </ctrl:node>
+  </ctrl:domain>
+</nmtb:topology>
+"""
+
+
+def parse(text):
+    return etree.fromstring(text).getroottree()
+
+
+# Hardware type names long enough to be moved to shared definitions
+PC_HARDWARE = "dell-poweredge-r740-2x-xeon-gold-6130-192gb-10gbe-nvme"
+VM_HARDWARE = "emulab-xen-shared-host-dell-poweredge-r640-2x-xeon-silver"
+
+
+def with_hardware_types(text, hardware):
+    """
+    Parses an RSpec with the hardware types of the nodes named in the
+    hardware dict, by component_name, replaced by the listed names.
+    """
+    tree = parse(text)
+    ns = tree.getroot().nsmap[None]
+    for node in tree.getroot().iter("{%s}node" % ns):
+        names = hardware.get(node.get("component_name"), None)
+        if names is None:
+            continue
+        for element in node.findall("{%s}hardware_type" % ns):
+            node.remove(element)
+        for position, name in enumerate(names):
+            element = etree.Element("{%s}hardware_type" % ns, name=name)
+            node.insert(position, element)
+    return tree
@@ -0,0 +1,248 @@
+'''
+Tests of the decoders and the encoder command line.
+'''
+
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest2
+from StringIO import StringIO
+
+import mock
+
+from lxml import etree
+
+from unisencoder import decoder
+from unisencoder.benchmark import make_xnd_tree
+from unisencoder.decoder import ExnodeDecoder, ElementFilter, RSpec3Decoder, encode_options, \
+    serve_stdio
+from unisencoder.extents import without_lifetimes
+from unisencoder.test.documents import ADVERTISEMENT, PS_TOPOLOGY, CM_URN, parse
+
+
+class ServeStdioTest(unittest2.TestCase):
+
+    def serve(self, requests):
+        in_file = StringIO("".join(json.dumps(request) + "\n" for request in requests))
+        out_file = StringIO()
+        serve_stdio(in_file, out_file)
+        return [json.loads(line) for line in out_file.getvalue().splitlines()]
+
+    def test_encodes_each_request(self):
+        responses = self.serve([
+            {"id": 1, "type": "rspec3", "options": {"component_manager_id": CM_URN},
+             "payload": ADVERTISEMENT},
+            {"id": "b", "type": "ps", "options": {}, "payload": PS_TOPOLOGY},
+        ])
+        self.assertEqual([response["id"] for response in responses], [1, "b"])
+        self.assertEqual(responses[0]["result"],
+            json.loads(json.dumps(decoder.RSpec3Decoder().encode(parse(ADVERTISEMENT),
+                component_manager_id=CM_URN))))
+        self.assertEqual(len(responses[1]["result"]["domains"]), 2)
+
+    def test_errors_do_not_stop_the_loop(self):
+        in_file = StringIO("not json\n\n" + json.dumps(
+            {"id": 2, "type": "xml", "payload": "<a/>"}) + "\n" + json.dumps(
+            {"id": 3, "type": "rspec3", "payload": ADVERTISEMENT}) + "\n" + json.dumps(
+            {"id": 4, "type": "ps", "payload": PS_TOPOLOGY}) + "\n")
+        out_file = StringIO()
+        serve_stdio(in_file, out_file)
+        responses = [json.loads(line) for line in out_file.getvalue().splitlines()]
+        self.assertEqual(len(responses), 4)
+        self.assertIn("error", responses[0])
+        self.assertIn("Unknown input type", responses[1]["error"])
+        self.assertIn("component_manager_id", responses[2]["error"])
+        self.assertIn("result", responses[3])
+
+    def test_compact_option(self):
+        options = {"component_manager_id": CM_URN}
+        plain, compact = self.serve([
+            {"type": "rspec3", "options": options, "payload": ADVERTISEMENT},
+            {"type": "rspec3", "options": dict(options, compact=True), "payload": ADVERTISEMENT},
+        ])
+        self.assertEqual(compact["result"], plain["result"])
+
+    def test_decoders_are_kept_warm(self):
+        request = {"type": "ps", "payload": PS_TOPOLOGY}
+        with mock.patch.dict(decoder.DECODERS,
+                             {"ps": mock.Mock(wraps=decoder.PSDecoder)}):
+            responses = self.serve([request, request, request])
+            self.assertEqual(decoder.DECODERS["ps"].call_count, 1)
+        self.assertEqual(responses[0]["result"], responses[2]["result"])
+
+    def test_co_process(self):
+        # Answers each request before the next one is written
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        process = subprocess.Popen([sys.executable, "-m", "unisencoder.decoder", "--serve-stdio",
+            "--log", os.path.join(workdir, "unisencoder.log")],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for index in range(3):
+                process.stdin.write(json.dumps({"id": index, "type": "ps",
+                    "payload": PS_TOPOLOGY}) + "\n")
+                process.stdin.flush()
+                response = json.loads(process.stdout.readline())
+                self.assertEqual(response["id"], index)
+                self.assertIn("result", response)
+        finally:
+            process.stdin.close()
+            self.assertEqual(process.wait(), 0)
+
+
+class IterencodeTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def without_lifetimes(self, exnode):
+        exnode = dict(exnode)
+        exnode["extents"] = [without_lifetimes(extent) for extent in exnode["extents"]]
+        return exnode
+
+    def test_same_output_as_encode(self):
+        filename = make_xnd_tree(self.workdir, 1, 20)[0]
+        options = {"creation_time": 10, "modified_time": 20, "duration": 5, "parent": "dir"}
+        streamed = json.loads("".join(ExnodeDecoder().iterencode(filename, **options)))
+        encoded = ExnodeDecoder().encode(etree.parse(filename), **options)
+        self.assertEqual(self.without_lifetimes(streamed), self.without_lifetimes(encoded))
+        self.assertEqual(streamed["size"], 20 * 1024 * 1024)
+        self.assertEqual(len(streamed["extents"][0]["lifetimes"]), 1)
+
+    def test_yields_extents_as_they_are_read(self):
+        filename = make_xnd_tree(self.workdir, 1, 5)[0]
+        chunks = list(ExnodeDecoder().iterencode(open(filename, 'rb'), creation_time=0,
+                                                 modified_time=0, properties={"metadata": {"a": 1}}))
+        # The opening, one chunk per extent and the root fields
+        self.assertEqual(len(chunks), 7)
+        self.assertEqual(json.loads("".join(chunks))["properties"], {"metadata": {"a": 1}})
+
+    def test_no_mappings(self):
+        filename = make_xnd_tree(self.workdir, 1, 0)[0]
+        out = json.loads("".join(ExnodeDecoder().iterencode(filename, creation_time=0, modified_time=0)))
+        self.assertEqual(out["extents"], [])
+        self.assertEqual(out["size"], 0)
+
+
+class ParallelTest(unittest2.TestCase):
+    """Encoding the subtrees of a document in a pool gives the serial output."""
+
+    def encode(self, decoder_class, text, **kwargs):
+        with mock.patch.object(decoder.multiprocessing, "Pool", wraps=multiprocessing.Pool) as pool:
+            parallel = decoder_class().encode(parse(text), processes=2, **kwargs)
+            self.assertEqual(pool.call_count, 1)
+        return parallel, decoder_class().encode(parse(text), **kwargs)
+
+    def test_rspec(self):
+        parallel, serial = self.encode(decoder.RSpec3Decoder, ADVERTISEMENT,
+                                       component_manager_id=CM_URN)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(parallel["nodes"]), 3)
+
+    def test_rspec_options(self):
+        parallel, serial = self.encode(decoder.RSpec3Decoder, ADVERTISEMENT,
+                                       component_manager_id=CM_URN, shared_definitions=True,
+                                       canonical=True)
+        self.assertEqual(parallel, serial)
+
+    def test_ps(self):
+        parallel, serial = self.encode(decoder.PSDecoder, PS_TOPOLOGY)
+        self.assertEqual(parallel, serial)
+        # The remote links, encoded in other processes, are still pointers
+        link = parallel["domains"][0]["links"][0]
+        self.assertEqual(link["endpoints"]["sink"]["href"], "#/domains/1/ports/0")
+
+    def test_ps_canonical(self):
+        parallel, serial = self.encode(decoder.PSDecoder, PS_TOPOLOGY, canonical=True)
+        self.assertEqual(parallel, serial)
+
+
+class ElementFilterTest(unittest2.TestCase):
+
+    PC1 = "urn:publicid:IDN+example.net+node+pc1"
+
+    def element(self, name):
+        root = parse(ADVERTISEMENT).getroot()
+        return [child for child in root
+                if (child.get("component_id", None) or "").endswith("+" + name)][0]
+
+    def encode(self, **filters):
+        return RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                                      element_filter=ElementFilter(**filters))
+
+    def test_matches(self):
+        pc1, pc2, link = self.element("pc1"), self.element("pc2"), self.element("pc1-pc2")
+        self.assertTrue(ElementFilter().matches(pc1))
+        self.assertFalse(ElementFilter(kinds=["link"]).matches(pc1))
+        self.assertTrue(ElementFilter(kinds=["link"]).matches(link))
+        self.assertTrue(ElementFilter(urn_prefix="urn:publicid:IDN+example.net+node+").matches(pc1))
+        self.assertFalse(ElementFilter(urn_prefix="urn:publicid:IDN+example.net+node+").matches(link))
+        # Nodes name their manager in an attribute, links in a child element
+        self.assertTrue(ElementFilter(component_manager=CM_URN).matches(pc1))
+        self.assertTrue(ElementFilter(component_manager=CM_URN).matches(link))
+        self.assertFalse(ElementFilter(component_manager="urn:other").matches(pc1))
+        self.assertFalse(ElementFilter(available=True).matches(pc2))
+        self.assertTrue(ElementFilter(available=False).matches(pc2))
+        self.assertTrue(ElementFilter(available=True).matches(link))
+
+    def test_skipped_nodes(self):
+        out = self.encode(available=True)
+        self.assertEqual([node["name"] for node in out["nodes"]], ["pc1", "vm1"])
+        self.assertEqual([port["urn"] for port in out["ports"]],
+                         ["urn:publicid:IDN+example.net+interface+pc1:eth0",
+                          "urn:publicid:IDN+example.net+interface+vm1:eth0"])
+        # The link to the skipped pc2 keeps its URN instead of a pointer
+        self.assertEqual(out["links"][0]["endpoints"], [
+            {"href": "#/ports/0", "rel": "full"},
+            {"href": "urn:publicid:IDN+example.net+interface+pc2:eth0", "rel": "full"}])
+
+    def test_links_only(self):
+        out = self.encode(kinds=["link"])
+        self.assertNotIn("nodes", out)
+        self.assertEqual([endpoint["href"] for endpoint in out["links"][0]["endpoints"]],
+                         ["urn:publicid:IDN+example.net+interface+pc1:eth0",
+                          "urn:publicid:IDN+example.net+interface+pc2:eth0"])
+
+    def test_nodes_only(self):
+        out = self.encode(kinds=["node"], urn_prefix=self.PC1)
+        self.assertEqual([node["urn"] for node in out["nodes"]], [self.PC1])
+        self.assertNotIn("links", out)
+
+    def test_parallel(self):
+        kwargs = dict(component_manager_id=CM_URN, processes=2)
+        parallel = RSpec3Decoder().encode(parse(ADVERTISEMENT),
+                                          element_filter=ElementFilter(available=True), **kwargs)
+        self.assertEqual(parallel, self.encode(available=True))
+
+    def test_encode_options(self):
+        kwargs = encode_options("rspec3", {"kinds": "node,link", "available": "True",
+                                           "component_manager_id": CM_URN})
+        self.assertEqual(kwargs["component_manager_id"], CM_URN)
+        element_filter = kwargs["element_filter"]
+        self.assertEqual(element_filter.kinds, set(["node", "link"]))
+        self.assertIs(element_filter.available, True)
+        self.assertNotIn("element_filter", encode_options("ps", {"kinds": "node"}))
+
+    def test_command_line(self):
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        filename = os.path.join(workdir, "rspec.xml")
+        with open(filename, 'w') as out_file:
+            out_file.write(ADVERTISEMENT)
+        output = os.path.join(workdir, "out.json")
+        subprocess.check_call([sys.executable, "-m", "unisencoder.decoder", "-t", "rspec3",
+            "-m", CM_URN, "--log", os.path.join(workdir, "unisencoder.log"), "-o", output,
+            "--select-kind", "node", "--select-available", filename])
+        with open(output) as in_file:
+            out = json.load(in_file)
+        self.assertEqual([node["name"] for node in out["nodes"]], ["pc1", "vm1"])
+        self.assertNotIn("links", out)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,286 @@
+'''
+Tests of the exnode dispatcher against the in-process fake UNIS.
+'''
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest2
+
+import mock
+
+from unisencoder import settings
+from unisencoder import dispatcher
+from unisencoder.benchmark import make_xnd_tree
+from unisencoder.extents import without_lifetimes
+from unisencoder.fakeunis import FakeUNIS
+
+
+class DispatcherTestCase(unittest2.TestCase):
+    """Runs each test with its own .xnd tree, dispatch log and fake UNIS."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self._settings = dict((name, getattr(settings, name)) for name in
+            ("XND_FILE_PATH", "DISPATCH_LOG_PATH", "EXNODE_BATCH_SIZE", "EXNODE_STREAM_THRESHOLD"))
+        settings.XND_FILE_PATH = os.path.join(self.workdir, "xnd")
+        settings.DISPATCH_LOG_PATH = os.path.join(self.workdir, "dispatched_files.log")
+        self.unis = FakeUNIS().start()
+        self.dispatch = dispatcher.Dispatcher(host=self.unis.host, port=self.unis.port)
+
+    def tearDown(self):
+        self.dispatch._client.close()
+        self.unis.stop()
+        for name, value in self._settings.iteritems():
+            setattr(settings, name, value)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run_dispatch(self):
+        entries = dispatcher.read_dispatch_log()
+        dispatch_list = dispatcher.build_dispatch_list(dispatcher.create_file_list(), entries)
+        root_id = self.dispatch.CreateRemoteDirectory(settings.ROOT_NAME, None)
+        dispatcher.dispatch_files(self.dispatch, dispatch_list, entries, root_id)
+        dispatcher.write_dispatch_log(entries)
+        return entries
+
+    def touch(self, filenames):
+        later = time.time() + 10
+        for filename in filenames:
+            os.utime(filename, (later, later))
+
+
+class HashTest(DispatcherTestCase):
+
+    def test_hash_exnode_ignores_volatile_fields(self):
+        filename = make_xnd_tree(settings.XND_FILE_PATH, 1, 2)[0]
+        first = self.dispatch.EncodeFile(filename)
+        second = self.dispatch.EncodeFile(filename)
+        second["modified"] = first["modified"] + 100
+        second["parent"] = "elsewhere"
+        for extent in second["extents"]:
+            extent["lifetimes"] = [{"start": "2000-01-01 00:00:00", "end": "2000-01-01 03:00:00"}]
+        self.assertEqual(dispatcher.hash_exnode(first), dispatcher.hash_exnode(second))
+
+    def test_hash_exnode_changes_with_extents(self):
+        filename = make_xnd_tree(settings.XND_FILE_PATH, 1, 2)[0]
+        first = self.dispatch.EncodeFile(filename)
+        second = self.dispatch.EncodeFile(filename)
+        second["extents"][0]["size"] += 1
+        self.assertNotEqual(dispatcher.hash_exnode(first), dispatcher.hash_exnode(second))
+
+
+class DedupeTest(DispatcherTestCase):
+
+    def test_dispatch_log_records_hashes_and_ids(self):
+        make_xnd_tree(settings.XND_FILE_PATH, 3, 2)
+        entries = self.run_dispatch()
+        self.assertEqual(len(self.unis.files()), 3)
+        ids = set(exnode["id"] for exnode in self.unis.files())
+        reread = dispatcher.read_dispatch_log()
+        self.assertEqual(set(entry["id"] for entry in reread.values()), ids)
+        for filename, entry in reread.iteritems():
+            self.assertEqual(entry["content_hash"], dispatcher.hash_file(filename))
+            self.assertEqual(entry["content_hash"], entries[filename]["content_hash"])
+
+    def test_touched_files_are_not_uploaded_again(self):
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 3, 2)
+        self.run_dispatch()
+        before = dict((exnode["id"], exnode) for exnode in self.unis.files())
+
+        self.touch(filenames)
+        entries = self.run_dispatch()
+        after = dict((exnode["id"], exnode) for exnode in self.unis.files())
+        self.assertEqual(set(after), set(before))
+        for filename in filenames:
+            entry = entries[filename]
+            self.assertEqual(entry["modified"], int(os.stat(filename).st_mtime))
+            exnode = after[entry["id"]]
+            self.assertEqual(exnode["modified"], entry["modified"])
+            # The PUT replaced the exnode, nothing but its time changed
+            self.assertEqual(exnode["extents"], before[entry["id"]]["extents"])
+            self.assertEqual(exnode["name"], before[entry["id"]]["name"])
+
+    def test_same_encoding_is_not_uploaded_again(self):
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 2, 2)
+        self.run_dispatch()
+        with open(filenames[0], 'a') as out_file:
+            out_file.write("\n")
+        self.touch(filenames)
+        entries = self.run_dispatch()
+        self.assertEqual(len(self.unis.files()), 2)
+        self.assertEqual(entries[filenames[0]]["content_hash"], dispatcher.hash_file(filenames[0]))
+
+    def test_changed_files_are_uploaded(self):
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 2, 2)
+        self.run_dispatch()
+        make_xnd_tree(settings.XND_FILE_PATH, 2, 3)
+        self.touch(filenames)
+        self.run_dispatch()
+        self.assertEqual(len(self.unis.files()), 4)
+
+    def test_update_modified_of_unknown_exnode(self):
+        self.assertFalse(self.dispatch.UpdateModified("missing", 10))
+
+    def test_failed_directories_are_retried(self):
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 2, 2)
+        create = self.dispatch.CreateRemoteDirectory
+        # Only the root directory can be created
+        failing = lambda name, parent: None if parent is not None else create(name, parent)
+        # Streamed first, then batched
+        for threshold in (0, self._settings["EXNODE_STREAM_THRESHOLD"]):
+            settings.EXNODE_STREAM_THRESHOLD = threshold
+            with mock.patch.object(self.dispatch, "CreateRemoteDirectory", side_effect=failing):
+                entries = self.run_dispatch()
+            self.assertEqual(entries, {})
+            self.assertEqual(self.unis.files(), [])
+        self.assertEqual(self.dispatch.metrics.get("files_failed", reason="directory"), 4)
+
+        entries = self.run_dispatch()
+        self.assertEqual(sorted(entries), sorted(filenames))
+        self.assertEqual(len(self.unis.files()), 2)
+        for exnode in self.unis.files():
+            self.assertIsNotNone(exnode["parent"])
+
+
+class StreamTest(DispatcherTestCase):
+
+    def test_large_files_are_streamed(self):
+        settings.EXNODE_STREAM_THRESHOLD = 0
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 2, 4)
+        entries = self.run_dispatch()
+        for filename in filenames:
+            self.assertEqual(entries[filename]["encoded_hash"], "")
+            exnode = self.unis.get_exnode(entries[filename]["id"])
+            encoded = self.dispatch.EncodeFile(filename)
+            self.assertEqual([without_lifetimes(extent) for extent in exnode["extents"]],
+                             [without_lifetimes(extent) for extent in encoded["extents"]])
+            self.assertEqual(exnode["size"], encoded["size"])
+            self.assertEqual(exnode["name"], encoded["name"])
+
+        # Streamed files are still skipped while their content is unchanged
+        self.touch(filenames)
+        self.run_dispatch()
+        self.assertEqual(len(self.unis.files()), 2)
+
+
+class RenewTest(DispatcherTestCase):
+
+    def test_renew_dispatched(self):
+        make_xnd_tree(settings.XND_FILE_PATH, 2, 3)
+        entries = self.run_dispatch()
+        before = dict((exnode["id"], exnode) for exnode in self.unis.files())
+        failed = dispatcher.renew_dispatched(self.dispatch, entries, duration = 10)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.dispatch.metrics.get("exnodes_renewed"), 2)
+        for exnode in self.unis.files():
+            old = before[exnode["id"]]
+            # The PUT kept everything but the lifetimes
+            for key in ("name", "parent", "modified", "size", "mode"):
+                self.assertEqual(exnode[key], old[key])
+            self.assertEqual([without_lifetimes(extent) for extent in exnode["extents"]],
+                             [without_lifetimes(extent) for extent in old["extents"]])
+            for extent in exnode["extents"]:
+                start, end = [datetime.datetime.strptime(extent["lifetimes"][0][name], "%Y-%m-%d %H:%M:%S")
+                              for name in ("start", "end")]
+                self.assertEqual(end - start, datetime.timedelta(hours = 10))
+
+    def test_renew_unknown_exnode(self):
+        entries = {"gone.xnd": {"id": "missing"}, "new.xnd": {"id": None}}
+        self.assertEqual(dispatcher.renew_dispatched(self.dispatch, entries), ["gone.xnd"])
+
+
+class RecordingDispatch(object):
+    """Stands in for a Dispatcher, recording the batches it is given."""
+
+    def __init__(self, reject=()):
+        self.metrics = dispatcher.Metrics()
+        self.batches = []
+        self.singles = []
+        self._reject = reject
+
+    def DispatchBatch(self, documents):
+        self.batches.append(documents)
+        if self._reject is None:
+            return None
+        return [None if index in self._reject else "id%d" % index
+                for index in range(len(documents))]
+
+    def PostExnode(self, data):
+        self.singles.append(data)
+        return "single"
+
+
+class BatcherTest(unittest2.TestCase):
+
+    def make(self, dispatch, **kwargs):
+        self.created = []
+        kwargs.setdefault("max_size", 100)
+        kwargs.setdefault("max_bytes", 1024 * 1024)
+        kwargs.setdefault("max_latency", 60)
+        return dispatcher.ExnodeBatcher(dispatch,
+            lambda key, exnode_id: self.created.append((key, exnode_id)), **kwargs)
+
+    def test_flushes_when_full(self):
+        dispatch = RecordingDispatch()
+        batcher = self.make(dispatch, max_size=3)
+        for index in range(7):
+            batcher.add(index, {"name": index})
+        self.assertEqual([len(batch) for batch in dispatch.batches], [3, 3])
+        self.assertEqual(len(batcher), 1)
+        batcher.flush()
+        self.assertEqual([len(batch) for batch in dispatch.batches], [3, 3, 1])
+        self.assertEqual([key for key, exnode_id in self.created], range(7))
+
+    def test_flushes_on_bytes(self):
+        dispatch = RecordingDispatch()
+        batcher = self.make(dispatch, max_bytes=50)
+        batcher.add("a", {"name": "x" * 30})
+        self.assertEqual(dispatch.batches, [])
+        batcher.add("b", {"name": "x" * 30})
+        self.assertEqual(len(dispatch.batches), 1)
+
+    def test_flushes_on_latency(self):
+        dispatch = RecordingDispatch()
+        batcher = self.make(dispatch, max_latency=0)
+        batcher.add("a", {"name": "a"})
+        self.assertEqual(len(dispatch.batches), 1)
+
+    def test_batch_is_a_json_array_post(self):
+        unis = FakeUNIS().start()
+        try:
+            dispatch = dispatcher.Dispatcher(host=unis.host, port=unis.port)
+            batcher = self.make(dispatch)
+            for index in range(5):
+                batcher.add(index, {"name": "f%d" % index, "mode": "file"})
+            batcher.flush()
+            dispatch._client.close()
+        finally:
+            unis.stop()
+        self.assertEqual(unis.request_count, 1)
+        self.assertEqual(sorted(exnode["name"] for exnode in unis.files()),
+                         ["f%d" % index for index in range(5)])
+        self.assertEqual(len(set(exnode_id for key, exnode_id in self.created)), 5)
+
+    def test_rejected_exnodes_are_posted_alone(self):
+        dispatch = RecordingDispatch(reject=[1])
+        batcher = self.make(dispatch)
+        for index in range(3):
+            batcher.add(index, {"name": index})
+        batcher.flush()
+        self.assertEqual(len(dispatch.singles), 1)
+        self.assertEqual(sorted(self.created), [(0, "id0"), (1, "single"), (2, "id2")])
+
+    def test_rejected_batch_is_posted_one_by_one(self):
+        dispatch = RecordingDispatch(reject=None)
+        batcher = self.make(dispatch)
+        for index in range(3):
+            batcher.add(index, {"name": index})
+        batcher.flush()
+        self.assertEqual(len(dispatch.singles), 3)
+        self.assertEqual(len(self.created), 3)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,244 @@
+'''
+Tests of the extent index and the compact extent forms.
+'''
+
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest2
+
+from lxml import etree
+
+from unisencoder import dispatcher
+from unisencoder.benchmark import make_xnd_tree
+from unisencoder.decoder import ExnodeDecoder
+from unisencoder.extents import ExtentIndex, coalesce_extents, expand_extents, \
+    without_lifetimes, make_lifetimes, renew_lifetimes, renew_files
+
+
+def make_extent(offset, size, depot=0, lifetimes=None):
+    caps = "ibp://depot%d.example.org:6714/0#%d-%d" % (depot, offset, size)
+    extent = {
+        "offset": offset,
+        "size": size,
+        "location": "ibp://",
+        "mapping": {"read": caps + "/READ", "write": caps + "/WRITE", "manage": caps + "/MANAGE"},
+    }
+    if lifetimes is not None:
+        extent["lifetimes"] = lifetimes
+    return extent
+
+
+class ExtentsTestCase(unittest2.TestCase):
+    """Runs each test in its own directory."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def encode_xnd(self, extents, **kwargs):
+        """Encodes a synthetic exnode of extents 1 MB mappings on 4 depots."""
+        filename = make_xnd_tree(self.workdir, 1, extents)[0]
+        decoder = ExnodeDecoder()
+        out = decoder.encode(etree.parse(filename), creation_time=0, modified_time=0, **kwargs)
+        return decoder, out
+
+
+class ExtentIndexTest(ExtentsTestCase):
+
+    def test_covering(self):
+        rand = random.Random(7)
+        extents = []
+        for i in range(300):
+            offset = rand.randrange(0, 10000)
+            extents.append(make_extent(offset, rand.randrange(1, 500), i % 3))
+        extents.append(make_extent(extents[0]["offset"], extents[0]["size"], 5))
+        index = ExtentIndex.from_extents(extents)
+        for i in range(200):
+            start = rand.randrange(-100, 11000)
+            end = start + rand.randrange(0, 800)
+            expected = sorted(position for position, extent in enumerate(extents)
+                              if extent["offset"] < end and extent["offset"] + extent["size"] > start
+                              and end > start)
+            found = index.covering(start, end)
+            self.assertEqual(sorted(p for offset, size, positions in found for p in positions),
+                             expected)
+            self.assertEqual([offset for offset, size, positions in found],
+                             sorted(offset for offset, size, positions in found))
+
+    def test_replicas_are_grouped(self):
+        extents = [make_extent(0, 10, 0), make_extent(10, 10, 0), make_extent(0, 10, 1)]
+        index = ExtentIndex.from_extents(extents)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.covering(5, 6), [(0, 10, [0, 2])])
+        self.assertEqual(index.covering(0, 20), [(0, 10, [0, 2]), (10, 10, [1])])
+        self.assertEqual(index.covering(20, 30), [])
+        self.assertEqual(index.covering(5, 5), [])
+
+    def test_long_extent_before_short_ones(self):
+        extents = [make_extent(0, 1000), make_extent(10, 5), make_extent(20, 5)]
+        index = ExtentIndex.from_extents(extents)
+        self.assertEqual([positions for offset, size, positions in index.covering(500, 501)], [[0]])
+
+    def test_gaps_and_size(self):
+        extents = [make_extent(10, 10), make_extent(15, 10), make_extent(40, 10)]
+        index = ExtentIndex.from_extents(extents)
+        self.assertEqual(index.gaps(), [(0, 10), (25, 40)])
+        self.assertEqual(index.size, 50)
+        self.assertEqual(ExtentIndex().size, 0)
+        self.assertEqual(ExtentIndex().covering(0, 10), [])
+
+    def test_save_and_load(self):
+        extents = [make_extent(offset * 100, 100, offset % 2) for offset in range(50)]
+        extents += [make_extent(0, 100, 3)]
+        index = ExtentIndex.from_extents(extents)
+        filename = os.path.join(self.workdir, "file.idx")
+        index.save(filename)
+        loaded = ExtentIndex.load(filename)
+        for name in ("offsets", "lengths", "starts", "positions"):
+            self.assertEqual(getattr(loaded, name), getattr(index, name))
+        self.assertEqual(loaded.covering(50, 250), index.covering(50, 250))
+
+    def test_load_other_version(self):
+        filename = os.path.join(self.workdir, "file.idx")
+        ExtentIndex.from_extents([make_extent(0, 10)]).save(filename)
+        with open(filename, 'rb') as in_file:
+            header = json.loads(in_file.readline())
+            rest = in_file.read()
+        header["version"] += 1
+        with open(filename, 'wb') as out_file:
+            out_file.write(json.dumps(header) + "\n" + rest)
+        with self.assertRaises(ValueError):
+            ExtentIndex.load(filename)
+
+    def test_decoder_builds_the_index(self):
+        decoder, out = self.encode_xnd(8, extent_index=True)
+        self.assertEqual(len(decoder.extent_index), 8)
+        self.assertEqual(decoder.extent_index.size, 8 * 1024 * 1024)
+        offset, size, positions = decoder.extent_index.covering(3 * 1024 * 1024, 3 * 1024 * 1024 + 1)[0]
+        self.assertEqual(out["extents"][positions[0]]["offset"], 3 * 1024 * 1024)
+        decoder.reset()
+        self.assertEqual(decoder.extent_index, None)
+
+
+class CoalesceTest(ExtentsTestCase):
+
+    def setUp(self):
+        ExtentsTestCase.setUp(self)
+        self.lifetimes = make_lifetimes(3)
+        # Four contiguous extents held by two depots each, and a lone one
+        self.extents = [make_extent(offset * 10, 10, depot, self.lifetimes)
+                        for depot in (0, 1) for offset in range(4)]
+        self.extents.append(make_extent(100, 10, 2, self.lifetimes))
+
+    def sort_key(self, extent):
+        return (extent["offset"], extent["mapping"]["read"])
+
+    def test_coalesce(self):
+        out = coalesce_extents(self.extents)
+        self.assertEqual([(extent["offset"], extent["size"]) for extent in out], [(0, 40), (100, 10)])
+        self.assertEqual([replica["depot"] for replica in out[0]["replicas"]],
+                         ["depot0.example.org:6714", "depot1.example.org:6714"])
+        self.assertEqual([len(replica["mappings"]) for replica in out[0]["replicas"]], [4, 4])
+        self.assertEqual(out[0]["lifetimes"], self.lifetimes)
+        self.assertEqual(out[0]["location"], "ibp://")
+        for replica in out[0]["replicas"]:
+            for mapping in replica["mappings"]:
+                self.assertNotIn("lifetimes", mapping)
+                self.assertNotIn("offset", mapping)
+
+    def test_expand_restores_the_extents(self):
+        original = json.loads(json.dumps(self.extents))
+        expanded = expand_extents(coalesce_extents(self.extents))
+        self.assertEqual(sorted(expanded, key=self.sort_key), sorted(original, key=self.sort_key))
+        self.assertEqual(self.extents, original)
+
+    def test_fields_that_differ_stay_on_the_mappings(self):
+        self.extents[1]["lifetimes"] = make_lifetimes(6)
+        out = coalesce_extents(self.extents)
+        self.assertNotIn("lifetimes", out[0])
+        self.assertEqual(out[0]["replicas"][0]["mappings"][1]["lifetimes"], self.extents[1]["lifetimes"])
+        self.assertEqual(sorted(expand_extents(out), key=self.sort_key),
+                         sorted(self.extents, key=self.sort_key))
+
+    def test_gap_splits_replicas(self):
+        extents = [make_extent(0, 10), make_extent(20, 10)]
+        out = coalesce_extents(extents)
+        self.assertEqual([(extent["offset"], extent["size"]) for extent in out], [(0, 10), (20, 10)])
+
+    def test_plain_extents_pass_through_expand(self):
+        self.assertEqual(expand_extents(self.extents[:1]), self.extents[:1])
+
+    def test_decoder(self):
+        decoder, plain = self.encode_xnd(8)
+        decoder, coalesced = self.encode_xnd(8, coalesce=True, extent_index=True)
+        self.assertEqual(sorted(without_lifetimes(extent) for extent in expand_extents(coalesced["extents"])),
+                         sorted(without_lifetimes(extent) for extent in plain["extents"]))
+        # The index is built over the coalesced descriptors
+        self.assertEqual(len(decoder.extent_index), len(coalesced["extents"]))
+
+    def test_striped_exnode_does_not_grow(self):
+        # Round-robin stripes are neither contiguous on a depot nor replicated
+        decoder, plain = self.encode_xnd(8)
+        decoder, coalesced = self.encode_xnd(8, coalesce=True)
+        self.assertFalse(any("replicas" in extent for extent in coalesced["extents"]))
+        self.assertLessEqual(len(json.dumps(coalesced)), len(json.dumps(plain)))
+
+    def test_lone_extent_stays_plain(self):
+        out = coalesce_extents(self.extents)
+        self.assertEqual(out[1], self.extents[-1])
+        self.assertEqual(expand_extents(out[1:]), self.extents[-1:])
+
+    def test_hash_ignores_lifetimes(self):
+        exnode = {"name": "a", "extents": coalesce_extents(self.extents)}
+        renewed = json.loads(json.dumps(exnode))
+        for extent in renewed["extents"]:
+            extent["lifetimes"] = make_lifetimes(100)
+            for replica in extent.get("replicas", []):
+                for mapping in replica["mappings"]:
+                    mapping["lifetimes"] = make_lifetimes(1)
+        self.assertEqual(dispatcher.hash_exnode(exnode), dispatcher.hash_exnode(renewed))
+        renewed["extents"][0]["replicas"][0]["mappings"][0]["size"] += 1
+        self.assertNotEqual(dispatcher.hash_exnode(exnode), dispatcher.hash_exnode(renewed))
+
+
+class RenewTest(ExtentsTestCase):
+
+    def test_renew_plain_and_coalesced(self):
+        start = datetime.datetime(2020, 1, 1)
+        extents = [make_extent(offset * 10, 10, depot, make_lifetimes(3))
+                   for depot in (0, 1) for offset in range(2)]
+        plain = {"extents": json.loads(json.dumps(extents))}
+        coalesced = {"extents": coalesce_extents(extents)}
+        coalesced["extents"][0]["replicas"][0]["mappings"][0]["lifetimes"] = make_lifetimes(1)
+        expected = [{"start": "2020-01-01 00:00:00", "end": "2020-01-01 05:00:00"}]
+        for exnode in (plain, coalesced):
+            renew_lifetimes(exnode, 5, start)
+            for extent in exnode["extents"]:
+                self.assertEqual(extent["lifetimes"], expected)
+        for replica in coalesced["extents"][0]["replicas"]:
+            for mapping in replica["mappings"]:
+                self.assertNotIn("lifetimes", mapping)
+
+    def test_renew_files(self):
+        decoder, exnode = self.encode_xnd(2)
+        good = os.path.join(self.workdir, "good.json")
+        bad = os.path.join(self.workdir, "bad.json")
+        with open(good, 'w') as out_file:
+            json.dump(exnode, out_file)
+        with open(bad, 'w') as out_file:
+            out_file.write("{")
+        missing = os.path.join(self.workdir, "missing.json")
+        failed = renew_files([good, bad, missing], 1, datetime.datetime(2020, 1, 1))
+        self.assertEqual(failed, [bad, missing])
+        with open(good) as in_file:
+            renewed = json.load(in_file)
+        self.assertEqual(renewed["extents"][0]["lifetimes"][0]["end"], "2020-01-01 01:00:00")
+        self.assertEqual(renewed["name"], exnode["name"])
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,94 @@
+'''
+Tests of the fake UNIS and the dispatcher benchmark built on it.
+'''
+
+import threading
+import time
+import unittest2
+
+from unisencoder import benchmark
+from unisencoder.fakeunis import FakeUNIS
+from unisencoder.unisclient import UNISClient, json_chunks
+
+
+def wait_for_threads(count, timeout=1):
+    """Returns the number of live threads once it drops to count or the
+    timeout passes, handler threads still close their socket after finish."""
+    deadline = time.time() + timeout
+    while threading.active_count() > count and time.time() < deadline:
+        time.sleep(0.01)
+    return threading.active_count()
+
+
+class FakeUNISTest(unittest2.TestCase):
+
+    def test_bytes_received_from_concurrent_clients(self):
+        unis = FakeUNIS().start()
+        sizes = []
+        def post(index):
+            client = UNISClient(host=unis.host, port=unis.port, gzip=False)
+            doc = {"name": "f%d" % index, "mode": "file"}
+            for _ in range(20):
+                client.post("exnodes", doc)
+                sizes.append(len("".join(json_chunks(doc))))
+            client.close()
+        try:
+            threads = [threading.Thread(target=post, args=(index,)) for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            unis.stop()
+        self.assertEqual(unis.request_count, 160)
+        self.assertEqual(unis.bytes_received, sum(sizes))
+
+    def test_stop_closes_kept_alive_connections(self):
+        before = threading.active_count()
+        unis = FakeUNIS().start()
+        client = UNISClient(host=unis.host, port=unis.port)
+        client.post("exnodes", {"name": "a", "mode": "file"})
+        # The client keeps its connection open, its handler is still waiting
+        self.assertEqual(len(unis._connections), 1)
+        start = time.time()
+        unis.stop()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(unis._connections), 0)
+        self.assertEqual(wait_for_threads(before), before)
+        client.close()
+
+    def test_put_replaces_the_exnode(self):
+        unis = FakeUNIS().start()
+        client = UNISClient(host=unis.host, port=unis.port)
+        try:
+            created = client.post("exnodes", {"name": "a", "mode": "file", "size": 1})
+            client.put("exnodes/%s" % created["id"], {"name": "b", "mode": "file"})
+            exnode = client.get("exnodes/%s" % created["id"])
+        finally:
+            client.close()
+            unis.stop()
+        self.assertEqual(exnode["name"], "b")
+        self.assertNotIn("size", exnode)
+        self.assertEqual(exnode["selfRef"], created["selfRef"])
+
+
+class BenchmarkTest(unittest2.TestCase):
+
+    def test_latencies_per_operation(self):
+        before = threading.active_count()
+        result = benchmark.run(30, 2, batch_size=10)
+        self.assertEqual(result["uploaded"], 30)
+        self.assertEqual(result["latencies"]["DispatchBatch"][0], 3)
+        self.assertIn("CreateRemoteDirectory", result["latencies"])
+        self.assertNotIn("UpdateModified", result["latencies"])
+        for count, p50, p99 in result["latencies"].values():
+            self.assertLessEqual(p50, p99)
+        self.assertEqual(wait_for_threads(before), before)
+
+    def test_failed_directories_are_not_uploads(self):
+        result = benchmark.run(20, 1, error_rate=1.0, batch_size=10)
+        self.assertEqual((result["uploaded"], result["failed"]), (0, 20))
+
+
+if __name__ == '__main__':
+    unittest2.main()
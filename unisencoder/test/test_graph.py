@@ -0,0 +1,125 @@
+'''
+Tests of the graph view of encoded topologies.
+'''
+
+import unittest2
+
+from unisencoder import model
+from unisencoder.decoder import RSpec3Decoder, PSDecoder, UNISDecoder
+from unisencoder.graph import TopologyGraph, DEFAULT_METRIC
+from unisencoder.test.documents import ADVERTISEMENT, PS_TOPOLOGY, CM_URN, parse
+
+
+R1 = "urn:ogf:network:domain=a.example.net:node=r1"
+R2 = "urn:ogf:network:domain=b.example.net:node=r2"
+
+
+def make_topology(links):
+    """
+    A domain of nodes n0..nN with one port per link end. links is a list of
+    (source, sink, capacity, metric), capacity and metric may be None.
+    """
+    names = sorted(set(end for link in links for end in link[:2]))
+    out = {"$schema": UNISDecoder.SCHEMAS["domain"], "urn": "urn:test:domain",
+           "nodes": [], "ports": [], "links": []}
+    for name in names:
+        out["nodes"].append({"$schema": UNISDecoder.SCHEMAS["node"], "urn": "urn:test:" + name,
+                             "ports": []})
+    for index, (source, sink, capacity, metric) in enumerate(links):
+        endpoints = []
+        for end in (source, sink):
+            pointer = "#/ports/%d" % len(out["ports"])
+            out["ports"].append({"$schema": UNISDecoder.SCHEMAS["port"],
+                                 "urn": "urn:test:%s:%d" % (end, index)})
+            out["nodes"][names.index(end)]["ports"].append({"href": pointer, "rel": "full"})
+            endpoints.append({"href": pointer, "rel": "full"})
+        link = {"$schema": UNISDecoder.SCHEMAS["link"], "urn": "urn:test:link:%d" % index,
+                "directed": False, "endpoints": endpoints}
+        if capacity is not None:
+            link["capacity"] = capacity
+        if metric is not None:
+            link["properties"] = {"ctrlPlane": {"trafficEngineeringMetric": metric}}
+        out["links"].append(link)
+    return out
+
+
+class TopologyGraphTest(unittest2.TestCase):
+
+    def test_perfsonar_links_nested_in_ports(self):
+        graph = TopologyGraph(PSDecoder().encode(parse(PS_TOPOLOGY)))
+        r1, r2 = graph.resolve(R1), graph.resolve(R2)
+        self.assertEqual(graph.neighbors(R1), [r2])
+        self.assertEqual(graph.neighbors(R2), [r1])
+        self.assertEqual(graph.node_of(R1 + ":port=xe-0"), r1)
+        link = graph.resolve(R1 + ":port=xe-0:link=1")
+        self.assertEqual(graph.capacity(link), 10 ** 10)
+        self.assertEqual(graph.metric(link), 10)
+        cost, nodes, links = graph.shortest_path(R1, R2)
+        self.assertEqual((cost, nodes, links), (10, [r1, r2], [link]))
+
+    def test_rspec_advertisement(self):
+        graph = TopologyGraph(RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN))
+        pc1 = "urn:publicid:IDN+example.net+node+pc1"
+        vm1 = "urn:publicid:IDN+example.net+node+vm1"
+        self.assertEqual(graph.neighbors(pc1), [graph.resolve("urn:publicid:IDN+example.net+node+pc2")])
+        self.assertEqual(graph.neighbors(vm1), [])
+        self.assertFalse(graph.is_reachable(pc1, vm1))
+        self.assertIsNone(graph.shortest_path(pc1, vm1))
+        link = "urn:publicid:IDN+example.net+link+pc1-pc2"
+        self.assertIsNone(graph.capacity(link))
+        self.assertEqual(graph.metric(link), DEFAULT_METRIC)
+
+    def test_compact_output(self):
+        out = PSDecoder().encode(parse(PS_TOPOLOGY), compact=True)
+        self.assertIsInstance(out["domains"][0], model.Domain)
+        self.assertTrue(TopologyGraph(out).is_reachable(R1, R2))
+
+    def test_shortest_path_weights(self):
+        # a-b-d is short in hops and metric, a-c-d is wide
+        graph = TopologyGraph(make_topology([
+            ("a", "b", 10, 1), ("b", "d", 10, 1),
+            ("a", "c", 100, 5), ("c", "d", 100, 5),
+        ]))
+        a, b, c, d = [graph.resolve("urn:test:" + name) for name in "abcd"]
+        self.assertEqual(graph.shortest_path(a, d)[:2], (2, [a, b, d]))
+        self.assertEqual(graph.shortest_path(a, d, weight="hops")[0], 2)
+        self.assertEqual(graph.shortest_path(a, d, weight="capacity")[1], [a, c, d])
+        self.assertEqual(graph.shortest_path(a, d, min_capacity=50)[:2], (10, [a, c, d]))
+        self.assertIsNone(graph.shortest_path(a, d, min_capacity=1000))
+        self.assertEqual(graph.shortest_path(a, a), (0, [a], []))
+
+    def test_reachable(self):
+        graph = TopologyGraph(make_topology([("a", "b", 10, None), ("b", "c", 1, None),
+                                             ("d", "e", None, None)]))
+        a, b, c = [graph.resolve("urn:test:" + name) for name in "abc"]
+        self.assertEqual(graph.reachable("urn:test:a"), set([a, b, c]))
+        self.assertEqual(graph.reachable("urn:test:a", min_capacity=5), set([a, b]))
+        # Links of unknown capacity never fit a minimum
+        self.assertFalse(graph.is_reachable("urn:test:d", "urn:test:e", min_capacity=1))
+        self.assertTrue(graph.is_reachable("urn:test:d", "urn:test:e"))
+
+    def test_link_capacity_from_ports(self):
+        out = make_topology([("a", "b", None, None)])
+        out["ports"][0]["capacity"] = 100
+        out["ports"][1]["capacity"] = 40
+        graph = TopologyGraph(out)
+        self.assertEqual(graph.capacity("urn:test:link:0"), 40)
+        self.assertEqual(graph.capacity("urn:test:a:0"), 100)
+
+    def test_directed_links(self):
+        out = make_topology([("a", "b", None, None)])
+        out["links"][0]["directed"] = True
+        graph = TopologyGraph(out)
+        self.assertTrue(graph.is_reachable("urn:test:a", "urn:test:b"))
+        self.assertFalse(graph.is_reachable("urn:test:b", "urn:test:a"))
+
+    def test_unknown_names(self):
+        graph = TopologyGraph(make_topology([("a", "b", None, None)]))
+        with self.assertRaises(KeyError):
+            graph.neighbors("urn:test:missing")
+        with self.assertRaises(KeyError):
+            graph.capacity("urn:test:a")
+
+
+if __name__ == '__main__':
+    unittest2.main()
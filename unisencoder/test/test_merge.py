@@ -0,0 +1,223 @@
+'''
+Tests of merging encoded domains and of the manifest batches.
+'''
+
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest2
+
+from unisencoder.decoder import RSpec3Decoder, PSDecoder
+from unisencoder.merge import merge_domains, split_input, component_index, resolve_components, \
+    encode_manifests
+from unisencoder.output import resolve, hrefs
+from unisencoder.test.documents import ADVERTISEMENT, MANIFEST, PS_TOPOLOGY, CM_URN, \
+    SLICE_URN, PC_HARDWARE, VM_HARDWARE, parse, with_hardware_types
+
+
+NS = "{http://www.geni.net/resources/rspec/3}"
+
+
+def second_advertisement(hardware="xen"):
+    """ADVERTISEMENT with only new nodes vm2 and vm3 of a new hardware type."""
+    tree = parse(ADVERTISEMENT)
+    root = tree.getroot()
+    root.set("generated", "2012-03-26T10:30:00Z")
+    for element in list(root):
+        if element.get("component_name", None) != "vm1":
+            root.remove(element)
+    template = root[0]
+    for name in ("vm2", "vm3"):
+        node = copy.deepcopy(template)
+        node.set("component_id", "urn:publicid:IDN+example.net+node+" + name)
+        node.set("component_name", name)
+        node.find(NS + "hardware_type").set("name", hardware)
+        node.find(NS + "interface").set("component_id",
+                                        "urn:publicid:IDN+example.net+interface+%s:eth0" % name)
+        root.append(node)
+    root.remove(template)
+    return tree
+
+
+def ps_domain(index):
+    """PS_TOPOLOGY with only its index-th domain."""
+    tree = parse(PS_TOPOLOGY)
+    root = tree.getroot()
+    root.remove(root[1 - index])
+    return tree
+
+
+class MergeTest(unittest2.TestCase):
+
+    def check_references(self, merged):
+        """The ports of every node point at ports of merged."""
+        for domain in merged["domains"]:
+            for node in domain.get("nodes", []):
+                for href in hrefs(node.get("ports", None)):
+                    self.assertEqual(resolve(merged, href)["$schema"], RSpec3Decoder.SCHEMAS["port"])
+
+    def test_domains_and_cross_references(self):
+        merged = merge_domains([PSDecoder().encode(ps_domain(0)), PSDecoder().encode(ps_domain(1))],
+                               urn="urn:test:federation")
+        self.assertEqual(merged["urn"], "urn:test:federation")
+        self.assertEqual([domain["urn"] for domain in merged["domains"]],
+                         ["urn:ogf:network:domain=a.example.net", "urn:ogf:network:domain=b.example.net"])
+        self.check_references(merged)
+        # The remote end, a bare URN in the first input, points into the second
+        link = merged["domains"][0]["links"][0]
+        self.assertEqual(link["endpoints"]["sink"]["href"], "#/domains/1/ports/0")
+        self.assertEqual(link["relations"]["sibling"][0]["href"], "#/domains/1/links/0")
+
+    def test_duplicates_are_dropped(self):
+        merged = merge_domains([PSDecoder().encode(parse(PS_TOPOLOGY)),
+                                PSDecoder().encode(ps_domain(1))])
+        self.assertEqual(len(merged["domains"]), 2)
+        self.assertEqual([len(domain["nodes"]) for domain in merged["domains"]], [1, 1])
+        self.check_references(merged)
+
+    def test_repeated_domain_keeps_its_definitions(self):
+        tree = with_hardware_types(ADVERTISEMENT, {"pc1": [PC_HARDWARE], "pc2": [PC_HARDWARE]})
+        first = RSpec3Decoder().encode(tree, component_manager_id=CM_URN, shared_definitions=True)
+        second = RSpec3Decoder().encode(second_advertisement(VM_HARDWARE), component_manager_id=CM_URN,
+                                        shared_definitions=True)
+        conflicts = []
+        merged = merge_domains([first, second], conflicts=conflicts)
+        self.assertEqual(len(merged["domains"]), 1)
+        domain = merged["domains"][0]
+        self.assertEqual([node["name"] for node in domain["nodes"]], ["pc1", "pc2", "vm1", "vm2", "vm3"])
+        self.check_references(merged)
+        for node in domain["nodes"][3:]:
+            hardware = node["properties"]["geni"]["hardware_types"][0]["href"]
+            self.assertEqual(hardware, "#/domains/0/definitions/hardware_types/1")
+            self.assertEqual(resolve(merged, hardware), {"name": VM_HARDWARE})
+        hardware = domain["nodes"][0]["properties"]["geni"]["hardware_types"][0]["href"]
+        self.assertEqual(resolve(merged, hardware), {"name": PC_HARDWARE})
+        # The first copy of differing values is kept and the other reported
+        self.assertEqual(domain["properties"]["geni"]["generated"], "2012-03-26T10:00:00Z")
+        self.assertEqual(conflicts, [("#/domains/0/properties/geni/generated",
+                                      "2012-03-26T10:00:00Z", "2012-03-26T10:30:00Z")])
+
+    def test_new_keys_of_a_repeated_domain(self):
+        first = {"$schema": RSpec3Decoder.SCHEMAS["domain"], "urn": "urn:test:d", "nodes": []}
+        second = {"$schema": RSpec3Decoder.SCHEMAS["domain"], "urn": "urn:test:d",
+                  "nodes": [{"$schema": RSpec3Decoder.SCHEMAS["node"], "urn": "urn:test:n",
+                             "ports": [{"href": "#/ports/0", "rel": "full"}]}],
+                  "ports": [{"$schema": RSpec3Decoder.SCHEMAS["port"], "urn": "urn:test:p"}],
+                  "selfRef": "#/nodes/0", "extra": {"a": 1}}
+        merged = merge_domains([first, second])
+        domain = merged["domains"][0]
+        self.assertEqual(domain["extra"], {"a": 1})
+        self.assertEqual(domain["selfRef"], "#/domains/0/nodes/0")
+        self.check_references(merged)
+
+    def test_registry_references(self):
+        first = PSDecoder().encode(ps_domain(0))
+        second = PSDecoder().encode(ps_domain(1))
+        first["domains"][0]["links"][0]["endpoints"]["sink"]["href"] = "b#/domains/0/ports/0"
+        merged = merge_domains([second, first], documents=["b", "a"])
+        link = merged["domains"][1]["links"][0]
+        self.assertEqual(link["endpoints"]["sink"]["href"], "#/domains/0/ports/0")
+
+
+class ManifestBatchTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.advertisement = self.write("ad.xml", ADVERTISEMENT)
+        self.manifest = self.write("manifest.xml", MANIFEST)
+        self.ad = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN)
+
+    def write(self, name, text):
+        filename = os.path.join(self.workdir, name)
+        with open(filename, 'w') as out_file:
+            out_file.write(text)
+        return filename
+
+    def check_resolved(self, out):
+        for resource in out["nodes"] + out["ports"]:
+            href = resource["relations"]["over"][0]["href"]
+            self.assertTrue(href.startswith(CM_URN + "#/"), href)
+            self.assertEqual(resolve(self.ad, href[len(CM_URN):])["urn"],
+                             resource["properties"]["geni"]["component_id"])
+
+    def test_component_index(self):
+        index = component_index([self.ad])
+        self.assertEqual(index["urn:publicid:IDN+example.net+node+pc1"], CM_URN + "#/nodes/0")
+        self.assertEqual(component_index([self.ad], ["ad"])["urn:publicid:IDN+example.net+node+pc1"],
+                         "ad#/nodes/0")
+        with self.assertRaises(ValueError):
+            component_index([{"nodes": []}])
+
+    def test_resolve_components(self):
+        out = RSpec3Decoder().encode(parse(MANIFEST), slice_urn=SLICE_URN)
+        self.assertEqual(resolve_components(out, component_index([self.ad])), 3)
+        self.check_resolved(out)
+        # Already resolved references are left alone
+        self.assertEqual(resolve_components(out, {}), 0)
+
+    def test_unknown_components_stay_urns(self):
+        out = RSpec3Decoder().encode(parse(MANIFEST), slice_urn=SLICE_URN)
+        self.assertEqual(resolve_components(out, {}), 0)
+        self.assertEqual(out["nodes"][0]["relations"]["over"][0]["href"],
+                         "urn:publicid:IDN+example.net+node+pc1")
+
+    def test_encode_manifests(self):
+        other_slice = "urn:publicid:IDN+example.net+slice+other"
+        manifests = [(self.manifest, SLICE_URN), (self.manifest, other_slice, None)]
+        for processes in (1, 2):
+            outputs = encode_manifests([(self.advertisement, CM_URN)], manifests, processes)
+            self.assertEqual([out["urn"] for out in outputs], [SLICE_URN, other_slice])
+            for out in outputs:
+                self.check_resolved(out)
+
+    def test_given_index(self):
+        index = {"urn:publicid:IDN+example.net+node+pc1": "ad#/nodes/9"}
+        out = encode_manifests([], [(self.manifest, SLICE_URN)], 1, index=index)[0]
+        self.assertEqual(out["nodes"][0]["relations"]["over"][0]["href"], "ad#/nodes/9")
+        self.assertEqual(out["nodes"][1]["relations"]["over"][0]["href"],
+                         "urn:publicid:IDN+example.net+node+vm1")
+
+    def test_command_line(self):
+        manifest = self.write("slice=1.xml", MANIFEST)
+        output = os.path.join(self.workdir, "out.json")
+        subprocess.check_call([sys.executable, "-m", "unisencoder.merge", "-p", "1",
+            "--log", os.path.join(self.workdir, "unisencoder.log"), "-o", output,
+            "-a", self.advertisement + "=" + CM_URN, manifest + "=" + SLICE_URN])
+        with open(output) as in_file:
+            outputs = json.load(in_file)
+        self.assertEqual(len(outputs), 1)
+        self.check_resolved(outputs[0])
+
+
+class SplitInputTest(unittest2.TestCase):
+
+    def test_split_input(self):
+        self.assertEqual(split_input("ad.xml=" + CM_URN), ("ad.xml", CM_URN))
+        self.assertEqual(split_input("a=b.xml=" + CM_URN), ("a=b.xml", CM_URN))
+        self.assertEqual(split_input("a=b.xml"), ("a=b.xml", None))
+        self.assertEqual(split_input("ad.xml=urn:ogf:network:domain=a.example.net"),
+                         ("ad.xml", "urn:ogf:network:domain=a.example.net"))
+
+    def test_command_line(self):
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        filename = os.path.join(workdir, "site=1.xml")
+        with open(filename, 'w') as out_file:
+            out_file.write(ADVERTISEMENT)
+        output = os.path.join(workdir, "out.json")
+        subprocess.check_call([sys.executable, "-m", "unisencoder.merge", "-p", "1",
+            "--log", os.path.join(workdir, "unisencoder.log"), "-o", output,
+            filename + "=" + CM_URN])
+        with open(output) as in_file:
+            merged = json.load(in_file)
+        self.assertEqual(merged["domains"][0]["urn"], CM_URN)
+        self.assertEqual(len(merged["domains"][0]["nodes"]), 3)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,110 @@
+'''
+Tests of the dispatcher metrics registry.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+import urllib2
+
+from unisencoder import settings
+from unisencoder.benchmark import make_xnd_tree
+from unisencoder.metrics import Metrics
+from unisencoder.test.test_dispatcher import DispatcherTestCase
+
+
+class MetricsTest(unittest2.TestCase):
+
+    def test_counters_and_gauges(self):
+        metrics = Metrics()
+        metrics.inc("files_uploaded")
+        metrics.inc("files_uploaded", 2)
+        metrics.inc("files_skipped", reason="content")
+        metrics.set("queue_depth", 7, stage="encode")
+        self.assertEqual(metrics.get("files_uploaded"), 3)
+        self.assertEqual(metrics.get("files_skipped", reason="content"), 1)
+        self.assertEqual(metrics.get("files_skipped", reason="encoded"), None)
+        self.assertEqual(metrics.get("queue_depth", stage="encode"), 7)
+
+    def test_concurrent_increments(self):
+        metrics = Metrics()
+        def work():
+            for _ in range(1000):
+                metrics.inc("requests", method="POST")
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.get("requests", method="POST"), 8000)
+
+    def test_render(self):
+        metrics = Metrics(prefix="test")
+        metrics.inc("unis_requests", method="GET")
+        metrics.inc("unis_requests", method="POST")
+        metrics.set("queue_depth", 3)
+        metrics.observe("unis_request_seconds", 0.003)
+        metrics.observe("unis_request_seconds", 0.2)
+        lines = metrics.render().splitlines()
+        self.assertEqual(lines.count("# TYPE test_unis_requests_total counter"), 1)
+        self.assertIn('test_unis_requests_total{method="GET"} 1', lines)
+        self.assertIn('test_unis_requests_total{method="POST"} 1', lines)
+        self.assertIn("test_queue_depth 3", lines)
+        self.assertIn("# TYPE test_unis_request_seconds histogram", lines)
+        self.assertIn('test_unis_request_seconds_bucket{le="0.001"} 0', lines)
+        self.assertIn('test_unis_request_seconds_bucket{le="0.005"} 1', lines)
+        self.assertIn('test_unis_request_seconds_bucket{le="0.25"} 2', lines)
+        self.assertIn('test_unis_request_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("test_unis_request_seconds_count 2", lines)
+
+    def test_timer(self):
+        metrics = Metrics()
+        with metrics.timer("encode_seconds", stage="xnd"):
+            pass
+        histogram = metrics.snapshot()["histograms"]['encode_seconds{stage="xnd"}']
+        self.assertEqual(histogram["count"], 1)
+
+    def test_write_snapshot(self):
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        metrics = Metrics()
+        metrics.inc("files_uploaded", 5)
+        path = os.path.join(workdir, "metrics.json")
+        metrics.write_snapshot(path)
+        with open(path) as in_file:
+            snapshot = json.load(in_file)
+        self.assertEqual(snapshot["counters"], {"files_uploaded": 5})
+        self.assertEqual(os.listdir(workdir), ["metrics.json"])
+
+    def test_serve(self):
+        metrics = Metrics(prefix="test")
+        metrics.inc("files_uploaded")
+        server = metrics.serve(0, "127.0.0.1")
+        try:
+            body = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1]).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn("test_files_uploaded_total 1", body)
+
+
+class DispatchMetricsTest(DispatcherTestCase):
+
+    def test_dispatch_is_counted(self):
+        filenames = make_xnd_tree(settings.XND_FILE_PATH, 3, 2)
+        self.run_dispatch()
+        self.touch(filenames)
+        self.run_dispatch()
+        metrics = self.dispatch.metrics
+        self.assertEqual(metrics.get("files_uploaded"), 3)
+        self.assertEqual(metrics.get("files_skipped", reason="content"), 3)
+        self.assertEqual(metrics.get("queue_depth", stage="encode"), 0)
+        self.assertGreater(metrics.get("unis_requests", method="POST"), 0)
+        self.assertGreater(metrics.get("bytes_sent"), 0)
+
+
+if __name__ == '__main__':
+    unittest2.main()
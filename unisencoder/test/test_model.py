@@ -0,0 +1,106 @@
+'''
+Tests of the compact model and of the decoders' compact output.
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest2
+
+from unisencoder import model
+from unisencoder.decoder import RSpec3Decoder, PSDecoder, UNISDecoder
+from unisencoder.test.documents import ADVERTISEMENT, PS_TOPOLOGY, CM_URN, parse
+
+
+NODE_SCHEMA = UNISDecoder.SCHEMAS["node"]
+
+
+class ResourceTest(unittest2.TestCase):
+
+    def test_dict_api(self):
+        node = model.Node([("$schema", NODE_SCHEMA), ("id", "n1"), ("extra", 1)])
+        self.assertEqual(node["id"], "n1")
+        self.assertEqual(node["extra"], 1)
+        self.assertIn("$schema", node)
+        self.assertNotIn("ports", node)
+        self.assertEqual(node.get("ports", []), [])
+        self.assertEqual(sorted(node.keys()), ["$schema", "extra", "id"])
+        self.assertEqual(sorted(node.values()), [1, NODE_SCHEMA, "n1"])
+        self.assertEqual(len(node), 3)
+        node["ports"] = []
+        del node["extra"]
+        self.assertEqual(node, {"$schema": NODE_SCHEMA, "id": "n1", "ports": []})
+        with self.assertRaises(KeyError):
+            node["extra"]
+        with self.assertRaises(KeyError):
+            del node["name"]
+
+    def test_loads_builds_resources(self):
+        text = json.dumps({"$schema": UNISDecoder.SCHEMAS["domain"], "nodes": [
+            {"$schema": NODE_SCHEMA, "id": "n1", "properties": {"a": 1}}]})
+        out = model.loads(text)
+        self.assertIsInstance(out, model.Domain)
+        self.assertIsInstance(out["nodes"][0], model.Node)
+        self.assertEqual(type(out["nodes"][0]["properties"]), dict)
+        self.assertEqual(model.to_dict(out), json.loads(text))
+        self.assertEqual(type(model.to_dict(out)), dict)
+
+    def test_schema_is_interned(self):
+        first = model.loads(json.dumps({"$schema": NODE_SCHEMA}))
+        second = model.loads(json.dumps({"$schema": NODE_SCHEMA}))
+        self.assertIs(first["$schema"], second["$schema"])
+
+    def test_encoder(self):
+        text = json.dumps({"$schema": UNISDecoder.SCHEMAS["domain"], "nodes": [
+            {"$schema": NODE_SCHEMA, "id": "n1"}]}, sort_keys=True)
+        self.assertEqual(json.dumps(model.loads(text), cls=model.ModelEncoder, sort_keys=True), text)
+
+
+class CompactEncodeTest(unittest2.TestCase):
+
+    def test_rspec(self):
+        decoder = RSpec3Decoder()
+        plain = decoder.encode(parse(ADVERTISEMENT), component_manager_id=CM_URN)
+        compact = decoder.encode(parse(ADVERTISEMENT), component_manager_id=CM_URN, compact=True)
+        self.assertIsInstance(compact, model.Domain)
+        self.assertIsInstance(compact["nodes"][0], model.Node)
+        self.assertEqual(model.to_dict(compact), plain)
+
+    def test_ps(self):
+        decoder = PSDecoder()
+        plain = decoder.encode(parse(PS_TOPOLOGY))
+        compact = decoder.encode(parse(PS_TOPOLOGY), compact=True, canonical=True)
+        self.assertIsInstance(compact["domains"][0], model.Domain)
+        self.assertEqual(json.loads(json.dumps(compact, cls=model.ModelEncoder)),
+                         json.loads(json.dumps(PSDecoder().encode(parse(PS_TOPOLOGY), canonical=True))))
+        self.assertEqual(len(model.to_dict(compact)["domains"]), len(plain["domains"]))
+
+    def test_decoder_state_is_released(self):
+        decoder = RSpec3Decoder()
+        decoder.encode(parse(ADVERTISEMENT), component_manager_id=CM_URN, compact=True)
+        self.assertEqual(decoder._parent_collection, {})
+        self.assertEqual(decoder._component_id_cache, {})
+        self.assertIs(decoder._root, None)
+
+    def test_command_line(self):
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        filename = os.path.join(workdir, "rspec.xml")
+        with open(filename, 'w') as out_file:
+            out_file.write(ADVERTISEMENT)
+        outputs = []
+        for options in ([], ["--compact"]):
+            output = os.path.join(workdir, "out%d.json" % len(outputs))
+            subprocess.check_call([sys.executable, "-m", "unisencoder.decoder", "-t", "rspec3",
+                "-m", CM_URN, "--log", os.path.join(workdir, "unisencoder.log"),
+                "-o", output] + options + [filename])
+            with open(output) as in_file:
+                outputs.append(json.load(in_file))
+        self.assertEqual(outputs[0], outputs[1])
+
+
+if __name__ == '__main__':
+    unittest2.main()
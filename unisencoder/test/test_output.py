@@ -0,0 +1,241 @@
+'''
+Tests of the output post-processing.
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest2
+
+from lxml import etree
+
+from unisencoder.decoder import RSpec3Decoder, PSDecoder
+from unisencoder.output import share_definitions, resolve, canonicalize, dumps_canonical, \
+    fingerprint, hrefs, build_index, write_index
+from unisencoder.test.documents import ADVERTISEMENT, PS_TOPOLOGY, CM_URN, PC_HARDWARE, \
+    VM_HARDWARE, parse, with_hardware_types
+
+
+def reversed_document(text, tag=None):
+    """
+    Parses text with the children of the root element, or only those
+    named tag, in reverse order.
+    """
+    tree = parse(text)
+    root = tree.getroot()
+    children = [child for child in root if tag is None or child.tag.endswith("}" + tag)]
+    positions = [root.index(child) for child in children]
+    for position, child in zip(positions, reversed(children)):
+        root.insert(position, child)
+    return tree
+
+
+def references(obj, out):
+    """Returns (where, URN pointed to) for every href of obj, by URN."""
+    found = []
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            if key in ("ports", "endpoints"):
+                found.extend((obj.get("urn", None), key, resolve(out, href)["urn"])
+                             for href in hrefs(value))
+            else:
+                found.extend(references(value, out))
+    elif isinstance(obj, list):
+        for value in obj:
+            found.extend(references(value, out))
+    return found
+
+
+def expand_definitions(obj, out):
+    """Replaces the references to out["definitions"] by what they point to."""
+    if isinstance(obj, dict):
+        if sorted(obj.keys()) == ["href", "rel"] and obj["href"].startswith("#/definitions/"):
+            return expand_definitions(resolve(out, obj["href"]), out)
+        return dict((key, expand_definitions(value, out)) for key, value in obj.iteritems()
+                    if obj is not out or key != "definitions")
+    if isinstance(obj, list):
+        return [expand_definitions(value, out) for value in obj]
+    return obj
+
+
+class ShareDefinitionsTest(unittest2.TestCase):
+
+    def encode(self, **kwargs):
+        # pc1 and pc2 share a long hardware type, vm1 keeps the short pcvm
+        tree = with_hardware_types(ADVERTISEMENT, {"pc1": [PC_HARDWARE], "pc2": [PC_HARDWARE]})
+        return RSpec3Decoder().encode(tree, component_manager_id=CM_URN, **kwargs)
+
+    def test_blocks_are_written_once(self):
+        out = self.encode(shared_definitions=True)
+        self.assertEqual(out["definitions"], {"hardware_types": [{"name": PC_HARDWARE}]})
+        self.assertEqual([node["properties"]["geni"]["hardware_types"][0] for node in out["nodes"]],
+                         [{"href": "#/definitions/hardware_types/0", "rel": "full"},
+                          {"href": "#/definitions/hardware_types/0", "rel": "full"},
+                          {"name": "pcvm"}])
+
+    def test_short_and_single_blocks_stay_in_place(self):
+        # pc is shorter than a reference, pcvm and the component manager are used once
+        kwargs = dict(component_manager_id=CM_URN)
+        out = RSpec3Decoder().encode(parse(ADVERTISEMENT), shared_definitions=True, **kwargs)
+        self.assertNotIn("definitions", out)
+        self.assertEqual(out, RSpec3Decoder().encode(parse(ADVERTISEMENT), **kwargs))
+
+    def test_expanding_gives_the_plain_output(self):
+        out = self.encode(shared_definitions=True)
+        self.assertEqual(expand_definitions(out, out), self.encode())
+
+    def test_nested_blocks(self):
+        image = {"name": "urn:publicid:IDN+example.net+image+ubuntu-22.04-lts-64-std"}
+        out = {"nodes": [{"properties": {"geni": {"sliver_type": {"name": "raw-pc",
+                                                                  "disk_images": [dict(image)]}}}}
+                         for i in range(3)]}
+        share_definitions(out)
+        self.assertEqual(out["definitions"]["disk_images"], [image])
+        self.assertEqual(out["definitions"]["sliver_type"], [{"name": "raw-pc", "disk_images": [
+            {"href": "#/definitions/disk_images/0", "rel": "full"}]}])
+        for node in out["nodes"]:
+            self.assertEqual(node["properties"]["geni"]["sliver_type"],
+                             {"href": "#/definitions/sliver_type/0", "rel": "full"})
+
+    def test_nothing_to_share(self):
+        out = {"nodes": [{"properties": {"geni": {"component_id": "a"}}}]}
+        self.assertEqual(share_definitions(out), {"nodes": [{"properties": {"geni": {"component_id": "a"}}}]})
+
+
+class CanonicalTest(unittest2.TestCase):
+
+    def test_document_order_does_not_matter(self):
+        first = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                                       canonical=True)
+        second = RSpec3Decoder().encode(reversed_document(ADVERTISEMENT, "node"),
+                                        component_manager_id=CM_URN, canonical=True)
+        self.assertEqual(dumps_canonical(first), dumps_canonical(second))
+        self.assertEqual([node["urn"] for node in first["nodes"]],
+                         sorted(node["urn"] for node in first["nodes"]))
+
+        first = PSDecoder().encode(parse(PS_TOPOLOGY), canonical=True)
+        second = PSDecoder().encode(reversed_document(PS_TOPOLOGY), canonical=True)
+        self.assertEqual(dumps_canonical(first), dumps_canonical(second))
+
+    def test_shared_definitions_order_does_not_matter(self):
+        # vm1 and its VM_HARDWARE come first in the reversed document
+        hardware = {"pc1": [PC_HARDWARE, VM_HARDWARE], "pc2": [PC_HARDWARE], "vm1": [VM_HARDWARE]}
+        text = etree.tostring(with_hardware_types(ADVERTISEMENT, hardware))
+        kwargs = dict(component_manager_id=CM_URN, canonical=True, shared_definitions=True)
+        first = RSpec3Decoder().encode(parse(text), **kwargs)
+        second = RSpec3Decoder().encode(reversed_document(text, "node"), **kwargs)
+        self.assertEqual(dumps_canonical(first), dumps_canonical(second))
+        self.assertEqual(first["definitions"]["hardware_types"],
+                         [{"name": PC_HARDWARE}, {"name": VM_HARDWARE}])
+        vm1 = [node for node in second["nodes"] if node["name"] == "vm1"][0]
+        self.assertEqual(resolve(second, vm1["properties"]["geni"]["hardware_types"][0]["href"]),
+                         {"name": VM_HARDWARE})
+
+    def test_nested_definitions_are_sorted(self):
+        # Sliver types compare on the sorted positions of their disk images
+        out = {"definitions": {
+            "disk_images": [{"name": "b"}, {"name": "a"}],
+            "sliver_type": [
+                {"name": "x", "disk_images": [{"href": "#/definitions/disk_images/0", "rel": "full"}]},
+                {"name": "x", "disk_images": [{"href": "#/definitions/disk_images/1", "rel": "full"}]}]},
+            "nodes": [{"sliver_type": {"href": "#/definitions/sliver_type/0", "rel": "full"}}]}
+        canonicalize(out)
+        self.assertEqual(out["definitions"]["disk_images"], [{"name": "a"}, {"name": "b"}])
+        self.assertEqual([block["disk_images"][0]["href"] for block in out["definitions"]["sliver_type"]],
+                         ["#/definitions/disk_images/0", "#/definitions/disk_images/1"])
+        sliver_type = resolve(out, out["nodes"][0]["sliver_type"]["href"])
+        self.assertEqual(resolve(out, sliver_type["disk_images"][0]["href"]), {"name": "b"})
+
+    def test_pointers_follow_the_resources(self):
+        plain = RSpec3Decoder().encode(reversed_document(ADVERTISEMENT, "node"),
+                                       component_manager_id=CM_URN)
+        out = RSpec3Decoder().encode(reversed_document(ADVERTISEMENT, "node"),
+                                     component_manager_id=CM_URN, canonical=True)
+        self.assertNotEqual([node["urn"] for node in out["nodes"]],
+                            [node["urn"] for node in plain["nodes"]])
+        self.assertTrue(references(plain, plain))
+        self.assertEqual(sorted(references(out, out)), sorted(references(plain, plain)))
+
+    def test_fingerprints(self):
+        out = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                                     canonical=True)
+        for resource in out["nodes"] + out["ports"] + out["links"]:
+            self.assertEqual(resource["properties"]["fingerprint"], fingerprint(resource))
+        self.assertNotIn("fingerprint", out.get("properties", {}))
+        self.assertEqual(len(set(node["properties"]["fingerprint"] for node in out["nodes"])), 3)
+
+    def test_fingerprint_ignores_self_ref(self):
+        node = {"$schema": "http://unis.incntre.iu.edu/schema/20140214/node#", "urn": "a"}
+        digest = fingerprint(node)
+        self.assertEqual(fingerprint(dict(node, selfRef="http://unis/nodes/a")), digest)
+        self.assertEqual(fingerprint(dict(node, properties={"fingerprint": "x"})),
+                         fingerprint(dict(node, properties={})))
+        self.assertNotEqual(fingerprint(dict(node, urn="b")), digest)
+
+    def test_canonicalize_is_idempotent(self):
+        out = PSDecoder().encode(parse(PS_TOPOLOGY), canonical=True)
+        text = dumps_canonical(out)
+        self.assertEqual(dumps_canonical(canonicalize(out)), text)
+
+
+class IndexTest(unittest2.TestCase):
+
+    def check_pointers(self, out, index):
+        for table in ("urns", "ids"):
+            for key, pointer in index[table].iteritems():
+                self.assertEqual(resolve(out, pointer)[table[:-1]], key)
+
+    def test_rspec(self):
+        out = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN)
+        index = build_index(out)
+        self.check_pointers(out, index)
+        self.assertEqual(index["urns"][CM_URN], "#")
+        port = index["urns"]["urn:publicid:IDN+example.net+interface+pc2:eth0"]
+        self.assertEqual(index["port_node"][port],
+                         index["urns"]["urn:publicid:IDN+example.net+node+pc2"])
+        self.assertEqual(index["port_links"][port],
+                         [index["urns"]["urn:publicid:IDN+example.net+link+pc1-pc2"]])
+        vm_port = index["urns"]["urn:publicid:IDN+example.net+interface+vm1:eth0"]
+        self.assertNotIn(vm_port, index["port_links"])
+
+    def test_ps_links_nested_in_ports(self):
+        out = PSDecoder().encode(parse(PS_TOPOLOGY))
+        index = build_index(out)
+        self.check_pointers(out, index)
+        port = index["urns"]["urn:ogf:network:domain=a.example.net:node=r1:port=xe-0"]
+        self.assertEqual(index["port_node"][port],
+                         index["urns"]["urn:ogf:network:domain=a.example.net:node=r1"])
+        # The port's own link and the remote link ending at it
+        self.assertEqual(index["port_links"][port], sorted([
+            index["urns"]["urn:ogf:network:domain=a.example.net:node=r1:port=xe-0:link=1"],
+            index["urns"]["urn:ogf:network:domain=b.example.net:node=r2:port=xe-1:link=1"]]))
+
+    def test_follows_canonical_order(self):
+        out = RSpec3Decoder().encode(reversed_document(ADVERTISEMENT, "node"),
+                                     component_manager_id=CM_URN, canonical=True)
+        self.check_pointers(out, build_index(out))
+
+    def test_write_index_and_command_line(self):
+        workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        out = PSDecoder().encode(parse(PS_TOPOLOGY))
+        filename = os.path.join(workdir, "index.json")
+        write_index(out, filename)
+        with open(filename) as in_file:
+            self.assertEqual(json.load(in_file), json.loads(json.dumps(build_index(out))))
+
+        source = os.path.join(workdir, "topology.xml")
+        with open(source, 'w') as out_file:
+            out_file.write(PS_TOPOLOGY)
+        subprocess.check_call([sys.executable, "-m", "unisencoder.decoder", "-t", "ps",
+            "--log", os.path.join(workdir, "unisencoder.log"), "-o", os.path.join(workdir, "out.json"),
+            "--index", os.path.join(workdir, "cli.json"), source])
+        with open(os.path.join(workdir, "cli.json")) as in_file:
+            self.assertEqual(json.load(in_file)["urns"], json.loads(json.dumps(build_index(out)))["urns"])
+
+
+if __name__ == '__main__':
+    unittest2.main()
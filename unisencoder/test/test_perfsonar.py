@@ -0,0 +1,408 @@
+'''
+Tests of the perfSONAR topology fetcher against in-process SOAP services.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest2
+from StringIO import StringIO
+
+import mock
+
+from unisencoder import perfsonar
+from unisencoder.decoder import PSDecoder
+from unisencoder.unisclient import UNISClientException
+from unisencoder.test.documents import PS_TOPOLOGY, parse
+
+
+SOAP_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">
+  <SOAP-ENV:Body>
+    <nmwg:message xmlns:nmwg="http://ggf.org/ns/nmwg/base/2.0/" type="TSQueryResponse">
+      <nmwg:data id="data1">%s</nmwg:data>
+    </nmwg:message>
+  </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+"""
+
+TOPOLOGY_RESPONSE = SOAP_RESPONSE % PS_TOPOLOGY.split("?>", 1)[1]
+
+
+def compress(body):
+    buf = StringIO()
+    out_file = gzip.GzipFile(fileobj=buf, mode="wb")
+    out_file.write(body)
+    out_file.close()
+    return buf.getvalue()
+
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out have closed their end already
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers POSTs from the routes of its FakeService."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        service = self.server.service
+        request = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        route = service.routes[self.path]
+        with service.lock:
+            service.requests.append(self.path)
+            service.in_flight += 1
+            service.max_in_flight = max(service.max_in_flight, service.in_flight)
+        try:
+            time.sleep(route.get("delay", 0))
+            etag = route.get("etag", None)
+            if etag is not None and self.headers.get("If-None-Match", None) == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = route["body"]
+            if callable(body):
+                body = body(request)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+            if etag is not None:
+                self.send_header("ETag", etag)
+            if route.get("gzip", False):
+                body = compress(body)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with service.lock:
+                service.in_flight -= 1
+
+
+class FakeService(object):
+    """
+    perfSONAR services served from a background thread. routes maps a
+    path to a dict with the response "body" (or a function of the request
+    body returning it) and optionally "gzip", "delay" and "etag".
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self._server = ServiceServer(("127.0.0.1", 0), ServiceHandler)
+        self._server.service = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self._server.server_address[1], path)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def closed_port_url():
+    """Returns a url nothing listens on."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%d/ts" % port
+
+
+def lookup_response(topology_services, lookup_services):
+    """Returns a lookup service route body listing the given access points."""
+    def body(request):
+        if "serviceType" in request:
+            access_points = lookup_services
+        else:
+            access_points = topology_services
+        return SOAP_RESPONSE % "".join(
+            '<psservice:accessPoint xmlns:psservice="%s">%s</psservice:accessPoint>' %
+            (perfsonar.PSSERVICE_NS, access_point) for access_point in access_points)
+    return body
+
+
+class PerfSONARTestCase(unittest2.TestCase):
+
+    routes = {}
+
+    def setUp(self):
+        self.service = FakeService(dict(self.routes))
+
+    def tearDown(self):
+        self.service.stop()
+
+
+class RunConcurrentlyTest(unittest2.TestCase):
+
+    def test_results_and_errors(self):
+        def func(item):
+            if item % 3 == 0:
+                raise ValueError("bad %d" % item)
+            return item * 2
+        results, errors = perfsonar.run_concurrently(func, range(10), 4)
+        self.assertEqual(results, dict((item, item * 2) for item in range(10) if item % 3))
+        self.assertEqual(sorted(errors), [0, 3, 6, 9])
+        self.assertIsInstance(errors[3], ValueError)
+
+    def test_no_items(self):
+        self.assertEqual(perfsonar.run_concurrently(lambda item: item, [], 4), ({}, {}))
+
+
+class FetchTest(PerfSONARTestCase):
+
+    routes = {
+        "/ts": {"body": TOPOLOGY_RESPONSE},
+        "/gzip": {"body": TOPOLOGY_RESPONSE, "gzip": True},
+        "/slow": {"body": TOPOLOGY_RESPONSE, "delay": 2},
+        "/empty": {"body": SOAP_RESPONSE % ""},
+    }
+
+    def test_fetch(self):
+        out = perfsonar.TopologyFetcher().fetch(self.service.url("/ts"))
+        self.assertEqual(out, PSDecoder().encode(parse(PS_TOPOLOGY)))
+
+    def test_fetch_gzip(self):
+        out = perfsonar.TopologyFetcher().fetch(self.service.url("/gzip"))
+        self.assertEqual(out, PSDecoder().encode(parse(PS_TOPOLOGY)))
+
+    def test_no_topology(self):
+        with self.assertRaises(perfsonar.PerfSONARException):
+            perfsonar.TopologyFetcher().fetch(self.service.url("/empty"))
+
+    def test_fetch_topologies(self):
+        urls = [self.service.url("/ts"), self.service.url("/gzip"),
+                self.service.url("/slow"), closed_port_url()]
+        start = time.time()
+        results, errors = perfsonar.fetch_topologies(urls, workers=4,
+            timeouts={self.service.url("/slow"): 0.5})
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(sorted(results), sorted(urls[:2]))
+        self.assertEqual(sorted(errors), sorted(urls[2:]))
+
+    def test_workers_bound_requests_in_flight(self):
+        self.service.routes["/wait"] = {"body": TOPOLOGY_RESPONSE, "delay": 0.1}
+        urls = [self.service.url("/wait") + "?%d" % index for index in range(6)]
+        for url in urls:
+            self.service.routes[url[url.index("/wait"):]] = self.service.routes["/wait"]
+        results, errors = perfsonar.fetch_topologies(urls, workers=2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.service.max_in_flight, 2)
+
+
+class CacheTest(PerfSONARTestCase):
+
+    routes = {
+        "/ts": {"body": TOPOLOGY_RESPONSE, "etag": '"v1"'},
+        "/plain": {"body": TOPOLOGY_RESPONSE},
+    }
+
+    def setUp(self):
+        PerfSONARTestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def fetcher(self, **kwargs):
+        return perfsonar.TopologyFetcher(cache=perfsonar.TopologyCache(self.workdir, **kwargs))
+
+    def encode_calls(self):
+        return mock.patch.object(PSDecoder, "encode", autospec=True, side_effect=PSDecoder.encode)
+
+    def test_fresh_entry(self):
+        fetcher = self.fetcher(ttl=60)
+        first = fetcher.fetch_entry(self.service.url("/ts"))
+        second = fetcher.fetch_entry(self.service.url("/ts"))
+        self.assertTrue(first["changed"])
+        self.assertFalse(second["changed"])
+        self.assertEqual(second["out"], first["out"])
+        self.assertEqual(len(self.service.requests), 1)
+
+    def test_not_modified(self):
+        fetcher = self.fetcher(ttl=0)
+        fetcher.fetch_entry(self.service.url("/ts"))
+        with self.encode_calls() as encode:
+            entry = fetcher.fetch_entry(self.service.url("/ts"))
+            self.assertFalse(encode.called)
+        self.assertFalse(entry["changed"])
+        self.assertEqual(len(self.service.requests), 2)
+
+    def test_unchanged_topology_is_not_encoded(self):
+        fetcher = self.fetcher(ttl=0)
+        fetcher.fetch_entry(self.service.url("/plain"))
+        with self.encode_calls() as encode:
+            entry = fetcher.fetch_entry(self.service.url("/plain"))
+            self.assertFalse(encode.called)
+        self.assertFalse(entry["changed"])
+
+    def test_options_are_part_of_the_key(self):
+        fetcher = self.fetcher(ttl=60)
+        url = self.service.url("/plain")
+        plain = fetcher.fetch(url)
+        canonical = fetcher.fetch(url, canonical=True)
+        self.assertEqual(len(self.service.requests), 2)
+        self.assertEqual(canonical, PSDecoder().encode(parse(PS_TOPOLOGY), canonical=True))
+        self.assertEqual(fetcher.fetch(url), plain)
+        self.assertEqual(fetcher.fetch(url, canonical=True), canonical)
+        self.assertEqual(len(self.service.requests), 2)
+
+    def test_processes_is_not_part_of_the_key(self):
+        cache = perfsonar.TopologyCache(self.workdir)
+        self.assertEqual(cache.key("http://ts", options=perfsonar.cache_options({"processes": 4})),
+                         cache.key("http://ts"))
+        self.assertNotEqual(cache.key("http://ts", options={"canonical": True}),
+                            cache.key("http://ts"))
+
+    def test_uncacheable_options(self):
+        self.assertEqual(perfsonar.cache_options({"registry": object()}), None)
+        self.assertEqual(perfsonar.cache_options({"compact": True}), None)
+        fetcher = self.fetcher(ttl=60)
+        fetcher.fetch(self.service.url("/plain"), compact=True)
+        fetcher.fetch(self.service.url("/plain"), compact=True)
+        self.assertEqual(len(self.service.requests), 2)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_evict(self):
+        cache = perfsonar.TopologyCache(self.workdir, max_bytes=250)
+        for index in range(5):
+            cache.put("http://ts%d" % index, {"out": "x" * 100})
+            os.utime(os.path.join(self.workdir, cache.key("http://ts%d" % index) + ".json"),
+                     (index, index))
+        cache.evict()
+        self.assertEqual(cache.get("http://ts0"), None)
+        self.assertEqual(cache.get("http://ts4"), {"out": "x" * 100})
+        self.assertEqual(len(os.listdir(self.workdir)), 2)
+
+
+class LookupCrawlerTest(PerfSONARTestCase):
+
+    def setUp(self):
+        PerfSONARTestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.cache_path = os.path.join(self.workdir, "discovered.json")
+        url = self.service.url
+        self.service.routes.update({
+            "/ls1": {"body": lookup_response(["http://ts1", "http://ts2"], [url("/ls2")])},
+            "/ls2": {"body": lookup_response(["http://ts2", "http://ts3"], [url("/ls1"), url("/ls3")])},
+            "/ls3": {"body": lookup_response(["http://ts4"], [])},
+            "/empty": {"body": lookup_response([], [])},
+        })
+
+    def crawler(self, lookup_services, **kwargs):
+        kwargs.setdefault("cache_path", self.cache_path)
+        kwargs.setdefault("ttl", 60)
+        kwargs.setdefault("depth", 3)
+        return perfsonar.LookupCrawler([self.service.url(path) for path in lookup_services],
+                                       **kwargs)
+
+    def test_discover(self):
+        services = self.crawler(["/ls1"]).discover()
+        self.assertEqual(services, ["http://ts1", "http://ts2", "http://ts3", "http://ts4"])
+        # Each lookup service is asked twice, once per query
+        self.assertEqual(sorted(self.service.requests),
+                         ["/ls1", "/ls1", "/ls2", "/ls2", "/ls3", "/ls3"])
+
+    def test_depth(self):
+        services = self.crawler(["/ls1"], depth=1).discover()
+        self.assertEqual(services, ["http://ts1", "http://ts2"])
+
+    def test_cached(self):
+        self.crawler(["/ls1"]).discover()
+        requests = len(self.service.requests)
+        self.assertEqual(len(self.crawler(["/ls1"]).discover()), 4)
+        self.assertEqual(len(self.service.requests), requests)
+        self.crawler(["/ls1"]).discover(refresh=True)
+        self.assertGreater(len(self.service.requests), requests)
+
+    def test_cache_is_per_bootstrap_list(self):
+        self.crawler(["/ls1"]).discover()
+        self.assertEqual(self.crawler(["/ls3"]).discover(), ["http://ts4"])
+        self.assertEqual(self.crawler(["/ls3"], depth=1).discover(), ["http://ts4"])
+        self.assertEqual(len(self.service.requests), 10)
+
+    def test_failed_crawl_is_not_cached(self):
+        crawler = perfsonar.LookupCrawler([self.service.url("/ls3"), closed_port_url()],
+            cache_path=self.cache_path, ttl=60, depth=3)
+        with mock.patch.object(crawler, "log") as log:
+            self.assertEqual(crawler.discover(), ["http://ts4"])
+        self.assertEqual([call[0][0] for call in log.error.call_args_list], ["lookup_failed"])
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_empty_crawl_is_not_cached(self):
+        self.assertEqual(self.crawler(["/empty"]).discover(), [])
+        self.assertFalse(os.path.exists(self.cache_path))
+
+
+class TopologyDaemonTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.entries = {}
+        self.fetcher = mock.Mock()
+        self.fetcher.fetch_entry.side_effect = lambda url: dict(self.entries[url])
+        self.client = mock.Mock()
+
+    def daemon(self, urls, **kwargs):
+        return perfsonar.TopologyDaemon(urls, fetcher=self.fetcher, client=self.client, **kwargs)
+
+    def test_pushes_changed_topologies_only(self):
+        daemon = self.daemon(["http://ts"])
+        self.entries["http://ts"] = {"topology_hash": "1", "out": {"id": "v1"}}
+        self.assertTrue(daemon.poll("http://ts"))
+        self.assertFalse(daemon.poll("http://ts"))
+        self.entries["http://ts"] = {"topology_hash": "2", "out": {"id": "v2"}}
+        self.assertTrue(daemon.poll("http://ts"))
+        self.assertEqual(self.client.post.call_args_list,
+                         [(("topologies", {"id": "v1"}), {}), (("topologies", {"id": "v2"}), {})])
+
+    def test_failures_are_retried_on_the_next_poll(self):
+        daemon = self.daemon(["http://ts"])
+        self.assertFalse(daemon.poll("http://ts"))
+        self.entries["http://ts"] = {"topology_hash": "1", "out": {}}
+        self.client.post.side_effect = UNISClientException("down")
+        self.assertFalse(daemon.poll("http://ts"))
+        self.client.post.side_effect = None
+        self.assertTrue(daemon.poll("http://ts"))
+
+    def test_schedule(self):
+        polled = []
+        urls = ["http://ts1", "http://ts2"]
+        for url in urls:
+            self.entries[url] = {"topology_hash": "1", "out": {}}
+        daemon = self.daemon(urls, interval=0.05, jitter=0.5, workers=2)
+        poll = daemon.poll
+        def record(url):
+            polled.append(url)
+            return poll(url)
+        daemon.poll = record
+        daemon.start()
+        time.sleep(0.5)
+        daemon.stop()
+        for url in urls:
+            self.assertGreater(polled.count(url), 2)
+        self.assertEqual(self.client.post.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest2.main()
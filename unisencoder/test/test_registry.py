@@ -0,0 +1,96 @@
+'''
+Tests of the URN registry.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest2
+
+from unisencoder.decoder import RSpec3Decoder, PSDecoder, UNISDecoderException
+from unisencoder.output import resolve
+from unisencoder.registry import URNRegistry
+from unisencoder.test.documents import ADVERTISEMENT, MANIFEST, PS_TOPOLOGY, CM_URN, \
+    SLICE_URN, parse
+
+
+PC1 = "urn:publicid:IDN+example.net+node+pc1"
+
+
+def domain_document(index):
+    """PS_TOPOLOGY with only its index-th domain."""
+    tree = parse(PS_TOPOLOGY)
+    root = tree.getroot()
+    root.remove(root[1 - index])
+    return tree
+
+
+class RegistryTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="unisencoder-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.path = os.path.join(self.workdir, "urns.db")
+        self.registry = URNRegistry(self.path)
+        self.addCleanup(self.registry.close)
+
+    def test_register_and_lookup(self):
+        out = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                                     registry=self.registry)
+        entry = self.registry.lookup(PC1)
+        self.assertEqual(entry["document"], CM_URN)
+        self.assertEqual(entry["kind"], "node")
+        self.assertEqual(resolve(out, entry["pointer"])["urn"], PC1)
+        self.assertEqual(entry["id"], resolve(out, entry["pointer"])["id"])
+        self.assertEqual(self.registry.reference(PC1, CM_URN), entry["pointer"])
+        self.assertEqual(self.registry.reference(PC1, "other"), CM_URN + entry["pointer"])
+        self.assertIsNone(self.registry.lookup("urn:publicid:IDN+example.net+node+missing"))
+        # Quoted URNs are found too
+        self.assertEqual(self.registry.lookup(PC1.replace("+", "%2B"))["pointer"], entry["pointer"])
+
+    def test_manifest_relations_resolve_to_the_advertisement(self):
+        ad = RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                                    registry=self.registry)
+        out = RSpec3Decoder().encode(parse(MANIFEST), slice_urn=SLICE_URN, registry=self.registry)
+        for resource in out["nodes"] + out["ports"]:
+            href = resource["relations"]["over"][0]["href"]
+            self.assertTrue(href.startswith(CM_URN + "#/"), href)
+            target = resolve(ad, href[len(CM_URN):])
+            self.assertEqual(target["urn"], resource["properties"]["geni"]["component_id"])
+        self.assertEqual(self.registry.lookup(out["nodes"][0]["urn"])["document"], SLICE_URN)
+
+    def test_remote_links_between_documents(self):
+        PSDecoder().encode(domain_document(1), registry=self.registry, document="b")
+        out = PSDecoder().encode(domain_document(0), registry=self.registry, document="a")
+        link = out["domains"][0]["links"][0]
+        self.assertEqual(link["endpoints"]["source"]["href"], "#/domains/0/ports/0")
+        self.assertEqual(link["endpoints"]["sink"]["href"], "b#/domains/0/ports/0")
+        self.assertEqual(link["relations"]["sibling"][0]["href"], "b#/domains/0/links/0")
+
+    def test_reregistering_replaces_a_document(self):
+        RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                               registry=self.registry, document="ad")
+        tree = parse(ADVERTISEMENT)
+        root = tree.getroot()
+        root.remove(root[0])
+        RSpec3Decoder().encode(tree, component_manager_id=CM_URN, registry=self.registry,
+                               document="ad")
+        self.assertIsNone(self.registry.lookup(PC1))
+        self.assertEqual(self.registry.lookup("urn:publicid:IDN+example.net+node+pc2")["pointer"],
+                         "#/nodes/0")
+
+    def test_persists(self):
+        RSpec3Decoder().encode(parse(ADVERTISEMENT), component_manager_id=CM_URN,
+                               registry=self.registry)
+        self.registry.close()
+        registry = URNRegistry(self.path)
+        self.addCleanup(registry.close)
+        self.assertEqual(registry.lookup(PC1)["document"], CM_URN)
+
+    def test_document_name_required(self):
+        with self.assertRaisesRegexp(UNISDecoderException, "document name"):
+            PSDecoder()._finish('{"domains": []}', registry=self.registry)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,149 @@
+'''
+Tests of the streaming UNIS client against the in-process fake UNIS.
+'''
+
+import BaseHTTPServer
+import httplib
+import socket
+import threading
+import time
+import unittest2
+
+import mock
+
+from unisencoder.fakeunis import FakeUNIS
+from unisencoder.unisclient import UNISClient, UNISClientException
+
+
+class TextHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every request with a plain text error page."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = "<html>Bad Gateway</html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UNISClientTestCase(unittest2.TestCase):
+    """Runs each test against its own fake UNIS."""
+
+    def setUp(self):
+        self.unis = FakeUNIS().start()
+
+    def tearDown(self):
+        self.unis.stop()
+
+    def client(self, **kwargs):
+        client = UNISClient(host=self.unis.host, port=self.unis.port, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+
+class UNISClientTest(UNISClientTestCase):
+
+    def test_round_trip(self):
+        client = self.client(gzip=False, chunk_size=16)
+        doc = {"name": "a" * 100, "mode": "file", "extents": range(50)}
+        created = client.post("exnodes", doc)
+        self.assertEqual(client.get("exnodes/%s" % created["id"])["extents"], range(50))
+
+    def test_gzip_round_trip(self):
+        client = self.client(gzip=True, chunk_size=16)
+        created = client.post("exnodes", {"name": "b" * 1000, "mode": "file"})
+        self.assertEqual(created["name"], "b" * 1000)
+        self.assertLess(self.unis.bytes_received, 1000)
+
+    def test_empty_body(self):
+        # The terminator alone still frames a complete request, the fake
+        # rejects the empty document and the connection stays usable
+        client = self.client()
+        with self.assertRaises(UNISClientException) as context:
+            client.send("POST", "exnodes", lambda: iter([]))
+        self.assertEqual(context.exception.status, 400)
+        self.assertEqual(client.get("exnodes"), [])
+
+    def test_error_status(self):
+        client = self.client()
+        with self.assertRaises(UNISClientException) as context:
+            client.get("exnodes/missing")
+        self.assertEqual(context.exception.status, 404)
+
+    def test_response_that_is_not_json(self):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), TextHandler)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        client = UNISClient(host="http://127.0.0.1", port=server.server_address[1])
+        try:
+            with self.assertRaises(UNISClientException) as context:
+                client.get("exnodes")
+            self.assertEqual(context.exception.status, 200)
+        finally:
+            client.close()
+            thread.join()
+            server.server_close()
+
+    def test_requests_are_not_delayed(self):
+        # A request split over several writes waits on the delayed ACK of
+        # the first one, about 40ms each on Linux
+        client = self.client(gzip=False)
+        client.post("exnodes", {"name": "warmup"})
+        start = time.time()
+        for index in range(20):
+            client.post("exnodes", {"name": "f%d" % index})
+        self.assertLess(time.time() - start, 0.5)
+
+
+class RetryTest(UNISClientTestCase):
+
+    def connected_client(self):
+        """Returns a client whose pooled connection is already open."""
+        client = self.client()
+        self.created = client.post("exnodes", {"name": "a", "mode": "file"})
+        return client
+
+    def test_post_is_not_replayed(self):
+        client = self.connected_client()
+        self.unis.drop = 1
+        with self.assertRaises(UNISClientException):
+            client.post("exnodes", {"name": "b", "mode": "file"})
+        self.assertEqual(self.unis.request_count, 2)
+        self.assertEqual(len(self.unis.files()), 1)
+
+    def test_idempotent_requests_are_replayed(self):
+        client = self.connected_client()
+        path = "exnodes/%s" % self.created["id"]
+        self.unis.drop = 1
+        self.assertEqual(client.get(path)["name"], "a")
+        self.unis.drop = 1
+        client.put(path, {"name": "b", "mode": "file"})
+        self.assertEqual(self.unis.request_count, 5)
+        self.assertEqual(client.get(path)["name"], "b")
+
+    def test_post_that_was_not_written_is_retried(self):
+        client = self.connected_client()
+        endheaders = httplib.HTTPConnection.endheaders
+        failures = [socket.error(32, "Broken pipe")]
+        def failing_endheaders(conn, *args):
+            if failures:
+                raise failures.pop()
+            return endheaders(conn, *args)
+        with mock.patch.object(httplib.HTTPConnection, "endheaders", failing_endheaders):
+            client.post("exnodes", {"name": "b", "mode": "file"})
+        self.assertEqual(sorted(exnode["name"] for exnode in self.unis.files()), ["a", "b"])
+
+    def test_new_connections_are_not_retried(self):
+        client = self.client()
+        self.unis.drop = 1
+        with self.assertRaises(UNISClientException):
+            client.get("exnodes")
+        self.assertEqual(self.unis.request_count, 1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,128 @@
+'''
+Tests of the HTTP encoding service.
+'''
+
+import httplib
+import json
+import socket
+import threading
+import unittest2
+import urllib
+
+import mock
+
+from unisencoder.webserver import DecoderPool, EncoderServer
+from unisencoder.test.documents import ADVERTISEMENT, CM_URN
+
+
+class WebserverTest(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = EncoderServer(("127.0.0.1", 0), workers=1, max_body=64 * 1024)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.conn = httplib.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def post(self, path, body, headers=None):
+        self.conn.request("POST", path, body, headers or {})
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def encode_path(self):
+        return "/encode/rspec3?" + urllib.urlencode({"component_manager_id": CM_URN})
+
+    def test_encode(self):
+        response, body = self.post(self.encode_path(), ADVERTISEMENT)
+        self.assertEqual(response.status, 200)
+        out = json.loads(body)
+        self.assertEqual(out["urn"], CM_URN)
+        self.assertEqual(len(out["nodes"]), 3)
+        self.assertTrue(response.getheader("ETag"))
+
+    def test_compact(self):
+        response, body = self.post(self.encode_path(), ADVERTISEMENT)
+        compact_path = "/encode/rspec3?" + urllib.urlencode({"component_manager_id": CM_URN,
+                                                             "compact": "true"})
+        with mock.patch.object(DecoderPool, "encode", wraps=self.server.decoders.encode) as encode:
+            compact, compact_body = self.post(compact_path, ADVERTISEMENT)
+            self.assertIs(encode.call_args[1]["compact"], True)
+        self.assertEqual(compact.status, 200)
+        self.assertEqual(json.loads(compact_body), json.loads(body))
+
+    def test_element_filter(self):
+        path = "/encode/rspec3?" + urllib.urlencode({"component_manager_id": CM_URN, "kinds": "link"})
+        response, body = self.post(path, ADVERTISEMENT)
+        self.assertEqual(response.status, 200)
+        out = json.loads(body)
+        self.assertEqual(out.get("nodes", []), [])
+        self.assertEqual(len(out["links"]), 1)
+
+        # The unfiltered response is cached apart from the filtered one
+        self.post(self.encode_path(), ADVERTISEMENT)
+        path = "/encode/rspec3?" + urllib.urlencode({"component_manager_id": CM_URN, "available": "true"})
+        response, body = self.post(path, ADVERTISEMENT)
+        self.assertEqual(sorted(node["name"] for node in json.loads(body)["nodes"]), ["pc1", "vm1"])
+
+    def test_cached_response(self):
+        first, first_body = self.post(self.encode_path(), ADVERTISEMENT)
+        with mock.patch.object(DecoderPool, "encode") as encode:
+            second, second_body = self.post(self.encode_path(), ADVERTISEMENT)
+            self.assertFalse(encode.called)
+        self.assertEqual(second_body, first_body)
+        self.assertEqual(second.getheader("ETag"), first.getheader("ETag"))
+
+        response, body = self.post(self.encode_path(), ADVERTISEMENT,
+                                   {"If-None-Match": first.getheader("ETag")})
+        self.assertEqual(response.status, 304)
+
+    def test_bad_document(self):
+        response, body = self.post(self.encode_path(), "<rspec")
+        self.assertEqual(response.status, 400)
+        # Without a component manager the advertisement is rejected
+        response, body = self.post("/encode/rspec3", ADVERTISEMENT)
+        self.assertEqual(response.status, 400)
+        self.assertIn("component_manager_id", json.loads(body)["error"])
+
+    def test_unknown_path(self):
+        response, body = self.post("/encode/xml", ADVERTISEMENT)
+        self.assertEqual(response.status, 404)
+
+    def test_unexpected_error(self):
+        with mock.patch.object(DecoderPool, "encode", side_effect=RuntimeError("boom")):
+            response, body = self.post(self.encode_path(), ADVERTISEMENT)
+        self.assertEqual(response.status, 500)
+        self.assertIn("boom", json.loads(body)["error"])
+        # The connection is still usable
+        response, body = self.post(self.encode_path(), ADVERTISEMENT)
+        self.assertEqual(response.status, 200)
+
+    def test_body_too_large_closes_the_connection(self):
+        sock = socket.create_connection(self.server.server_address, timeout=10)
+        try:
+            sock.sendall("POST %s HTTP/1.1\r\nHost: localhost\r\n"
+                         "Content-Length: %d\r\n\r\n" % (self.encode_path(), 1024 * 1024))
+            sock.sendall("GET / HTTP/1.1\r\n\r\n")
+            received = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                received.append(data)
+        finally:
+            sock.close()
+        response = "".join(received)
+        self.assertTrue(response.startswith("HTTP/1.1 413"))
+        self.assertIn("Connection: close", response)
+        # Nothing of the unread body was answered as a request
+        self.assertEqual(response.count("HTTP/1.1"), 1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,207 @@
+'''
+Streaming HTTP client for UNIS.
+
+Request bodies are serialized incrementally and sent with chunked transfer
+encoding, optionally gzip compressed, so the full JSON document is never
+held in memory as a single string. Connections are kept alive and reused,
+one per thread.
+'''
+
+import httplib
+import json
+import socket
+import threading
+import time
+import urlparse
+import uuid
+import zlib
+import settings
+from netlogger import nllog
+
+
+# Methods that are safe to send twice
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT", "DELETE"]
+
+
+class UNISClientException(Exception):
+    """Raised when UNIS cannot be reached or answers with an error."""
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+def json_chunks(obj):
+    """Yields the JSON serialization of obj piece by piece."""
+    return json.JSONEncoder().iterencode(obj)
+
+
+class UNISClient(object, nllog.DoesLogging):
+    """Sends JSON documents to a UNIS instance."""
+    
+    def __init__(self, host=None, port=None, **kwargs):
+        nllog.DoesLogging.__init__(self)
+        self._guid = uuid.uuid1()
+        if host is None:
+            host = settings.UNIS_HOST
+        if port is None:
+            port = settings.UNIS_PORT
+        url = urlparse.urlparse(host)
+        self._scheme = url.scheme or "http"
+        self._host = url.netloc or url.path
+        self._port = int(port)
+        self._gzip = kwargs.get("gzip", settings.UNIS_GZIP)
+        self._chunk_size = kwargs.get("chunk_size", settings.UNIS_CHUNK_SIZE)
+        self._timeout = kwargs.get("timeout", settings.UNIS_TIMEOUT)
+        self._metrics = kwargs.get("metrics", None)
+        self._keepalive = kwargs.get("keepalive", settings.UNIS_KEEPALIVE)
+        # One persistent connection per thread
+        self._local = threading.local()
+    
+    def get(self, path):
+        return self.send("GET", path, lambda: None)
+    
+    def post(self, path, obj):
+        return self.send("POST", path, lambda: json_chunks(obj))
+    
+    def put(self, path, obj):
+        return self.send("PUT", path, lambda: json_chunks(obj))
+    
+    def send(self, method, path, chunks):
+        """
+        Streams the strings produced by chunks as the request body and
+        returns the decoded JSON response. chunks can also be a callable
+        returning them, which lets a request that failed on a stale pooled
+        connection be sent again on a new one. That is only done when the
+        method is idempotent or nothing of the request was written, UNIS
+        may have processed a POST that got no answer. None sends no body.
+        """
+        start = time.time()
+        attempts = 2 if callable(chunks) else 1
+        for attempt in range(attempts):
+            reused = getattr(self._local, "conn", None) is not None
+            self._local.written = False
+            try:
+                response, body, sent = self._request(method, path,
+                    chunks() if callable(chunks) else chunks)
+                break
+            except (httplib.HTTPException, IOError), e:
+                self.close()
+                if reused and attempt + 1 < attempts and \
+                        (method in IDEMPOTENT_METHODS or not self._local.written):
+                    continue
+                self.log.error("unis_connection_failed", value=str(e), guid=self._guid)
+                self._record(method, start, 0, error=True)
+                raise UNISClientException("Failed to connect to UNIS: %s" % e)
+        
+        self._record(method, start, sent, error=response.status >= 400)
+        if response.status >= 400:
+            self.log.error("unis_request_failed", value=response.status, guid=self._guid)
+            raise UNISClientException("UNIS returned %d for %s /%s" % \
+                (response.status, method, path), response.status)
+        if not body:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError, e:
+            raise UNISClientException("UNIS sent a response that is not JSON: %s" % e,
+                                      response.status)
+    
+    def close(self):
+        """Closes the calling thread's pooled connection."""
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+    
+    def _request(self, method, path, chunks):
+        sent = 0
+        conn = self._connection()
+        conn.putrequest(method, "/" + path.lstrip("/"))
+        if chunks is None:
+            conn.endheaders()
+            self._local.written = True
+        else:
+            conn.putheader("Content-Type", "application/perfsonar+json")
+            conn.putheader("Transfer-Encoding", "chunked")
+            if self._gzip:
+                conn.putheader("Content-Encoding", "gzip")
+            # Each frame is held back until the next one exists, so the
+            # headers leave with the first frame and the terminator with the
+            # last, and a small body is a single write
+            pending = None
+            started = False
+            for block in self._encode_body(chunks):
+                if pending is not None:
+                    if started:
+                        conn.send(pending)
+                    else:
+                        conn.endheaders(pending)
+                        self._local.written = started = True
+                pending = "%x\r\n%s\r\n" % (len(block), block)
+                sent += len(block)
+            pending = (pending or "") + "0\r\n\r\n"
+            if started:
+                conn.send(pending)
+            else:
+                conn.endheaders(pending)
+                self._local.written = True
+        response = conn.getresponse()
+        body = response.read()
+        if not self._keepalive or response.will_close:
+            self.close()
+        return response, body, sent
+    
+    def _record(self, method, start, sent, error=False):
+        if self._metrics is None:
+            return
+        self._metrics.inc("unis_requests", method=method)
+        self._metrics.inc("bytes_sent", sent)
+        if error:
+            self._metrics.inc("unis_errors", method=method)
+        self._metrics.observe("unis_request_seconds", time.time() - start, method=method)
+    
+    def _connection(self):
+        """Returns the calling thread's connection, opening it if needed."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+    
+    def _connect(self):
+        if self._scheme == "https":
+            conn = httplib.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+        else:
+            conn = httplib.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        # Requests are written whole, so there is nothing for Nagle to
+        # coalesce and it would only hold the last segment back
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+    
+    def _encode_body(self, chunks):
+        """Regroups chunks into blocks of about chunk_size bytes, compressing
+        them first when gzip is enabled."""
+        compressor = None
+        if self._gzip:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        buf = []
+        size = 0
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf-8")
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self._chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if compressor is not None:
+            buf.append(compressor.flush())
+        block = "".join(buf)
+        if block:
+            yield block
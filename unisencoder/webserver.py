@@ -2,5 +2,245 @@
 Created on Mar 26, 2012
 
 @author: fernandes
+
+HTTP service that encodes topologies to UNIS without forking a process
+per conversion.
+
+    POST /encode/<type>?slice_urn=...&component_manager_id=...
+
+<type> is one of decoder.DECODERS, the body is the XML document and the
+response is the UNIS JSON, streamed with chunked transfer encoding.
+With compact=true the output waiting to be streamed is held in the
+compact model of unisencoder.model.
+Responses are cached by a hash of the type, options and body, which is
+also returned as the ETag.
 '''
 
+import argparse
+import BaseHTTPServer
+import SocketServer
+import Queue
+import collections
+import hashlib
+import json
+import threading
+import urlparse
+import settings
+from lxml import etree
+from netlogger import nllog
+import model
+from decoder import DECODERS, UNISDecoderException, encode_options, setup_logger
+
+
+# Query parameters passed to the decoders' encode
+ENCODE_OPTIONS = {
+    "rspec3": ["slice_urn", "slice_uuid", "component_manager_id", "compact",
+               "kinds", "urn_prefix", "component_manager", "available"],
+    "ps": ["compact"],
+    "exnode": ["creation_time", "modified_time", "duration"],
+}
+# Exnode lifetimes depend on the time of the request, so never cache them
+CACHEABLE_TYPES = ["rspec3", "ps"]
+
+
+class DecoderPool(object):
+    """Keeps warm decoder instances so requests don't pay their setup."""
+
+    def __init__(self, size):
+        self._pools = {}
+        for input_type, decoder_class in DECODERS.iteritems():
+            pool = Queue.Queue()
+            for i in range(size):
+                pool.put(decoder_class())
+            self._pools[input_type] = pool
+
+    def encode(self, input_type, tree, **kwargs):
+        decoder = self._pools[input_type].get()
+        try:
+            return decoder.encode(tree, **kwargs)
+        finally:
+            decoder.reset()
+            self._pools[input_type].put(decoder)
+
+
+class ResponseCache(object):
+    """LRU cache of serialized responses keyed by input hash."""
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.pop(key, None)
+            if body is not None:
+                self._entries[key] = body
+            return body
+
+    def put(self, key, body):
+        if self._size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = body
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+
+class EncoderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer, nllog.DoesLogging):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=None, max_body=None, cache_size=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, EncoderHandler)
+        nllog.DoesLogging.__init__(self)
+        if workers is None:
+            workers = settings.WEBSERVER_WORKERS
+        if max_body is None:
+            max_body = settings.WEBSERVER_MAX_BODY
+        if cache_size is None:
+            cache_size = settings.WEBSERVER_CACHE_SIZE
+        self.decoders = DecoderPool(workers)
+        self.cache = ResponseCache(cache_size)
+        self.max_body = max_body
+
+
+class EncoderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        if len(parts) != 2 or parts[0] != "encode" or parts[1] not in DECODERS:
+            return self._error(404, "Unknown path '%s'" % url.path)
+        input_type = parts[1]
+
+        length = self.headers.get("Content-Length", None)
+        if length is None:
+            return self._error(411, "Content-Length is required")
+        length = int(length)
+        if length > self.server.max_body:
+            # The unread body would be parsed as the next request, so drop
+            # the connection instead of reading it all
+            return self._error(413, "Request body larger than %d bytes" % self.server.max_body,
+                               close=True)
+        body = self.rfile.read(length)
+
+        params = urlparse.parse_qs(url.query)
+        kwargs = dict((name, params[name][0]) for name in ENCODE_OPTIONS[input_type] if name in params)
+
+        key = hashlib.sha1(input_type)
+        for name in sorted(kwargs.keys()):
+            key.update("\0%s=%s" % (name, kwargs[name]))
+        key.update("\0")
+        key.update(body)
+        etag = '"%s"' % key.hexdigest()
+        cacheable = input_type in CACHEABLE_TYPES
+
+        if cacheable and etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        cached = self.server.cache.get(etag) if cacheable else None
+        if cached is not None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/perfsonar+json")
+            self.send_header("Content-Length", str(len(cached)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(cached)
+            return
+
+        try:
+            out = self._encode(input_type, body, kwargs)
+        except (UNISDecoderException, etree.XMLSyntaxError, ValueError, KeyError), e:
+            return self._error(400, str(e))
+        except Exception, e:
+            self.server.log.error("encode_failed", type=input_type, value=str(e))
+            return self._error(500, "Failed to encode the document: %s" % e)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/perfsonar+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        if cacheable:
+            self.send_header("ETag", etag)
+        self.end_headers()
+
+        blocks = []
+        buf = []
+        size = 0
+        try:
+            for chunk in model.ModelEncoder().iterencode(out):
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= settings.UNIS_CHUNK_SIZE:
+                    self._write_chunk("".join(buf), blocks, cacheable)
+                    buf = []
+                    size = 0
+            if buf:
+                self._write_chunk("".join(buf), blocks, cacheable)
+        except Exception, e:
+            # The 200 is already sent, leaving the chunked body unterminated
+            # is the only way left to tell the client it is incomplete
+            self.server.log.error("encode_failed", type=input_type, value=str(e))
+            self.close_connection = 1
+            return
+        self.wfile.write("0\r\n\r\n")
+        if cacheable:
+            self.server.cache.put(etag, "".join(blocks))
+
+    def _encode(self, input_type, body, kwargs):
+        tree = etree.fromstring(body).getroottree()
+        kwargs = encode_options(input_type, kwargs)
+        return self.server.decoders.encode(input_type, tree, **kwargs)
+
+    def _write_chunk(self, block, blocks, keep):
+        if isinstance(block, unicode):
+            block = block.encode("utf-8")
+        self.wfile.write("%x\r\n%s\r\n" % (len(block), block))
+        if keep:
+            blocks.append(block)
+
+    def _error(self, status, message, close=False):
+        body = json.dumps({"error": message})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if close:
+            self.send_header("Connection", "close")
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="HTTP service encoding RSpec V3, perfSONAR and exnode documents to UNIS"
+    )
+    parser.add_argument('--host', type=str, default="",
+        help='Address to listen on.')
+    parser.add_argument('-p', '--port', type=int, default=settings.WEBSERVER_PORT,
+        help='Port to listen on.')
+    parser.add_argument('-w', '--workers', type=int, default=settings.WEBSERVER_WORKERS,
+        help='Warm decoders kept per input type.')
+    parser.add_argument('-l', '--log', type=str, default="unisencoder.log",
+        help='Log file.')
+    args = parser.parse_args()
+
+    setup_logger(args.log)
+    server = EncoderServer((args.host, args.port), workers=args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()